@@ -12,8 +12,14 @@ fit and guarantees a thread-safe means of passing information from the
 acquisition thread to the main GUI.
 """
 
+import threading
+import collections
+
+import wx
 import wx.lib.newevent
 
+import metrics
+
 # Event used to pass an updated string to the 'comment' TextCtrl on RunPage
 UpdateCommentEvent, EVT_UPDATE_COM_STR = wx.lib.newevent.NewEvent()
 
@@ -50,5 +56,125 @@ FilePathEvent, EVT_FILEPATH = wx.lib.newevent.NewEvent()
 # Event to update Switchbox config (description)
 SB_ConfEvent, EVT_SBCONF = wx.lib.newevent.NewEvent()
 
+# Event to update a source-voltage display (V1Setting/V2Setting) on RunPage
+# after the acquisition thread has set the source itself
+SrcVEvent, EVT_SRC_V = wx.lib.newevent.NewEvent()
+
 # Event to update log file
 LogEvent, EVT_LOG = wx.lib.newevent.NewEvent()
+
+# Event to update the live R1 estimate on RunPage (see liveanalysis.py)
+LiveR1Event, EVT_LIVE_R1 = wx.lib.newevent.NewEvent()
+
+
+"""
+Coalescing event bus:
+The acquisition threads post bursts of StatusEvents (and RLink posts a
+DataEvent per reading). Posting all of them straight to wx floods the event
+queue and forces redundant repaints, so worker threads call Post() instead
+of wx.PostEvent(). Per target window, status events are latest-value-wins
+(per status field), and so are sample-type DataEvents and row/delay
+updates. Pending events are delivered at most once per
+BUS_INTERVAL. Anything else (plot, clear-plot, start/stop-row, end-of-run
+DataEvents, ...) is delivered immediately, after flushing whatever is
+pending for the same target, so ordering is preserved.
+"""
+BUS_INTERVAL = 0.2 # s
+
+class EventBus(threading.Thread):
+    def __init__(self, interval=BUS_INTERVAL):
+        threading.Thread.__init__(self, name='EventBus')
+        self.daemon = True
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = collections.OrderedDict() # {id(target):(target,OrderedDict{key:event})}
+        self.n_posted = 0
+        self.n_delivered = 0
+        self.n_coalesced = 0
+        self._want_stop = threading.Event()
+        self.start()
+
+    def Key(self, ev):
+        # Return the coalescing key for ev, or None if ev must not be coalesced
+        if isinstance(ev, StatusEvent):
+            return ('stat', ev.field)
+        elif isinstance(ev, DataEvent):
+            if ev.flag in 'EF': # end of run - never held back
+                return None
+            return ('data',)
+        elif isinstance(ev, RowEvent):
+            return ('row',)
+        elif isinstance(ev, DelaysEvent):
+            return ('delays',)
+        return None
+
+    def Post(self, target, ev):
+        key = self.Key(ev)
+        with self.lock:
+            self.n_posted += 1
+            if key is None:
+                self._Flush(id(target))
+                wx.PostEvent(target, ev)
+                self.n_delivered += 1
+                return
+            t, events = self.pending.setdefault(id(target), (target, collections.OrderedDict()))
+            if key == ('stat', 'b'): # 'b' overwrites both status fields
+                for k in (('stat', 0), ('stat', 1)):
+                    if k in events:
+                        del events[k]
+                        self.n_coalesced += 1
+            if key in events:
+                self.n_coalesced += 1
+                del events[key] # re-insert at the end to keep delivery order
+            events[key] = ev
+
+    def _Flush(self, tid):
+        # Deliver pending events for one target. Caller holds self.lock.
+        if tid not in self.pending:
+            return
+        target, events = self.pending.pop(tid)
+        for ev in events.values():
+            wx.PostEvent(target, ev)
+            self.n_delivered += 1
+
+    def Flush(self):
+        with self.lock:
+            for tid in self.pending.keys():
+                self._Flush(tid)
+
+    def Depth(self):
+        # Number of events currently held back
+        with self.lock:
+            return sum([len(events) for (t, events) in self.pending.values()])
+
+    def Stats(self):
+        with self.lock:
+            return {'posted':self.n_posted, 'delivered':self.n_delivered,
+                    'coalesced':self.n_coalesced}
+
+    def run(self):
+        while not self._want_stop.wait(self.interval):
+            metrics.Set('hrbc_gui_events_pending', self.Depth())
+            self.Flush()
+        self.Flush()
+
+    def Stop(self):
+        self._want_stop.set()
+
+
+BUS = None
+
+def GetBus():
+    global BUS
+    if BUS is None or not BUS.is_alive():
+        BUS = EventBus()
+    return BUS
+
+
+def Post(target, ev):
+    """ Thread-safe, coalescing replacement for wx.PostEvent(). """
+    GetBus().Post(target, ev)
+
+
+def BusStats():
+    return GetBus().Stats()
@@ -33,8 +33,10 @@ import wx
 import nbpages as page
 import HighRes_events as evts
 import devices
+import runconfig
+import metrics
 
-VERSION = "1.0"
+VERSION = runconfig.VERSION
 
 print 'HRBC',VERSION
 
@@ -49,7 +51,8 @@ class MainFrame(wx.Frame):
         self.Bind(evts.EVT_STAT, self.UpdateStatus)
 
         self.sb = self.CreateStatusBar()
-        self.sb.SetFieldsCount(2)
+        self.sb.SetFieldsCount(3)
+        self.sb.SetStatusWidths([-2,-2,-1]) # Field 2: run duration / ETA
 
         MenuBar = wx.MenuBar()
         FileMenu = wx.Menu()
@@ -80,11 +83,13 @@ class MainFrame(wx.Frame):
         self.page1 = page.SetupPage(self.NoteBook)
         self.page2 = page.RunPage(self.NoteBook)
         self.page3 = page.PlotPage(self.NoteBook)
+        self.page4 = page.HistoryPage(self.NoteBook)
 
         # Add the pages to the notebook with the label to show on the tab
         self.NoteBook.AddPage(self.page1, "Setup")
         self.NoteBook.AddPage(self.page2, "Run")
         self.NoteBook.AddPage(self.page3, "Plots")
+        self.NoteBook.AddPage(self.page4, "History")
 
         # Finally, put the notebook in a sizer for the panel to manage
         # the layout
@@ -111,7 +116,11 @@ class MainFrame(wx.Frame):
         # WEDNESDAY
         print 'Saving',self.page1.XLFile.GetValue(),'...'
         if self.ExcelPath is not None:
-            self.page1.wb.save(self.page1.XLFile.GetValue())
+            if self.page2.Following():
+                print 'Run process has the data file - not saved' # It saves its own data
+            else:
+                self.page1.wb.save(self.page1.XLFile.GetValue())
+            self.page4.Save()
             self.page1.log.close()
     
     
@@ -127,13 +136,12 @@ class MainFrame(wx.Frame):
         dlg.Destroy()
 
     def CloseInstrSessions(self,event=None):
-        for r in devices.ROLES_INSTR.keys():
-            devices.ROLES_INSTR[r].Close()
-        devices.RM.close()
+        devices.CloseAll() # Waits for queued commands to finish
         print'Main.CloseInstrSessions(): closed VISA resource manager and GMH instruments'
 
     def OnQuit(self, event=None):
         self.CloseInstrSessions()
+        metrics.Stop() # Final metrics file
         self.OnSave()
         self.Close()
 
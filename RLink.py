@@ -19,54 +19,61 @@ Contains definitions for usual __init__() and run() methods
 from threading import Thread
 import datetime as dt
 import time
+import traceback
 #import os.path
 #os.environ['XLPATH'] = 'C:\Users\\t.lawson\Documents\Python Scripts\High_Res_Bridge'
 
 import string
 
 import numpy as np
-import wx
 # from openpyxl import load_workbook # WEDNESDAY
 from openpyxl.utils import get_column_letter #column_index_from_string
 from openpyxl.styles import Font, colors
 
-import HighRes_events as evts
 import devices #visastuff
+import checkpoint
+import bustrace
+import metrics
 
 class RLThread(Thread):
     """RLink Thread Class."""
-    def __init__(self, parent):
+    def __init__(self, config, sink, resume=None):
         # This runs when an instance of the class is created
+        # config: a runconfig.RunConfig, sink: a progress.ProgressSink (or TeeSink)
+        # resume: checkpoint state of an unfinished R-link run to continue (see checkpoint.py), or None
         Thread.__init__(self)
-        self.RunPage = parent
-        self.SetupPage = self.RunPage.GetParent().GetPage(0)
-        self.PlotPage = self.RunPage.GetParent().GetPage(2)
-        self.TopLevel = self.RunPage.GetTopLevelParent()
-        self.comment = self.RunPage.Comment.GetValue()
+        self.config = config
+        self.sink = sink
+        self.resume = resume
+        self.run_id = config.run_id
+        self.sb_conf = None # Last switchbox setting
+        self.comment = config.comment
         self._want_abort = 0
+        self.outcome = None # 'finished', 'aborted' or 'failed' when the thread ends
+        self.error = None # Exception that ended a failed run
         self.RLink_data = []
         
-        self.log = self.SetupPage.log
+        self.log = config.log
 
         print'\nRole -> Instrument:'
         print'------------------------------'
         # Print all instrument objects
-        for r in devices.ROLES_WIDGETS.keys():
-            d = devices.ROLES_WIDGETS[r]['icb'].GetValue()
+        for r in config.roles.keys():
+            d = config.roles[r]
             print'%s -> %s'%(devices.INSTR_DATA[d]['role'],d)
             if r != devices.INSTR_DATA[d]['role']:
                 devices.INSTR_DATA[d]['role'] = r
                 print'Role data corrected to:',r,'->',d
 
         # Get filename of Excel file
-        self.xlfilename = self.SetupPage.XLFile.GetValue()
+        self.xlfilename = config.xlfilename
 
         # open existing workbook
 #        self.wb_io = load_workbook(self.xlfilename) # load_workbook(self.xlfilename, data_only=True)
 #        self.ws = self.wb_io.get_sheet_by_name('Rlink')
         
         # Find existing workbook
-        self.wb_io = self.SetupPage.wb # WEDNESDAY
+        self.wb_io = config.wb # WEDNESDAY
         self.ws = self.wb_io.get_sheet_by_name('Rlink') # WEDNESDAY
 
          # read start row & run parameters from Excel file
@@ -79,10 +86,22 @@ class RLThread(Thread):
         self.AbsV2 = self.ws['D2'].value # 10 # self.ws['D'+str(self.start_row+3)]
         self.MaxV  = max(self.AbsV1,self.AbsV2)
 
-        self.settle_time = self.RunPage.SettleDel.GetValue()
+        self.checkpoint = checkpoint.Checkpoint(self.xlfilename)
+        self.first_rev = 1
+        if resume is not None:
+            self.start_row = resume['start_row'] # B1 may already point to the next data-block
+            self.headrow = self.start_row - 6
+            self.N_reversals = resume['N_reversals']
+            self.run_id = resume['run_id'] # Keep pairing with measurement data
+            self.first_rev = resume['next_rev']
+            print'RLThread: Resuming -',checkpoint.Describe(resume)
+            print >>self.log,'RLThread: Resuming -',checkpoint.Describe(resume)
+            print >>self.log,'RLThread: Unfinished reversal readings:',resume['readings']
 
-        self.R1Name = self.SetupPage.R1Name.GetValue()
-        self.R2Name = self.SetupPage.R2Name.GetValue()
+        self.settle_time = config.settle_time
+
+        self.R1Name = config.R1Name
+        self.R2Name = config.R2Name
 
         # Extract resistor nominal values from names
         R1multiplier = self.Getmultiplier(self.R1Name)
@@ -93,105 +112,95 @@ class RLThread(Thread):
         self.start() # Starts the thread running on creation
 
     def run(self):
+        # Thread entry point: a run that fails part-way still leaves the system safe
+        try:
+            self.Run()
+        except Exception as msg:
+            self.error = msg
+            print'%s.run(): Run failed:'%self.__class__.__name__
+            traceback.print_exc()
+            traceback.print_exc(file=self.log)
+            self.sink.Status('Run failed: %s'%msg, field=0)
+            try:
+                self.AbortRun()
+            except Exception:
+                traceback.print_exc()
+                self.sink.Running(False)
+            self.outcome = 'failed'
+
+    def Run(self):
         # Run Worker Thread. This is where all the important stuff goes.
     
         # Set button availibility
-        self.RunPage.StopBtn.Enable(True)
-        self.RunPage.StartBtn.Enable(False)
-        self.RunPage.RLinkBtn.Enable(False)
+        self.sink.Running(True)
 
-        stat_ev = evts.StatusEvent(msg='RLThread.run():',field = 0)
-        wx.PostEvent(self.TopLevel, stat_ev)
-        stat_ev = evts.StatusEvent(msg='Waiting to settle...',field = 1)
-        wx.PostEvent(self.TopLevel, stat_ev)
+        self.sink.Status('RLThread.run():', field=0)
+        self.sink.Status('Waiting to settle...', field=1)
 
         time.sleep(self.settle_time)
 
-        stat_ev = evts.StatusEvent(msg='', field='b') # write to both status fields
-        wx.PostEvent(self.TopLevel, stat_ev)
+        self.sink.Status('', field='b') # write to both status fields
 
-        # Define headings
-        headrows = range(self.headrow,self.start_row)
-        row_content = [['Run Id:',str(self.RunPage.run_id)],
-                        ['Comment',self.comment],
-                        [str(dt.datetime.today().strftime("%d/%m/%Y %H:%M:%S")),'','Nom. value','|V|'],
-                        ['R1',self.R1Name,self.R1Val,self.AbsV1],
-                        ['R2',self.R2Name,self.R2Val,self.AbsV2]]
-        Delta = u'\N{GREEK CAPITAL LETTER DELTA}'
-        last_head_row = []
-        for c in range(1,6):
-            last_head_row.append(Delta + 'V+')
-            last_head_row.append(Delta + 'V-')
-        row_content.append(last_head_row)
-        
-        headings = dict(zip(headrows,row_content))
-        
-        for r in headings.keys():
-            for c in range(1,len(headings[r])+1):
-                if r == self.headrow + 5: # 'delta_V' row
-                    if (c % 2 == 0): # even columns
-                        col = colors.BLUE
-                    else: # odd columns
-                        col = colors.RED
-                    self.ws.cell(row = r, column = c).font = Font(color = col)
-                if r == self.headrow: # 1st row (Run Id)
-                    self.ws.cell(row = r, column = c).font = Font(b = True)
-                self.ws.cell(row = r, column = c).value = headings[r][c-1]
+        if self.resume is None:
+            self.WriteHeadings()
 
-        revs = 1
+        revs = self.first_rev
 
         # Configuration and initialisation
-        devices.ROLES_INSTR['switchbox'].SendCmd(devices.SWITCH_CONFIGS['V2']) # Is 'V2' right/needed ? # visastuff replaced
-        self.SetupPage.Switchbox.SetValue('V2') # update switchbox configuration icb
-        devices.ROLES_INSTR['DVMd'].SendCmd('FUNC DCV,AUTO') # visastuff replaced
-        dvmOP = devices.ROLES_INSTR['DVMd'].Read() # Pre-read voltage to set appropriate range # visastuff replaced
-        devices.ROLES_INSTR['DVMd'].SendCmd('DCV,'+str(dvmOP)) # 'DCV,'+str(self.AbsV1) # visastuff replaced
-        devices.ROLES_INSTR['DVMd'].SendCmd('LFREQ LINE') # visastuff replaced
-        devices.ROLES_INSTR['SRC1'].SendCmd('R0=') # srcV1  'R0=' # visastuff replaced
+        self.SetSwitchbox('V2') # Is 'V2' right/needed ? # visastuff replaced
+        devices.Call('DVMd','SendCmd','FUNC DCV,AUTO') # visastuff replaced
+        dvmOP = devices.Call('DVMd','Read') # Pre-read voltage to set appropriate range # visastuff replaced
+        devices.Call('DVMd','SendCmd','DCV,'+str(dvmOP)) # 'DCV,'+str(self.AbsV1) # visastuff replaced
+        devices.Call('DVMd','SendCmd','LFREQ LINE') # visastuff replaced
+        devices.Call('SRC1','SendCmd','R0=') # srcV1  'R0=' # visastuff replaced
         time.sleep(3) # WEDNESDAY
 
-        self.V1set = self.AbsV1
-        self.V2set = self.AbsV2*-1
+        polarity = (-1)**(revs-1) # Polarities reverse every reversal
+        self.V1set = self.AbsV1*polarity
+        self.V2set = self.AbsV2*-1*polarity
         self.Vdiff = self.V1set - self.V2set
+        self.Checkpoint(revs, 'start')
 
         while revs <= self.N_reversals: # column index
             if self._want_abort:
                 self.AbortRun()
                 return
             del self.RLink_data[:]
+            rev_t0 = time.time()
+            bustrace.Mark('reversal %d'%revs)
             
             # Apply source voltages
-            self.RunPage.V1Setting.SetValue(str(self.V1set)) # Voltage displays control sources
+            self.SetSrcV('SRC1',self.V1set) # Sources set via instrument executor
             time.sleep(5) # WEDNESDAY
-            self.RunPage.V2Setting.SetValue(str(self.V2set))
+            self.SetSrcV('SRC2',self.V2set)
             time.sleep(60) # WEDNESDAY
             row = 1 # self.start_row + 1
 
             # Only store 10 readings per line, and then clear
             col_letter = get_column_letter(revs)
-            d = devices.ROLES_WIDGETS['DVMd']['icb'].GetValue() # visastuff replaced
+            d = self.config.roles['DVMd'] # visastuff replaced
             while row <= self.N_readings: # row index
                 if devices.INSTR_DATA[d]['demo'] == True: # visastuff replaced
                     dvmOP = np.random.normal(self.Vdiff*1.0e-6,abs(self.Vdiff*1.0e-8))
                     self.RLink_data.append(dvmOP)
                 else:
 #                    print 'RLink.py, run(): %s demo mode:%i'%(d,devices.INSTR_DATA[d]['demo']) # visastuff replaced
-                    devices.ROLES_INSTR['DVMd'].SendCmd('LFREQ LINE') # visastuff replaced
+                    devices.Call('DVMd','SendCmd','LFREQ LINE') # visastuff replaced
                     time.sleep(1)
-                    devices.ROLES_INSTR['DVMd'].SendCmd('AZERO ONCE') # visastuff replaced
+                    devices.Call('DVMd','SendCmd','AZERO ONCE') # visastuff replaced
                     time.sleep(1) # was 10
-                    dvmOP = devices.ROLES_INSTR['DVMd'].Read() # visastuff replaced
+                    dvmOP = devices.Call('DVMd','Read') # visastuff replaced
                     self.RLink_data.append(float(filter(self.filt,dvmOP)))
                 P = 100*((revs-1)*self.N_readings+row)/(self.N_reversals*self.N_readings) # % progress
-                update_ev = evts.DataEvent(t=0, Vm=self.RLink_data[row-1], Vsd=0, P=P,
-                                           r=col_letter+str(row), flag='-')
-                wx.PostEvent(self.RunPage, update_ev)
+                self.sink.Data(t=0, Vm=self.RLink_data[row-1], Vsd=0, P=P,
+                               r=col_letter+str(row), flag='-')
                 if revs % 2 == 0: # even columns
                     col = colors.BLUE
                 else: # odd columns
                     col = colors.RED
                 self.ws.cell(row = self.start_row+row-1, column = revs).font = Font(color = col)
                 self.ws.cell(row = self.start_row+row-1, column = revs).value = self.RLink_data[row-1]
+                self.Checkpoint(revs, 'reading')
                 row += 1
             # (end of readings loop)
                 
@@ -206,6 +215,13 @@ class RLThread(Thread):
 
             # Reset start row, for next data-block (accounting for gap + 6-line header)
             self.ws['B1'] = self.start_row + self.N_readings + 7
+
+            # Save after every reversal
+            with metrics.Timed('hrbc_workbook_save_seconds',run='rlink'):
+                self.wb_io.save(self.xlfilename)
+            self.Checkpoint(revs, 'reversal') # Reversal complete
+            metrics.Inc('hrbc_reversals_total')
+            metrics.Observe('hrbc_reversal_seconds',time.time()-rev_t0)
         # (end of reversals loop)
         self.FinishRun()
         return
@@ -213,46 +229,89 @@ class RLThread(Thread):
     def AbortRun(self):
         # prematurely end run
         self.Standby() # Set sources to 0V and leave system safe
+        self.outcome = 'aborted'
 
-        stat_ev = evts.StatusEvent(msg='AbortRun(): Run stopped', field=0)
-        wx.PostEvent(self.TopLevel, stat_ev)
+        self.sink.Status('AbortRun(): Run stopped', field=0)
 
-        stop_ev = evts.DataEvent(t='-', Vm='-', Vsd='-', P=0, r='-',flag='E') # End
-        wx.PostEvent(self.RunPage, stop_ev)
-
-        self.RunPage.RLinkBtn.Enable(True)
-        self.RunPage.StartBtn.Enable(True)
-        self.RunPage.StopBtn.Enable(False)
+        self.sink.Data(t='-', Vm='-', Vsd='-', P=0, r='-',flag='E') # End
+        self.sink.Running(False)
 
 
     def FinishRun(self):
         #save data in xl file
-        self.wb_io.save(self.xlfilename)
+        with metrics.Timed('hrbc_workbook_save_seconds',run='rlink'):
+            self.wb_io.save(self.xlfilename)
 
         self.Standby() # Set sources to 0V and leave system safe
+        self.outcome = 'finished'
+        self.checkpoint.Remove() # Nothing to resume
 
-        stop_ev = evts.DataEvent(t='-', Vm='-', Vsd='-', P=0, r='-', flag='F') # Finished
-        wx.PostEvent(self.RunPage, stop_ev)
-        stat_ev = evts.StatusEvent(msg='RLINK RUN COMPLETED', field=0)
-        wx.PostEvent(self.TopLevel, stat_ev)
-        stat_ev = evts.StatusEvent(msg='', field=1)
-        wx.PostEvent(self.TopLevel, stat_ev)
-
-        self.RunPage.RLinkBtn.Enable(True)
-        self.RunPage.StartBtn.Enable(True)
-        self.RunPage.StopBtn.Enable(False)
+        self.sink.Data(t='-', Vm='-', Vsd='-', P=0, r='-', flag='F') # Finished
+        self.sink.Status('RLINK RUN COMPLETED', field=0)
+        self.sink.Status('', field=1)
+        self.sink.Running(False)
         
         
     def Standby(self):
-        self.RunPage.V1Setting.SetValue('0')
-        self.RunPage.V2Setting.SetValue('0')
+        self.SetSrcV('SRC1',0)
+        self.SetSrcV('SRC2',0)
+
+
+    def WriteHeadings(self):
+        # Define headings
+        headrows = range(self.headrow,self.start_row)
+        row_content = [['Run Id:',str(self.run_id)],
+                        ['Comment',self.comment],
+                        [str(dt.datetime.today().strftime("%d/%m/%Y %H:%M:%S")),'','Nom. value','|V|'],
+                        ['R1',self.R1Name,self.R1Val,self.AbsV1],
+                        ['R2',self.R2Name,self.R2Val,self.AbsV2]]
+        Delta = u'\N{GREEK CAPITAL LETTER DELTA}'
+        last_head_row = []
+        for c in range(1,6):
+            last_head_row.append(Delta + 'V+')
+            last_head_row.append(Delta + 'V-')
+        row_content.append(last_head_row)
+        
+        headings = dict(zip(headrows,row_content))
+        
+        for r in headings.keys():
+            for c in range(1,len(headings[r])+1):
+                if r == self.headrow + 5: # 'delta_V' row
+                    if (c % 2 == 0): # even columns
+                        col = colors.BLUE
+                    else: # odd columns
+                        col = colors.RED
+                    self.ws.cell(row = r, column = c).font = Font(color = col)
+                if r == self.headrow: # 1st row (Run Id)
+                    self.ws.cell(row = r, column = c).font = Font(b = True)
+                self.ws.cell(row = r, column = c).value = headings[r][c-1]
+
+    def SetSwitchbox(self,conf):
+        # Set switchbox via the instrument executor, then report it (SetupPage display)
+        devices.Call('switchbox','SendCmd',devices.SWITCH_CONFIGS[conf])
+        self.sb_conf = conf
+        self.sink.Switchbox(conf) # update switchbox configuration icb
+
+    def Checkpoint(self,next_rev,phase):
+        # Record progress - next_rev is the first reversal not yet completed
+        src_V = {'SRC1':self.V1set,'SRC2':self.V2set}
+        state = {'kind':'rlink','run_id':self.run_id,'xlfile':self.xlfilename,
+                 'start_row':self.start_row,'N_reversals':self.N_reversals,
+                 'next_rev':next_rev,'phase':phase,
+                 'instruments':checkpoint.InstrSnapshot(self.config.roles,src_V,self.sb_conf),
+                 'readings':self.RLink_data}
+        self.checkpoint.Save(state)
+
+    def SetSrcV(self,role,V):
+        # Set source voltage via the instrument executor, then report it (RunPage display)
+        devices.SetSrcV(role,V)
+        self.sink.SrcV(role,V)
 
 
     def abort(self):
         """abort worker thread."""
         # Method for use by main thread to signal an abort
-        stat_ev = evts.StatusEvent(msg='abort(): Run aborted', field=0)
-        wx.PostEvent(self.TopLevel, stat_ev)
+        self.sink.Status('abort(): Run aborted', field=0)
         self._want_abort = 1
 
     def Getmultiplier(self,name):
@@ -7,15 +7,23 @@ Created on Fri Sep 18 09:40:33 2015
 @author: t.lawson
 """
 import string
+import hashlib
 import datetime as dt
 import time
 import math
 import xlrd
+from openpyxl import cell
 from openpyxl.styles import Font,colors,PatternFill,Border,Side
+from openpyxl.utils import get_column_letter
 import GTC
 from numbers import Number
 
+import incremental
+
 RL_SEARCH_LIMIT = 500
+RD_KIND = '.rd' # Stored Rd files (see StoredRd())
+RD_NAMES = ('Rd','nom_R1','nom_R2','abs_V1','abs_V2')
+N_ROLES = 10 # 10 roles in total
 
 INF = 1e6 # 'inf' dof
 ZERO = GTC.ureal(0,0)
@@ -77,6 +85,245 @@ def GetRLstartrow(sheet,Id,jump,log):
     return -1
 
 
+# Get instrument assignments {role:description} (written next to the run's 1st rows)
+def GetRoles(sheet,start_row):
+    role_descr = {}
+    for row in range(start_row, start_row + N_ROLES):
+        # Read {role:description}
+        temp_dict = {sheet['AC'+str(row)].value : sheet['AD'+str(row)].value}
+        assert temp_dict.keys()[-1] is not None,'Instrument assignment: Missing role!'
+        assert temp_dict.values()[-1] is not None,'Instrument assignment: Missing description!'
+        role_descr.update(temp_dict)
+    return role_descr
+
+
+# Calculate link resistance Rd from this run's block of Rlink data
+"""
+Returns (Rd,nom_R1,nom_R2,abs_V1,abs_V2).
+Assume all 'nominal' values have 100 ppm std.uncert. with 8 dof.
+"""
+# Find a run's block of Rlink data: (1st header row, reversals, readings)
+def RlinkBlock(ws_Rlink,Run_Id,log):
+    # 1st, detetermine data format
+    N_revs = ws_Rlink['B2'].value # Number of reversals = number of columns
+    assert N_revs is not None and N_revs > 0,'Missing or no reversals!'
+    N_reads = ws_Rlink['B3'].value # Number of readings = number of rows
+    assert N_reads is not None and N_reads > 0,'Missing or no reads!'
+    head_height = 6 # Rows of header before each block of data
+    jump = head_height + N_reads # rows to jump between starts of each header
+
+    # Find correct RLink data-header
+    RL_start_row = GetRLstartrow(ws_Rlink,Run_Id,jump,log)
+    assert RL_start_row > 1,'Unable to find matching Rlink data!'
+    return (RL_start_row,N_revs,N_reads)
+
+
+def GetRd(ws_Rlink,Run_Id,log):
+    RL_start_row,N_revs,N_reads = RlinkBlock(ws_Rlink,Run_Id,log)
+
+    # Next, define nom_R,abs_V quantities
+    val1 = ws_Rlink['C'+str(RL_start_row+2)].value
+    assert val1 is not None,'Missing nominal R1 value!'
+    nom_R1 = GTC.ureal(val1,val1/1e4,8,label='nom_R1') # don't know uncertainty of nominal values
+    val2 = ws_Rlink['C'+str(RL_start_row+3)].value
+    assert val2 is not None,'Missing nominal R2 value!'
+    nom_R2 = GTC.ureal(val2,val2/1e4,8,label='nom_R2') # don't know uncertainty of nominal values
+    val1 =ws_Rlink['D'+str(RL_start_row+2)].value
+    assert val1 is not None,'Missing nominal V1 value!'
+    abs_V1 = GTC.ureal(val1,val1/1e4,8,label='abs_V1') # don't know uncertainty of nominal values
+    val2 = ws_Rlink['D'+str(RL_start_row+3)].value
+    assert val2 is not None,'Missing nominal V2 value!'
+    abs_V2 = GTC.ureal(val2,val2/1e4,8,label='abs_V2') # don't know uncertainty of nominal values
+
+    # Calculate I
+    I=(abs_V1+abs_V2)/(nom_R1+nom_R2)
+    I.label = 'Rd_I' + Run_Id
+
+    # Average all +Vs and -Vs
+    Vp = []
+    Vn = []
+
+    for Vrow in range(RL_start_row+5,RL_start_row+5+N_reads):
+
+        col = 1
+        while col <= N_revs: # cycle through cols 1 to N_revs
+            Vp.append(ws_Rlink[get_column_letter(col)+str(Vrow)].value)
+            assert Vp[-1] is not None,'Missing Vp value!'
+            col +=1
+
+            Vn.append(ws_Rlink[get_column_letter(col)+str(Vrow)].value)
+            assert Vn[-1] is not None,'Missing Vn value!'
+            col +=1
+
+    av_dV_p = GTC.ta.estimate(Vp)
+    av_dV_p.label='av_dV_p' + Run_Id
+    av_dV_n = GTC.ta.estimate(Vn)
+    av_dV_n.label='av_dV_n' + Run_Id
+    av_dV = 0.5*GTC.magnitude(av_dV_p - av_dV_n)
+    av_dV.label = 'Rd_dV' + Run_Id
+
+    # Finally, calculate Rd
+    Rd = GTC.ar.result(av_dV/I,label = 'Rlink ' + Run_Id)
+    assert Rd.x < 0.01,'High link resistance!'
+    #assert Rd.x > Rd.u,'Link resistance uncertainty > value!' # (TEMPORARY RELAXATION OF TEST!)
+    log.write('\nRlink = ' + str(GTC.summary(Rd)))
+    return (Rd,nom_R1,nom_R2,abs_V1,abs_V2)
+
+
+# As GetRd(), but Rd is only calculated once per run: after that it's
+# restored (with its correlations) from the workbook's sidecar store (see
+# incremental.py). A stored Rd is used as long as the run's Rlink block
+# (header and readings) hasn't moved or changed.
+def StoredRd(xlfile,ws_Rlink,Run_Id,log):
+    RL_start_row,N_revs,N_reads = RlinkBlock(ws_Rlink,Run_Id,log)
+    h = hashlib.md5(repr((RL_start_row,N_revs,N_reads)))
+    for r in ws_Rlink.iter_rows(min_row=RL_start_row-1,max_row=RL_start_row+4+N_reads,max_col=max(2*N_revs,4)):
+        h.update(repr([c.value for c in r]))
+    key = h.hexdigest()
+    stored = incremental.Load(xlfile,Run_Id,RD_KIND)
+    if stored is not None and stored['key'] == key:
+        log.write('\nRlink (stored) = ' + str(GTC.summary(stored['Rd'])))
+        return tuple([stored[k] for k in RD_NAMES])
+    Rd_data = GetRd(ws_Rlink,Run_Id,log)
+    incremental.Save(xlfile,Run_Id,dict(zip(RD_NAMES,Rd_data),key=key),RD_KIND)
+    return Rd_data
+
+
+# Select R2 info based on applied voltage ('LV' or 'HV')
+def SelectR2(info,V2set):
+    Vdif_LV = abs(abs(V2set)-info['VRef_LV'])
+    Vdif_HV = abs(abs(V2set)-info['VRef_HV'])
+    if Vdif_LV > Vdif_HV:
+        return (info['R0_HV'],info['TRef_HV'],info['VRef_HV'])
+    else: # LV (or equally close to both)
+        return (info['R0_LV'],info['TRef_LV'],info['VRef_LV'])
+
+
+# Voltage-ratio code (parameter name of DVM12's ratio correction) for V1, V2 settings
+def VRatioCode(V1set,V2set):
+    if round(V1set) == round(V2set):
+        v_ratio_code = 'VRC_eq'
+    elif abs(round(V1set)) == 1 and abs(round(V2set,1)) == 0.1:
+        v_ratio_code = 'VRC_1to0.1'
+    elif abs(round(V1set)) == 5 and abs(round(V2set,1)) == 0.5:
+        v_ratio_code = 'VRC_5to0.5'
+    elif abs(round(V1set)) == 10 and abs(round(V2set)) == 1:
+        v_ratio_code = 'VRC_10to1'
+    elif abs(round(V1set)) == 100 and abs(round(V2set)) == 10:
+        v_ratio_code = 'VRC_100to10'
+    else:
+        v_ratio_code = None
+    assert v_ratio_code is not None,'Unable to determine voltage ratio ({0}/{1})!'.format(int(round(V1set)),int(round(V2set)))
+    return v_ratio_code
+
+
+# Extract resistor and instrument parameters from the Parameters sheet
+def ReadParams(ws_Params,log):
+    print 'Reading parameters...'
+    log.write('Reading parameters...')
+    headings = (u'Resistor Info:', u'Instrument Info:',
+                u'description', u'parameter', u'value',
+                u'uncert', u'dof', u'label', u'Comment / Reference')
+
+     # Determine colummn indices from column letters:
+    col_A = cell.cell.column_index_from_string('A') - 1
+    col_B = cell.cell.column_index_from_string('B') - 1
+    col_C = cell.cell.column_index_from_string('C') - 1
+    col_D = cell.cell.column_index_from_string('D') - 1
+    col_E = cell.cell.column_index_from_string('E') - 1
+    col_F = cell.cell.column_index_from_string('F') - 1
+    col_G = cell.cell.column_index_from_string('G') - 1
+
+    col_I = cell.cell.column_index_from_string('I') - 1
+    col_J = cell.cell.column_index_from_string('J') - 1
+    col_K = cell.cell.column_index_from_string('K') - 1
+    col_L = cell.cell.column_index_from_string('L') - 1
+    col_M = cell.cell.column_index_from_string('M') - 1
+    col_N = cell.cell.column_index_from_string('N') - 1
+    col_O = cell.cell.column_index_from_string('O') - 1
+
+    R_params = []
+    R_row_items = []
+    I_params = []
+    I_row_items = []
+    R_values = []
+    I_values = []
+    R_DESCR = []
+    I_DESCR = []
+    R_sublist = []
+    I_sublist = []
+
+    for r in ws_Params.rows: # a tuple of row objects
+        R_end = 0
+
+        # description, parameter, value, uncert, dof, label:
+        R_row_items = [r[col_A].value, r[col_B].value, r[col_C].value, r[col_D].value,
+                       r[col_E].value, r[col_F].value, r[col_G].value]
+
+        I_row_items = [r[col_I].value, r[col_J].value, r[col_K].value, r[col_L].value,
+                       r[col_M].value, r[col_N].value, r[col_O].value]
+
+        if R_row_items[0] == None: # end of R_list
+            R_end = 1
+
+        # check this row for heading text
+        if any(i in I_row_items for i in headings):
+            continue # Skip headings
+
+        else: # not header - main data
+            # Get instrument parameters first...
+            last_I_row = r[col_I].row
+            I_params.append(I_row_items[1])
+            I_values.append(Uncertainize(I_row_items))
+            if I_row_items[1] == u'test': # last parameter for this description
+                I_DESCR.append(I_row_items[0]) # build description list
+                I_sublist.append(dict(zip(I_params,I_values))) # add parameter dictionary to sublist
+                del I_params[:]
+                del I_values[:]
+
+            # Now attend to resistor parameters...
+            if R_end == 0: # Check we're not at the end of resistor data-block
+                last_R_row = r[col_A].row # Need to know this if we write more data, post-analysis
+                R_params.append(R_row_items[1])
+                R_values.append(Uncertainize(R_row_items))
+                if R_row_items[1] == u'T_sensor': # last parameter for this description
+                    R_DESCR.append(R_row_items[0]) # build description list
+                    R_sublist.append(dict(zip(R_params,R_values))) # add parameter dictionary to sublist
+                    del R_params[:]
+                    del R_values[:]
+
+    # Compile into dictionaries
+    """
+    There are two dictionaries; one for instruments (I_INFO) and one for resistors (R_INFO).
+    each dictionary item is keyed by the description (name) of the instrument (resistor).
+    Each dictionary value is itself a dictionary, keyed by parameter, such as 'address'
+    (for an instrument) or 'R_LV' (for a resistor value, measured at 'low voltage').
+
+    """
+    I_INFO = dict(zip(I_DESCR,I_sublist))
+    print len(I_INFO),'instruments (%d rows)'%last_I_row
+    log.write('\n'+str(len(I_INFO))+' instruments ('+str(last_I_row)+') rows')
+
+    R_INFO = dict(zip(R_DESCR,R_sublist))
+    print len(R_INFO),'resistors.(%d rows)\n'%last_R_row
+    log.write('\n'+str(len(R_INFO))+' resistors ('+str(last_R_row)+') rows')
+    return (I_INFO,R_INFO,last_I_row,last_R_row)
+
+
+# Fingerprint of the Parameters sheet (to tell if it has changed) - or of
+# just the rows of the resistors and instruments in names (and their T-sensors)
+def ParamsHash(ws_Params,names=None):
+    rows = [[c.value for c in r] for r in ws_Params.iter_rows(max_col=15)]
+    if names is not None:
+        names = set(names)
+        names.update([r[2] for r in rows if r[0] in names and r[1] == 'T_sensor'])
+        rows = [r[:7] for r in rows if r[0] in names] + [r[8:] for r in rows if r[8] in names]
+    h = hashlib.md5()
+    for r in rows:
+        h.update(repr(r))
+    return h.hexdigest()
+
+
 # Convert list of data to ureal, where possible
 def Uncertainize(row_items):
     v = row_items[2]
@@ -196,6 +443,42 @@ def WriteThisResult(sheet,row,result):
     sheet['H'+str(row)] = result['R_expU']
   
   
+# Write Monte Carlo result (mc: mean,u,low,high,trials,p) below measurement summary
+def WriteMCResult(sheet,row,mc):
+    sheet['A'+str(row+1)] = 'MC ('+str(mc['trials'])+' trials)'
+    sheet['E'+str(row+1)] = mc['mean']
+    sheet['F'+str(row+1)] = mc['u']
+    sheet['A'+str(row+2)] = str(int(round(100*mc['p'])))+'% interval'
+    sheet['E'+str(row+2)] = mc['low']
+    sheet['F'+str(row+2)] = mc['high']
+
+
+# Write joint R1(T,V,t) fit (see glsfit.py): values, std uncerts and correlations
+def WriteJointFit(sheet,row,fit):
+    u = [math.sqrt(c) for c in fit['cov'].diagonal()]
+    sheet['R'+str(row)] = 'Joint fit R1(T,V,t)'
+    sheet['V'+str(row)] = 'chi2'
+    sheet['W'+str(row)] = fit['chi2']
+    sheet['X'+str(row)] = 'dof'
+    sheet['Y'+str(row)] = fit['dof']
+    row += 1
+    for col,heading in zip(('R','S','T','U','V','W','X'),
+                           ('R0','alpha (/C)','gamma (/V)','drift (/yr)','at T','at V','at date/time')):
+        sheet[col+str(row)] = heading
+    sheet['Q'+str(row+1)] = 'value'
+    sheet['Q'+str(row+2)] = 'std u'
+    for i,col in enumerate(('R','S','T','U')):
+        sheet[col+str(row+1)] = fit['x'][i]
+        sheet[col+str(row+2)] = u[i]
+        for j in range(4): # Correlation matrix
+            sheet[col+str(row+3+j)] = fit['cov'][i,j]/(u[i]*u[j]) if u[i]*u[j] > 0 else 0
+    sheet['V'+str(row+1)] = fit['T']
+    sheet['W'+str(row+1)] = fit['V']
+    sheet['X'+str(row+1)] = dt.datetime.fromtimestamp(fit['time_fl']).strftime('%d/%m/%Y %H:%M:%S')
+    sheet['Q'+str(row+3)] = 'correlation'
+    return row+6
+
+
 # Sorting helper function - sort by uncert. contribution
 def by_u_cont(line):
     return line[5]    
@@ -314,6 +597,18 @@ def update_R_Info(name,params,data,sheet,row,Id,v):
     
     return row
 
+
+# Re-write the R1 parameters that run Id added to the Parameters sheet.
+# Returns False if there aren't any.
+def RewriteR_Info(name,params,data,sheet,Id,v):
+    label = name.split()[0] + '_'+ params[0] + '_' + Id
+    for r in sheet.iter_rows(max_col=6):
+        if r[0].value == name and r[1].value == params[0] and r[5].value == label:
+            update_R_Info(name,params,data,sheet,r[0].row-1,Id,v)
+            return True
+    return False
+
+
 def GetDigi(readings):
     """
     Return maximum digitization level of a set of data.
@@ -14,11 +14,31 @@ Contains definitions for usual __init__() and run() methods
  AND an abort() method. The Run() method forms the core of the
  procedure - any changes to the way the measurements are taken
  should be made here, and within included subroutines.
+
+Rows are pipelined: as soon as a row's measurements are complete they're
+handed (as a RowData dictionary) to a RowWriter thread, which writes them
+to the spreadsheet, saves the workbook, plots them and updates the
+checkpoint, while the instruments get on with the next row.
+
+The order of the V1, V2 and Vd phases in each row is chosen by seqplan.py
+(RunConfig.sequence) to avoid needless DVM12 range changes.
+
+Optionally (RunConfig.sem_ppm, sem_Vd) each V1, V2 or Vd phase stops as
+soon as the standard error of its mean reaches a target, rather than always
+taking n readings (column C, now the maximum). The number of readings
+actually taken is recorded in columns J, K, L (V1, V2, Vd).
+
+A live ETA (estimator.Eta) is reported after every row, and a timing
+budget (where the time went) is logged when the run ends.
+
+As each 4-row block is written, R1 is estimated from the run so far
+(liveanalysis.py) and reported through the sink.
 """
-import wx
-from threading import Thread
+from threading import Thread,Lock
+import Queue
 import datetime as dt
 import time
+import traceback
 #import os.path
 #os.environ['XLPATH'] = 'C:\Documents and Settings\\t.lawson\My Documents\Python Scripts\High_Res_Bridge'
 
@@ -27,21 +47,39 @@ import numpy as np
 #from openpyxl import load_workbook # WEDNESDAY
 from openpyxl.styles import Font,Border,Side
 
-import HighRes_events as evts
 import devices # visastuff
+import checkpoint
+import onlinestats
+import seqplan
+import estimator
+import bustrace
+import metrics
+import liveanalysis
 #import devices as GMH
 
 class AqnThread(Thread):
     """Acquisition Thread Class."""
-    def __init__(self, parent):
+    def __init__(self, config, sink, resume=None):
         # This runs when an instance of the class is created
+        # config: a runconfig.RunConfig, sink: a progress.ProgressSink (or TeeSink)
+        # resume: checkpoint state of an unfinished run to continue (see checkpoint.py), or None
         Thread.__init__(self)
-        self.RunPage = parent
-        self.SetupPage = self.RunPage.GetParent().GetPage(0)
-        self.PlotPage = self.RunPage.GetParent().GetPage(2)
-        self.TopLevel = self.RunPage.GetTopLevelParent()
-        self.Comment = self.RunPage.Comment.GetValue()
+        self.config = config
+        self.sink = sink
+        self.resume = resume
+        self.run_id = config.run_id
+        self.sb_conf = None # Last switchbox setting
+        self.dvm12_range = None # Last DVM12 range set (None: unknown)
+        self.budget = estimator.Budget()
+        self.eta = None
+        self.predicted = None # Predicted run duration (s)
+        self.V1_set = self.V2_set = 0
+        self.ws_lock = Lock() # Workbook access - shared with RowWriter
+        self.data_lock = Lock() # Reading lists - added to here, copied by Checkpoint() (also from RowWriter)
+        self.Comment = config.comment
         self._want_abort = 0
+        self.outcome = None # 'finished', 'aborted' or 'failed' when the thread ends
+        self.error = None # Exception that ended a failed run
         
         self.V1Data = []
         self.V2Data = []
@@ -49,16 +87,19 @@ class AqnThread(Thread):
         self.V1Times = []
         self.V2Times = []
         self.VdTimes = []
+        self.stats = {'V1':onlinestats.RunningStats(),
+                      'V2':onlinestats.RunningStats(),
+                      'Vd':onlinestats.RunningStats()}
         
-        self.log = self.SetupPage.log
+        self.log = config.log
 
         print'Role -> Instrument:'
         print >>self.log,'Role -> Instrument:'
         print'------------------------------'
         print >>self.log,'------------------------------'
         # Print all GPIB instrument objects
-        for r in devices.ROLES_WIDGETS.keys():
-            d = devices.ROLES_WIDGETS[r]['icb'].GetValue()
+        for r in config.roles.keys():
+            d = config.roles[r]
             # For 'switchbox' role, d is actually the setting (V1, Vd1,...) not the instrument description.
             
             print'%s -> %s'%(devices.INSTR_DATA[d]['role'],d)
@@ -69,7 +110,7 @@ class AqnThread(Thread):
                 print >>self.log,'Role data corrected to:',r,'->',d
 
         # Get filename of Excel file
-        self.xlfilename = self.SetupPage.XLFile.GetValue() # Full path
+        self.xlfilename = config.xlfilename # Full path
         self.path_components = self.xlfilename.split('\\') # List of all the bits between '\'s
         self.directory = '\\'.join(self.path_components[0:-1])
 
@@ -78,18 +119,27 @@ class AqnThread(Thread):
 #        self.ws = self.wb_io.get_sheet_by_name('Data')
 
         # Find existing workbook
-        self.wb_io = self.SetupPage.wb # WEDNESDAY
+        self.wb_io = config.wb # WEDNESDAY
         self.ws = self.wb_io.get_sheet_by_name('Data') # WEDNESDAY
 
         # read start/stop row numbers from Excel file
         self.start_row = self.ws['B1'].value
         self.stop_row = self.ws['B2'].value
-        strt_ev = evts.StartRowEvent(row = self.start_row)
-        wx.PostEvent(self.RunPage,strt_ev)
-        stp_ev = evts.StopRowEvent(row = self.stop_row)
-        wx.PostEvent(self.RunPage,stp_ev)
-
-        self.settle_time = self.RunPage.SettleDel.GetValue()
+        self.sink.Rows(self.start_row, self.stop_row)
+
+        self.checkpoint = checkpoint.Checkpoint(self.xlfilename)
+        self.first_row = self.start_row
+        self.writer = None
+        self.live = None # liveanalysis.LiveAnalysis, once the roles are recorded
+        if resume is not None:
+            assert (resume['start_row'],resume['stop_row']) == (self.start_row,self.stop_row),'Checkpoint rows do not match B1, B2!'
+            self.run_id = resume['run_id'] # Keep pairing with RLink data
+            self.first_row = resume['next_row']
+            print'AqnThread: Resuming -',checkpoint.Describe(resume)
+            print >>self.log,'AqnThread: Resuming -',checkpoint.Describe(resume)
+            print >>self.log,'AqnThread: Unfinished row readings:',resume['readings']
+
+        self.settle_time = config.settle_time
 
         # Local record of GMH ports and addresses
 #        self.GMH1Demo_status = devices.INSTR_DATA[self.SetupPage.GMH1Probes.GetValue()]['demo'] # replaced visastuff
@@ -107,24 +157,222 @@ class AqnThread(Thread):
         self.start() # Starts the thread running on creation
 
     def run(self):
+        # Thread entry point: a run that fails part-way still leaves the system safe
+        try:
+            self.Run()
+        except Exception as msg:
+            self.error = msg
+            print'%s.run(): Run failed:'%self.__class__.__name__
+            traceback.print_exc()
+            traceback.print_exc(file=self.log)
+            self.sink.Status('Run failed: %s'%msg, field=0)
+            try:
+                self.AbortRun()
+            except Exception:
+                traceback.print_exc()
+                self.sink.Running(False)
+            self.outcome = 'failed'
+
+    def Run(self):
         # Run Worker Thread. This is where all the important stuff goes, in a repeated cycle
         
         # Set button availability
-        self.RunPage.StopBtn.Enable(True)
-        self.RunPage.StartBtn.Enable(False)
-        self.RunPage.RLinkBtn.Enable(False)
+        self.sink.Running(True)
+        self.budget.Start()
         
         # Clear plots
-        clr_plot_ev = evts.ClearPlotEvent()
-        wx.PostEvent(self.PlotPage, clr_plot_ev)
+        self.sink.ClearPlot()
+
+        if self.resume is None:
+            self.WriteHeadings()
+        self.next_row = self.first_row # First row not yet saved
+        self.Checkpoint(self.next_row, 'start')
+
+        self.sink.Status('AqnThread.run():', field=0)
+        self.sink.Status('Waiting to settle...', field=1)
+
+        self.Sleep(self.settle_time,'settle')
+
+        # Initialise all instruments (doesn't open GMH sensors yet)
+        self.initialise()
+        self.dvm12_range = None # Unknown after Init
+
+        self.sink.Status('', field='b') # write to both status fields
+
+        self.sink.Status('Post-initialise delay...', field=1)
+        self.Sleep(3,'initialise') # 3
+
+        if self.resume is None:
+            # Get some initial temperatures...
+            self.ws['U'+str(self.start_row-1)] = devices.Call('GMH1','Measure','T') # self.TR1
+            self.ws['V'+str(self.start_row-1)] = devices.Call('GMH2','Measure','T') # self.TR2
+
+        self.WriteRoles()
+        self.PlanSequence()
+        with self.ws_lock:
+            self.live = liveanalysis.LiveAnalysis(self.wb_io,self.xlfilename,self.run_id,self.start_row,
+                                                  self.Comment,self.sink,self.log)
+
+        row = self.first_row
+        pbar = 1 + self.first_row - self.start_row
+        self.writer = RowWriter(self)
+
+        # loop over xl rows..
+        while row <= self.stop_row:
+            row_t0 = time.time()
+            bustrace.Mark('row %d'%row)
+            if self._want_abort:
+                self.AbortRun()
+                return
+            if self.writer.error is not None:
+                raise self.writer.error # Couldn't save the previous row
+            #self.role_list['DVM12'].SendCmd('DCV,100') # dvmV1V2:'DCV100'-REDUNDANT?
+
+            if self._want_abort:
+                self.AbortRun()
+                return
+            self.sink.Status('AqnThread.run():', field=0)
+
+            self.sink.Status('Short delay 1...', field=1)
+            self.Sleep(seqplan.SHORT_DEL_1,'row overhead') # WEDNESDAY
+
+            if not self.SetUpMeasThisRow(row):
+                self.AbortRun()
+                return
+
+            self.sink.Row(row)
 
+            # V1, V2, Vd - in the planned order
+            for node in self.plan.Order(row-self.start_row):
+                if not self.MeasureNode(node,row,pbar):
+                    self.AbortRun()
+                    return
+
+            # Record room conditions
+            t0 = time.time()
+            if devices.ROLES_INSTR['GMHroom'].demo == False:
+                self.Troom = devices.Call('GMHroom','Measure','T')
+                self.Proom = devices.Call('GMHroom','Measure','P')
+                self.RHroom = devices.Call('GMHroom','Measure','RH')
+            else:
+                self.Troom = self.Proom = self.RHroom = 0.0
+            
+            self.T1dvm = self.ReadDvmT('DVMT1')
+            self.T2dvm = self.ReadDvmT('DVMT2')
+            self.budget.Add('temperatures',time.time()-t0)
+
+            # Hand the row over for writing, saving and plotting - carry on measuring
+            self.writer.Put(self.RowData(row))
+            row_time = time.time()-row_t0
+            self.eta.RowDone(row_time)
+            metrics.Inc('hrbc_rows_total')
+            metrics.Observe('hrbc_row_seconds',row_time)
+            metrics.Set('hrbc_rows_per_hour',3600.0*self.eta.done/self.eta.meas_done)
+            self.sink.Eta(self.eta.Finish(),self.eta.Remaining())
+            pbar += 1
+            row += 1
+
+        # (end of while loop):
+        self.FinishRun()
+        return
+
+    def PlanSequence(self):
+        # Choose phase order for the remaining rows
+        with self.ws_lock:
+            rows = seqplan.ReadRows(self.ws,self.first_row,self.stop_row)
+        offset = self.first_row - self.start_row
+        plan,results = seqplan.Choose(rows,self.config.auto_range,offset)
+        for p,sim,asym in results:
+            print >>self.log,'AqnThread.PlanSequence(): %-11s settle %6.0f s, %3d range changes, asymmetry %5.1f s'%(p.name,sim['settle'],sim['range_changes'],asym)
+        if self.config.sequence != 'auto':
+            plan = seqplan.Find(self.config.sequence)
+        self.plan = plan
+        print'AqnThread.PlanSequence(): Measurement sequence',plan.name
+        print >>self.log,'AqnThread.PlanSequence(): Measurement sequence',plan.name
+
+        # Predicted time for the remaining rows - initial ETA
+        est = estimator.Estimate(rows,self.config.auto_range,plan,offset=offset)
+        self.eta = estimator.Eta(est['rows'])
+        self.predicted = time.time() - self.budget.start + sum(est['rows'])
+        self.sink.Eta(self.eta.Finish(),self.eta.Remaining())
+
+    def MeasureNode(self,node,row,pbar):
+        # Switch to, settle and measure one phase (V1, V2 or Vd). Returns False if aborted.
+        if node == 'Vd':
+            # Set RS232 to Vd1
+            self.SetSwitchbox('Vd1') # replaced visastuff
+            devices.Call('DVMd','SendCmd','RANGE AUTO') # dvmVd:'RANGE AUTO' # replaced visastuff
+            if self._want_abort:
+                return False
+        else:
+            rng = seqplan.DVMRange(node,{'V1':self.V1_set,'V2':self.V2_set},self.config.auto_range)
+            if rng != self.dvm12_range:
+                # Change DVM12 range. Going down, set RS232 BEFORE changing DVM range
+                if self.dvm12_range is not None and rng < self.dvm12_range:
+                    self.SetSwitchbox(node) # replaced visastuff
+                if node == 'V1':
+                    devices.Call('DVM12','SendCmd','DCV,'+str(int(self.V1_set))) # dvmV1V2:'DCV'+str(self.V1_set) # replaced visastuff
+                elif self.config.auto_range == True:
+                    devices.Call('DVM12','SendCmd','DCV,'+str(self.V2_set)) # Reset DVM range # replaced visastuff
+                else:
+                    # Running with fixed range: set range to 'str(self.V1_set)'
+                    devices.Call('DVM12','SendCmd','DCV,'+str(self.V1_set)) # replaced visastuff
+                self.dvm12_range = rng
+                self.Sleep(seqplan.RANGE_SET_DEL,'range change') # was 0.1
+                devices.Call('DVM12','SendCmd','LFREQ LINE') # dvmV1V2:'LFREQ LINE' # replaced visastuff
+                if self._want_abort:
+                    return False
+                self.sink.Status('AqnThread.run():', field=0)
+                self.sink.Status('Short delay 2...', field=1)
+                self.Sleep(seqplan.SHORT_DEL_2,'range change') # 3
+            # Set RS232 to V1 or V2 (if not already)
+            if self.sb_conf != node:
+                self.SetSwitchbox(node) # replaced visastuff
+            devices.Call('DVM12','SendCmd','AZERO ON') # dvmV1V2: 'AZERO ON' # replaced visastuff
+            if self._want_abort:
+                return False
+
+        self.sink.Status('Range delay...', field=1)
+        self.Sleep(self.range_del,'range del.')
+
+        self.sink.Status('Measuring '+node, field=1)
+        t0 = time.time()
+        if node == 'Vd':
+            devices.Call('DVMd','SendCmd','LFREQ LINE') # dvmVd   'LFREQ LINE' # replaced visastuff
+            devices.Call('DVMd','Read') # dummy read # replaced visastuff
+        else:
+            devices.Call('DVM12','Read') # dvmV1V2 (why these 2 unused reads?) # replaced visastuff
+            devices.Call('DVM12','Read')# dvmV1V2 # replaced visastuff
+        self.MeasurePhase(node)
+        self.budget.Add(node+' readings',time.time()-t0)
+        t0 = time.time()
+        if node == 'V1':
+            self.T1 = devices.Call('GMH1','Measure','T')
+        elif node == 'V2':
+            self.T2 = devices.Call('GMH2','Measure','T')
+        self.budget.Add('temperatures',time.time()-t0)
+        self.Checkpoint(self.next_row, node)
+
+        # Update run displays on Run page via a DataEvent:
+        Times = {'V1':self.V1Times,'V2':self.V2Times,'Vd':self.VdTimes}[node]
+        t = dt.datetime.fromtimestamp(np.mean(Times)).strftime("%d/%m/%Y %H:%M:%S")
+        Vm = self.stats[node].Mean()
+        print 'AqnThread.run(): %sm ='%node,Vm
+        print >>self.log,'AqnThread.run(): %sm ='%node,Vm
+        assert len(Times)>1,"Can't take SD of one or less items!"
+        Vsd = self.stats[node].SD()
+        P = 100.0*pbar/(1 + self.stop_row - self.start_row) # % progress
+        self.sink.Data(t=t, Vm=Vm, Vsd=Vsd, P=P, r=row, flag={'V1':'1','V2':'2','Vd':'d'}[node])
+        return True
+
+    def WriteHeadings(self):
         # Column headings
         Head_row = self.start_row-2 # Main headings
         sub_row = self.start_row-1 # Sub-headings
         # Write unique id for this run - used to pair measurement data with RLink data
         self.ws['A'+str(sub_row)] = 'Run Id:'
         self.ws['B'+str(sub_row)].font = Font(b=True)
-        self.ws['B'+str(sub_row)] = str(self.RunPage.run_id)
+        self.ws['B'+str(sub_row)] = str(self.run_id)
         self.ws['A'+str(Head_row)] = 'V1_set'
         self.ws['B'+str(Head_row)] = 'V2_set'
         self.ws['C'+str(Head_row)] = 'n'
@@ -135,7 +383,10 @@ class AqnThread(Thread):
         self.ws['G'+str(sub_row)] = 't'
         self.ws['H'+str(sub_row)] = 'V'
         self.ws['I'+str(sub_row)] = 'sd(V)'
-        # miss columns j,k,l
+        self.ws['J'+str(Head_row)] = 'n taken'
+        self.ws['J'+str(sub_row)] = 'V1'
+        self.ws['K'+str(sub_row)] = 'V2'
+        self.ws['L'+str(sub_row)] = 'Vd'
         self.ws['M'+str(Head_row)] = 'Vd1'
         self.ws['M'+str(sub_row)] = 't'
         self.ws['N'+str(sub_row)] = 'V'
@@ -156,28 +407,7 @@ class AqnThread(Thread):
         self.ws['AC'+str(Head_row)] = 'Role'
         self.ws['AD'+str(Head_row)] = 'Instrument descr.'
 
-
-        stat_ev = evts.StatusEvent(msg='AqnThread.run():',field = 0)
-        wx.PostEvent(self.TopLevel, stat_ev)
-        stat_ev = evts.StatusEvent(msg='Waiting to settle...',field = 1)
-        wx.PostEvent(self.TopLevel, stat_ev)
-
-        time.sleep(self.settle_time)
-
-        # Initialise all instruments (doesn't open GMH sensors yet)
-        self.initialise()
-
-        stat_ev = evts.StatusEvent(msg='', field='b') # write to both status fields
-        wx.PostEvent(self.TopLevel, stat_ev)
-
-        stat_ev = evts.StatusEvent(msg='Post-initialise delay...', field=1)
-        wx.PostEvent(self.TopLevel, stat_ev)
-        time.sleep(3) # 3
-
-        # Get some initial temperatures...      
-        self.ws['U'+str(self.start_row-1)] = devices.ROLES_INSTR['GMH1'].Measure('T') # self.TR1
-        self.ws['V'+str(self.start_row-1)] = devices.ROLES_INSTR['GMH2'].Measure('T') # self.TR2
-
+    def WriteRoles(self):
         # Record ALL POSSIBLE roles and corresponding instrument descriptions in XL sheet
         role_row = self.start_row
         bord_tl = Border(top = Side(style='thin'), left = Side(style='thin'))
@@ -186,7 +416,7 @@ class AqnThread(Thread):
         bord_r = Border(right = Side(style='thin'))
         bord_bl = Border(bottom = Side(style='thin'), left = Side(style='thin'))
         bord_br = Border(bottom = Side(style='thin'), right = Side(style='thin'))
-        for r in devices.ROLES_WIDGETS.keys():
+        for r in self.config.roles.keys():
             if role_row == self.start_row: # 1st row
                 self.ws['AC'+str(role_row)].border = bord_tl
                 self.ws['AD'+str(role_row)].border = bord_tr
@@ -197,362 +427,222 @@ class AqnThread(Thread):
                 self.ws['AC'+str(role_row)].border = bord_l
                 self.ws['AD'+str(role_row)].border = bord_r
             self.ws['AC'+str(role_row)] = r
-            d = devices.ROLES_WIDGETS[r]['icb'].GetValue() # descr # replaced visastuff
+            d = self.config.roles[r] # descr # replaced visastuff
             self.ws['AD'+str(role_row)] = d
             role_row += 1
 
-        row = self.start_row
-        pbar = 1
-
-        # loop over xl rows..
-        while row <= self.stop_row:
-            if self._want_abort:
-                self.AbortRun()
-                return
-            #self.role_list['DVM12'].SendCmd('DCV,100') # dvmV1V2:'DCV100'-REDUNDANT?
-
-            if self._want_abort:
-                self.AbortRun()
-                return
-            stat_ev = evts.StatusEvent(msg='AqnThread.run():', field=0)
-            wx.PostEvent(self.TopLevel, stat_ev)
-
-            stat_ev = evts.StatusEvent(msg='Short delay 1...', field=1)
-            wx.PostEvent(self.TopLevel, stat_ev)
-            time.sleep(5) # WEDNESDAY
-
-            self.SetUpMeasThisRow(row)
-
-            row_ev = evts.RowEvent(r = row)
-            wx.PostEvent(self.RunPage, row_ev)
-
-            #  V1...
-            devices.ROLES_INSTR['DVM12'].SendCmd('LFREQ LINE') # dvmV1V2:'LFREQ LINE' # replaced visastuff
-            time.sleep(0.5)
-            devices.ROLES_INSTR['DVM12'].SendCmd('DCV,'+str(int(self.V1_set))) # dvmV1V2:'DCV'+str(self.V1_set) # replaced visastuff
-            if self._want_abort:
-                self.AbortRun()
-                return
-
-            stat_ev = evts.StatusEvent(msg='AqnThread.run():', field=0)
-            wx.PostEvent(self.TopLevel, stat_ev)
-            stat_ev = evts.StatusEvent(msg='Short delay 2...', field=1)
-            wx.PostEvent(self.TopLevel, stat_ev)
-            time.sleep(3) # 3
-
-            # Set RS232 to V1
-            devices.ROLES_INSTR['switchbox'].SendCmd(devices.SWITCH_CONFIGS['V1']) # replaced visastuff
-            self.SetupPage.Switchbox.SetValue('V1') # update switchbox configuration icb
-            devices.ROLES_INSTR['DVM12'].SendCmd('AZERO ON') # dvmV1V2: 'AZERO ON' # replaced visastuff
-            if  self._want_abort:
-                self.AbortRun()
-                return
-
-            stat_ev = evts.StatusEvent(msg='Range delay...', field=1)
-            wx.PostEvent(self.TopLevel, stat_ev)
-            time.sleep(self.range_del)
-
-            stat_ev = evts.StatusEvent(msg='Measuring V1', field=1)
-            wx.PostEvent(self.TopLevel, stat_ev)
-            devices.ROLES_INSTR['DVM12'].Read()# junk = ...dvmV1V2 # replaced visastuff
-            devices.ROLES_INSTR['DVM12'].Read()# junk = ...dvmV1V2 # replaced visastuff
-            for i in range(self.n_readings):
-                self.MeasureV('V1')
-            self.T1 = devices.ROLES_INSTR['GMH1'].Measure('T')
-            
-            # Update run displays on Run page via a DataEvent:
-            t1 = dt.datetime.fromtimestamp(np.mean(self.V1Times)).strftime("%d/%m/%Y %H:%M:%S")
-            V1m = np.mean(self.V1Data)
-            print 'AqnThread.run(): V1m =',V1m
-            print >>self.log,'AqnThread.run(): V1m =',V1m
-            assert len(self.V1Data)>1,"Can't take SD of one or less items!"
-            V1sd = np.std(self.V1Data,ddof=1)
-            P = 100.0*pbar/(1 + self.stop_row - self.start_row) # % progress
-            update_ev = evts.DataEvent(t=t1, Vm=V1m, Vsd=V1sd, P=P, r=row, flag='1')
-            wx.PostEvent(self.RunPage,update_ev)
-
-            #  V2...
-            # Set RS232 to V2 BEFORE changing DVM range
-            devices.ROLES_INSTR['switchbox'].SendCmd(devices.SWITCH_CONFIGS['V2']) # replaced visastuff
-            self.SetupPage.Switchbox.SetValue('V2') # update switchbox configuration icb
-            
-            # If running with fixed range set range to 'str(self.V1_set)':
-            if self.RunPage.RangeTBtn.GetValue() == True:
-                range2 = self.V2_set
-            else:
-                range2 = self.V1_set
-            devices.ROLES_INSTR['DVM12'].SendCmd('DCV,'+str(range2)) # Reset DVM range # replaced visastuff
-            if self._want_abort:
-                self.AbortRun()
-                return
-            time.sleep(0.5) # was 0.1
-            devices.ROLES_INSTR['DVM12'].SendCmd('LFREQ LINE') # dvmV1V2:'LFREQ LINE' # replaced visastuff
-            
-            stat_ev = evts.StatusEvent(msg='AqnThread.run():', field=0)
-            wx.PostEvent(self.TopLevel, stat_ev)
-            stat_ev = evts.StatusEvent(msg='Short delay 3...', field=1)
-            wx.PostEvent(self.TopLevel, stat_ev)
-            if self._want_abort:
-                self.AbortRun()
-                return
-            time.sleep(3) # 3
-
-            stat_ev = evts.StatusEvent(msg='Range delay...', field=1)
-            wx.PostEvent(self.TopLevel, stat_ev)
-            if self._want_abort:
-                self.AbortRun()
-                return
-            time.sleep(self.range_del)
-
-            stat_ev = evts.StatusEvent(msg='Measuring V2', field=1)
-            wx.PostEvent(self.TopLevel, stat_ev)
-
-            devices.ROLES_INSTR['DVM12'].Read() # dvmV1V2 (why these 2 unused reads?) # replaced visastuff
-            devices.ROLES_INSTR['DVM12'].Read()# dvmV1V2 # replaced visastuff
-            for i in range(self.n_readings):
-                self.MeasureV('V2')
-            self.T2 = devices.ROLES_INSTR['GMH2'].Measure('T')
-
-            # Update displays on Run page via a DataEvent:
-            t2 = dt.datetime.fromtimestamp(np.mean(self.V2Times)).strftime("%d/%m/%Y %H:%M:%S")
-            V2m = np.mean(self.V2Data)
-            print 'AqnThread.run(): V2m =',V2m
-            print >>self.log,'AqnThread.run(): V2m =',V2m
-            assert len(self.V2Data)>1,"Can't take SD of one or less items!"
-            V2sd = np.std(self.V2Data,ddof=1)
-            P = 100.0*pbar/(1 + self.stop_row - self.start_row) # % progress
-            update_ev = evts.DataEvent(t=t2, Vm=V2m, Vsd=V2sd, P=P, r=row, flag='2')
-            wx.PostEvent(self.RunPage, update_ev)
-
-            #  Vd...
-            # Set RS232 to Vd1
-            devices.ROLES_INSTR['switchbox'].SendCmd(devices.SWITCH_CONFIGS['Vd1']) # replaced visastuff
-            self.SetupPage.Switchbox.SetValue('Vd1') # update switchbox configuration icb
-            devices.ROLES_INSTR['DVMd'].SendCmd('RANGE AUTO') # dvmVd:'RANGE AUTO' # replaced visastuff
-            if self._want_abort:
-                self.AbortRun()
-                return
-            stat_ev = evts.StatusEvent(msg='Range delay...', field=1)
-            wx.PostEvent(self.TopLevel, stat_ev)
-            time.sleep(self.range_del)
-
-            stat_ev = evts.StatusEvent(msg='Measuring Vd', field=1)
-            wx.PostEvent(self.TopLevel, stat_ev)
-            devices.ROLES_INSTR['DVMd'].SendCmd('LFREQ LINE') # dvmVd   'LFREQ LINE' # replaced visastuff
-            devices.ROLES_INSTR['DVMd'].Read() # dummy read # replaced visastuff
-            for i in range(self.n_readings):
-                self.MeasureV('Vd')
-            # Update displays on Run page via a DataEvent:
-            td = dt.datetime.fromtimestamp(np.mean(self.VdTimes)).strftime("%d/%m/%Y %H:%M:%S")
-            Vdm = np.mean(self.VdData)
-            print 'AqnThread.run(): Vdm =',Vdm
-            print >>self.log,'AqnThread.run(): Vdm =',Vdm
-            assert len(self.VdData)>1,"Can't take SD of one or less items!"
-            Vdsd = np.std(self.VdData,ddof=1)
-            P = 100.0*pbar/(1 + self.stop_row - self.start_row) # % progress
-            update_ev = evts.DataEvent(t=td, Vm=Vdm, Vsd=Vdsd, P=P, r=row, flag='d')
-            wx.PostEvent(self.RunPage, update_ev)
-
-            # Record room conditions
-            if devices.ROLES_INSTR['GMHroom'].demo == False:
-                self.Troom = devices.ROLES_INSTR['GMHroom'].Measure('T')
-                self.Proom = devices.ROLES_INSTR['GMHroom'].Measure('P')
-                self.RHroom = devices.ROLES_INSTR['GMHroom'].Measure('RH')
-            else:
-                self.Troom = self.Proom = self.RHroom = 0.0
-            
-            self.WriteDataThisRow(row)
-
-            # Plot data
-            VdDates = []
-            V1Dates = []
-            V2Dates = []
-            for d in self.VdTimes:
-                VdDates.append(dt.datetime.fromtimestamp(d))
-            for d in self.V1Times:
-                V1Dates.append(dt.datetime.fromtimestamp(d))
-            for d in self.V2Times:
-                V2Dates.append(dt.datetime.fromtimestamp(d))
-            clear_plot = 0
-            if row == self.start_row:
-                clear_plot = 1 # start each run with a clear plot 
-            plot_ev = evts.PlotEvent(td=VdDates, t1=V1Dates, t2=V2Dates,
-                                     Vd=self.VdData, V1=self.V1Data, V2=self.V2Data, clear=clear_plot)
-            wx.PostEvent(self.PlotPage, plot_ev)
-#            print'acquisition.run(): V1Data:',self.V1Data
-            pbar += 1
-            row += 1
-
-        # (end of while loop):
-        self.FinishRun()
-        return
-
     def initialise(self):
         # This is a Dascon (%RH) PLACEHOLDER for now - replace with some actual code...
         # Set Dascon Outlets 1,3 to 'On' and initialise (room T & RH)
 
-        stat_ev = evts.StatusEvent(msg='Initialising instruments...', field=0)
-        wx.PostEvent(self.TopLevel, stat_ev)
+        self.sink.Status('Initialising instruments...', field=0)
 
         for r in devices.ROLES_INSTR.keys():
-            d = devices.ROLES_WIDGETS[r]['icb'].GetValue()
+            d = self.config.roles[r]
 #            if not devices.ROLES_INSTR[r].is_open and 'GMH' not in devices.ROLES_INSTR[r].Descr:
             # Open non-GMH devices:
             if 'GMH' not in devices.ROLES_INSTR[r].Descr:
                 print'AqnThread.initialise(): Opening',d
                 print >>self.log,'AqnThread.initialise(): Opening',d
-                devices.ROLES_INSTR[r].Open()
+                devices.Call(r,'Open')
             else:
                 print'AqnThread.initialise(): %s already open'%d
                 print >>self.log,'AqnThread.initialise(): %s already open'%d
             
-            stat_ev = evts.StatusEvent(msg=d, field=1)
-            wx.PostEvent(self.TopLevel, stat_ev)
-            devices.ROLES_INSTR[r].Init()
-            time.sleep(1)
-        stat_ev = evts.StatusEvent(msg='Done', field=0)
-        wx.PostEvent(self.TopLevel, stat_ev)
+            self.sink.Status(d, field=1)
+            devices.Call(r,'Init')
+            self.Sleep(1,'initialise')
+        self.sink.Status('Done', field=0)
 
 
     def SetUpMeasThisRow(self,row):
+        # Set sources and delays for this row. Returns False if aborted.
         d = devices.ROLES_INSTR['SRC2'].Descr # replaced visastuff
         if d.endswith('F5520A'):
-            err = devices.ROLES_INSTR['SRC2'].CheckErr() # srcV2  'ERR?', '*CLS' # replaced visastuff
+            err = devices.Call('SRC2','CheckErr') # srcV2  'ERR?', '*CLS' # replaced visastuff
             print 'Cleared F5520A error:',err
             print >>self.log,'Cleared F5520A error:',err
-        time.sleep(3) # Wait 3 s after checking error
-        # Get V1,V2 setting, n, delays from spreadsheet
-        self.V1_set = self.ws.cell(row=row,column=1).value
-        self.RunPage.V1Setting.SetValue(str(self.V1_set))
+        self.Sleep(seqplan.ERR_CHECK_DEL,'row overhead') # Wait 3 s after checking error
+        # Get V1,V2 setting, n, delays from spreadsheet (RowWriter may be saving)
+        with self.ws_lock:
+            V1_set,V2_set,n,start_del,AZ1_del,range_del = [self.ws.cell(row=row,column=c).value for c in range(1,7)]
+        self.V1_set = V1_set
+        self.SetSrcV('SRC1',self.V1_set)
         if self._want_abort:
-                self.AbortRun()
-                return
-        time.sleep(5) # wait 5 s after setting voltage
-        self.V2_set = self.ws.cell(row=row,column=2).value
-        self.RunPage.V2Setting.SetValue(str(self.V2_set))
-        self.start_del = self.ws.cell(row=row,column=4).value
+            return False
+        self.Sleep(seqplan.SRC_DEL,'row overhead') # wait 5 s after setting voltage
+        self.V2_set = V2_set
+        self.SetSrcV('SRC2',self.V2_set)
+        self.start_del = start_del
         if self._want_abort:
-                self.AbortRun()
-                return
-        time.sleep(self.start_del)
-        self.n_readings = self.ws.cell(row=row,column=3).value
-        self.AZ1_del = self.ws.cell(row=row,column=5).value
-        self.range_del = self.ws.cell(row=row,column=6).value
-        del_ev = evts.DelaysEvent(n = self.n_readings,
-                                  s = self.start_del,
-                                  AZ1 = self.AZ1_del,
-                                  r = self.range_del)
-        wx.PostEvent(self.RunPage, del_ev)
-
-        del self.V1Data[:]
-        del self.V2Data[:]
-        del self.VdData[:]
-        del self.V1Times[:]
-        del self.V2Times[:]
-        del self.VdTimes[:]
-
+            return False
+        self.Sleep(self.start_del,'start del.')
+        self.n_readings = n
+        self.AZ1_del = AZ1_del
+        self.range_del = range_del
+        self.sink.Delays(n = self.n_readings,
+                         s = self.start_del,
+                         AZ1 = self.AZ1_del,
+                         r = self.range_del)
+
+        with self.data_lock:
+            del self.V1Data[:]
+            del self.V2Data[:]
+            del self.VdData[:]
+            del self.V1Times[:]
+            del self.V2Times[:]
+            del self.VdTimes[:]
+        for node in self.stats.keys():
+            self.stats[node].Clear()
+        return True
+
+
+    def MeasurePhase(self,node):
+        # Take up to n readings - fewer if the target SEM (if any) is reached first
+        target = self.TargetSEM(node)
+        stats = self.stats[node]
+        while stats.n < self.n_readings:
+            self.MeasureV(node)
+            if target is not None and stats.n >= self.config.min_readings and stats.SEM() <= target:
+                print'AqnThread.MeasurePhase(): %s target SEM reached after %d readings'%(node,stats.n)
+                print >>self.log,'AqnThread.MeasurePhase(): %s target SEM reached after %d readings'%(node,stats.n)
+                break
+        return stats.n
+
+    def TargetSEM(self,node):
+        # Target standard error of the mean (V) for this phase, or None (always take n readings)
+        if node == 'Vd':
+            return self.config.sem_Vd
+        elif self.config.sem_ppm is None:
+            return None
+        elif node == 'V1':
+            return 1e-6*self.config.sem_ppm*abs(self.V1_set)
+        else:
+            return 1e-6*self.config.sem_ppm*abs(self.V2_set)
 
     def MeasureV(self,node):
         assert node in ('V1','V2','Vd'),'Unknown argument to MeasureV().'
         if node == 'V1':
-            self.V1Times.append(time.time())
+            t = time.time()
             if devices.ROLES_INSTR['DVM12'].demo == True:
-                dvmOP = np.random.normal(self.V1_set,1.0e-5*abs(self.V1_set))
-                self.V1Data.append(dvmOP)
+                V = np.random.normal(self.V1_set,1.0e-5*abs(self.V1_set))
             else:
                 # lfreq line, azero once,range auto, wait for settle
-                dvmOP = devices.ROLES_INSTR['DVM12'].Read()# dvmV1V2
-                self.V1Data.append(float(filter(self.filt,dvmOP)))
+                dvmOP = devices.Call('DVM12','Read')# dvmV1V2
+                V = float(filter(self.filt,dvmOP))
+            self.AddReading(self.V1Times,t,self.V1Data,V)
+            self.stats['V1'].Add(V)
         elif node == 'V2':
-            self.V2Times.append(time.time())
+            t = time.time()
             if devices.ROLES_INSTR['DVM12'].demo == True:
-                dvmOP = np.random.normal(self.V2_set,1.0e-5*abs(self.V2_set))
-                self.V2Data.append(dvmOP)
+                V = np.random.normal(self.V2_set,1.0e-5*abs(self.V2_set))
             else:
-                dvmOP = devices.ROLES_INSTR['DVM12'].Read() # dvmV1V2
-                self.V2Data.append(float(filter(self.filt,dvmOP)))
+                dvmOP = devices.Call('DVM12','Read') # dvmV1V2
+                V = float(filter(self.filt,dvmOP))
+            self.AddReading(self.V2Times,t,self.V2Data,V)
+            self.stats['V2'].Add(V)
         elif node == 'Vd':
-            self.VdTimes.append(time.time())
+            t = time.time()
             if self.AZ1_del > 0:
-                devices.ROLES_INSTR['DVMd'].SendCmd('AZERO ONCE') # dvmVd: AZERO ONCE
+                devices.Call('DVMd','SendCmd','AZERO ONCE') # dvmVd: AZERO ONCE
                 time.sleep(self.AZ1_del)
             if devices.ROLES_INSTR['DVMd'].demo == True:
-                dvmOP = np.random.normal(0.0,1.0e-6)
-                self.VdData.append(dvmOP)
+                V = np.random.normal(0.0,1.0e-6)
             else:
-                dvmOP = devices.ROLES_INSTR['DVMd'].Read() # dvmVd
-                self.VdData.append(float(filter(self.filt,dvmOP)))
+                dvmOP = devices.Call('DVMd','Read') # dvmVd
+                V = float(filter(self.filt,dvmOP))
+            self.AddReading(self.VdTimes,t,self.VdData,V)
+            self.stats['Vd'].Add(V)
             return 1
 
+    def AddReading(self,times,t,data,V):
+        # Time and reading together, so a checkpoint never has one without the other
+        with self.data_lock:
+            times.append(t)
+            data.append(V)
 
-    def WriteDataThisRow(self,row):
-        stat_ev = evts.StatusEvent(msg='AqnThread.WriteDataThisRow():', field=0)
-        wx.PostEvent(self.TopLevel, stat_ev)
-        stat_ev = evts.StatusEvent(msg='Row '+str(row), field=1)
-        wx.PostEvent(self.TopLevel, stat_ev)
-
-        self.ws['P'+str(row)] = str(dt.datetime.fromtimestamp(np.mean(self.V1Times)).strftime("%d/%m/%Y %H:%M:%S"))
-        print >>self.log,'WriteDataThisRow(): cell','P'+str(row),':',str(dt.datetime.fromtimestamp(np.mean(self.V1Times)).strftime("%d/%m/%Y %H:%M:%S"))
-        self.ws['Q'+str(row)] = np.mean(self.V1Data)
-        print >>self.log,'WriteDataThisRow(): cell','Q'+str(row),':',np.mean(self.V1Data)
-        self.ws['R'+str(row)] = np.std(self.V1Data,ddof=1)
-        print >>self.log,'WriteDataThisRow(): cell','R'+str(row),np.std(self.V1Data,ddof=1)
-        self.ws['G'+str(row)] = str(dt.datetime.fromtimestamp(np.mean(self.V2Times)).strftime("%d/%m/%Y %H:%M:%S"))
-        print >>self.log,'WriteDataThisRow(): cell','G'+str(row),':',str(dt.datetime.fromtimestamp(np.mean(self.V2Times)).strftime("%d/%m/%Y %H:%M:%S"))
-        self.ws['H'+str(row)] = np.mean(self.V2Data)
-        print >>self.log,'WriteDataThisRow(): cell','H'+str(row),':',np.mean(self.V2Data)
-        self.ws['I'+str(row)] = np.std(self.V2Data,ddof=1)
-        print >>self.log,'WriteDataThisRow(): cell','I'+str(row),':',np.std(self.V2Data,ddof=1)
-        self.ws['M'+str(row)] = str(dt.datetime.fromtimestamp(np.mean(self.VdTimes)).strftime("%d/%m/%Y %H:%M:%S"))
-        print >>self.log,'WriteDataThisRow(): cell','M'+str(row),':',str(dt.datetime.fromtimestamp(np.mean(self.VdTimes)).strftime("%d/%m/%Y %H:%M:%S"))
-        self.ws['N'+str(row)] = np.mean(self.VdData)
-        print >>self.log,'WriteDataThisRow(): cell','N'+str(row),':',np.mean(self.VdData)
-        self.ws['O'+str(row)] = np.std(self.VdData,ddof=1)
-        print >>self.log,'WriteDataThisRow(): cell','O'+str(row),':',np.std(self.VdData,ddof=1)
-
-        if devices.ROLES_INSTR['DVMT1'].demo == True:
-            T1dvmOP = np.random.normal(108.0,1.0e-2)
-            self.ws['S'+str(row)] = T1dvmOP
-            print >>self.log,'WriteDataThisRow(): cell','S'+str(row),':',T1dvmOP
-        else:
-            T1dvmOP = devices.ROLES_INSTR['DVMT1'].SendCmd('READ?')
-            self.ws['S'+str(row)] = float(filter(self.filt,T1dvmOP))
-            print >>self.log,'WriteDataThisRow(): cell','S'+str(row),':',float(filter(self.filt,T1dvmOP))
-
-        if devices.ROLES_INSTR['DVMT2'].demo == True:
-            T2dvmOP = np.random.normal(108.0,1.0e-2)
-            self.ws['T'+str(row)] = T2dvmOP
-            print >>self.log,'WriteDataThisRow(): cell','T'+str(row),':',T2dvmOP
+
+    def ReadDvmT(self,role):
+        # PRT resistance, read from a DVM (DVMT1 or DVMT2)
+        if devices.ROLES_INSTR[role].demo == True:
+            return np.random.normal(108.0,1.0e-2)
         else:
-            T2dvmOP = devices.ROLES_INSTR['DVMT2'].SendCmd('READ?')
-            self.ws['T'+str(row)] = float(filter(self.filt,T2dvmOP))
-            print >>self.log,'WriteDataThisRow(): cell','T'+str(row),':',float(filter(self.filt,T2dvmOP))
-
-        self.ws['U'+str(row)] = self.T1
-        print >>self.log,'WriteDataThisRow(): cell','U'+str(row),':',self.T1
-        self.ws['V'+str(row)] = self.T2
-        print >>self.log,'WriteDataThisRow(): cell','V'+str(row),':',self.T2
-        self.ws['W'+str(row)] = self.Troom
-        print >>self.log,'WriteDataThisRow(): cell','W'+str(row),':',self.Troom
-        self.ws['X'+str(row)] = self.Proom
-        print >>self.log,'WriteDataThisRow(): cell','X'+str(row),':',self.Proom
-        self.ws['Y'+str(row)] = self.RHroom
-        print >>self.log,'WriteDataThisRow(): cell','Y'+str(row),':',self.RHroom
-        self.ws['Z'+str(row)] = self.Comment
-        print >>self.log,'WriteDataThisRow(): cell','Z'+str(row),':',self.Comment
-
-        # Save after every row
-        self.wb_io.save(self.xlfilename)
+            dvmOP = devices.Call(role,'SendCmd','READ?')
+            return float(filter(self.filt,dvmOP))
+
+    def RowData(self,row):
+        # Snapshot of one completed row - the measurement lists are re-used for the next row
+        return {'row':row,
+                'V1':list(self.V1Data),'V1_t':list(self.V1Times),
+                'V2':list(self.V2Data),'V2_t':list(self.V2Times),
+                'Vd':list(self.VdData),'Vd_t':list(self.VdTimes),
+                'T1':self.T1,'T2':self.T2,'T1dvm':self.T1dvm,'T2dvm':self.T2dvm,
+                'Troom':self.Troom,'Proom':self.Proom,'RHroom':self.RHroom,
+                'stats':dict([(node,(st.n,st.Mean(),st.SD())) for node,st in self.stats.items()])}
+
+    def WriteDataThisRow(self,rd):
+        # Called by RowWriter
+        row = rd['row']
+        tV1 = dt.datetime.fromtimestamp(np.mean(rd['V1_t']))
+        tV2 = dt.datetime.fromtimestamp(np.mean(rd['V2_t']))
+        tVd = dt.datetime.fromtimestamp(np.mean(rd['Vd_t']))
+        n1,V1m,V1sd = rd['stats']['V1']
+        n2,V2m,V2sd = rd['stats']['V2']
+        nd,Vdm,Vdsd = rd['stats']['Vd']
+        cells = [('P',tV1.strftime("%d/%m/%Y %H:%M:%S")),
+                 ('Q',V1m),
+                 ('R',V1sd),
+                 ('G',tV2.strftime("%d/%m/%Y %H:%M:%S")),
+                 ('H',V2m),
+                 ('I',V2sd),
+                 ('J',n1), # Readings actually taken
+                 ('K',n2),
+                 ('L',nd),
+                 ('M',tVd.strftime("%d/%m/%Y %H:%M:%S")),
+                 ('N',Vdm),
+                 ('O',Vdsd),
+                 ('S',rd['T1dvm']),
+                 ('T',rd['T2dvm']),
+                 ('U',rd['T1']),
+                 ('V',rd['T2']),
+                 ('W',rd['Troom']),
+                 ('X',rd['Proom']),
+                 ('Y',rd['RHroom']),
+                 ('Z',self.Comment)]
+
+        with self.ws_lock:
+            for col,value in cells:
+                self.ws[col+str(row)] = value
+            # Save after every row
+            with metrics.Timed('hrbc_workbook_save_seconds',run='run'):
+                self.wb_io.save(self.xlfilename)
+        for col,value in cells:
+            print >>self.log,'WriteDataThisRow(): cell',col+str(row),':',value
+
+    def PlotRow(self,rd):
+        # Called by RowWriter
+        self.sink.Plot(td=[dt.datetime.fromtimestamp(d) for d in rd['Vd_t']],
+                       t1=[dt.datetime.fromtimestamp(d) for d in rd['V1_t']],
+                       t2=[dt.datetime.fromtimestamp(d) for d in rd['V2_t']],
+                       Vd=rd['Vd'], V1=rd['V1'], V2=rd['V2'],
+                       clear=int(rd['row'] == self.start_row), # start each run with a clear plot
+                       tT=dt.datetime.fromtimestamp(np.mean(rd['Vd_t'])),
+                       T1=rd['T1'], T2=rd['T2']) # temperatures for the HistoryPage
+
+    def AnalyseRow(self,rd):
+        # Called by RowWriter - R1 so far, if this row completes a block
+        if self.live is not None:
+            with self.ws_lock:
+                self.live.Row(rd['row'])
 
     def AbortRun(self):
         # prematurely end run, prompted by regular checks of _want_abort flag
         self.Standby() # Set sources to 0V and leave system safe
+        self.FlushRows() # Keep completed rows
+        self.ReportBudget()
+        self.outcome = 'aborted'
 
-#        stat_ev = evts.StatusEvent(msg='AbortRun(): Run stopped', field=0)
-#        wx.PostEvent(self.TopLevel, stat_ev)
-
-        stop_ev = evts.DataEvent(t='-', Vm='-', Vsd='-', P=0, r='-',flag='E') # End
-        wx.PostEvent(self.RunPage, stop_ev)
+        self.sink.Data(t='-', Vm='-', Vsd='-', P=0, r='-',flag='E') # End
         
 #        for r in devices.ROLES_INSTR.keys():
 #            d = devices.ROLES_INSTR[r].Descr
@@ -564,25 +654,25 @@ class AqnThread(Thread):
 #                print'AqnThread.AbortRun(): %s already closed'%d
 #                print>>self.log,'AqnThread.AbortRun(): %s already closed'%d
 
-        self.RunPage.StartBtn.Enable(True)
-        self.RunPage.RLinkBtn.Enable(True)
-        self.RunPage.StopBtn.Enable(False)
+        self.sink.Running(False)
 
     def FinishRun(self):
         # Run complete - leave system safe and final xl save
-        self.wb_io.save(self.xlfilename)
+        self.FlushRows()
+        if self.writer.error is not None:
+            raise self.writer.error # Last row(s) not saved - keep the checkpoint
+        with self.ws_lock:
+            with metrics.Timed('hrbc_workbook_save_seconds',run='run'):
+                self.wb_io.save(self.xlfilename)
 
         self.Standby() # Set sources to 0V and leave system safe
+        self.outcome = 'finished'
+        self.checkpoint.Remove() # Nothing to resume
+        self.ReportBudget()
 
-#        stat_ev = evts.StatusEvent(msg='Closing instruments...', field=0)
-#        wx.PostEvent(self.TopLevel, stat_ev)
-
-        stop_ev = evts.DataEvent(t='-', Vm='-', Vsd='-', P=0, r='-', flag='F') # Finished
-        wx.PostEvent(self.RunPage, stop_ev)
-        stat_ev = evts.StatusEvent(msg='RUN COMPLETED', field=0)
-        wx.PostEvent(self.TopLevel, stat_ev)
-        stat_ev = evts.StatusEvent(msg='', field=1)
-        wx.PostEvent(self.TopLevel, stat_ev)
+        self.sink.Data(t='-', Vm='-', Vsd='-', P=0, r='-', flag='F') # Finished
+        self.sink.Status('RUN COMPLETED', field=0)
+        self.sink.Status('', field=1)
         
 #        for r in devices.ROLES_INSTR.keys():
 #            d = devices.ROLES_INSTR[r].Descr
@@ -592,21 +682,60 @@ class AqnThread(Thread):
 #            else:
 #                print'AqnThread.FinishRun(): %s already closed'%d
 
-        self.RunPage.StartBtn.Enable(True)
-        self.RunPage.RLinkBtn.Enable(True)
-        self.RunPage.StopBtn.Enable(False)
+        self.sink.Running(False)
+
+    def FlushRows(self):
+        # Wait for the RowWriter to finish with all completed rows
+        if self.writer is not None:
+            self.writer.Finish()
 
     def Standby(self):
         # Set sources to 0V and disable outputs
-        devices.ROLES_INSTR['SRC1'].SendCmd('R0=') # srcV1  'R0='
-        self.RunPage.V1Setting.SetValue(str(0))
-        self.RunPage.V2Setting.SetValue(str(0))
+        devices.Call('SRC1','SendCmd','R0=') # srcV1  'R0='
+        self.SetSrcV('SRC1',0)
+        self.SetSrcV('SRC2',0)
+
+    def Sleep(self,seconds,category):
+        # Built-in delays - recorded in the timing budget
+        time.sleep(seconds)
+        self.budget.Add(category,seconds)
+
+    def ReportBudget(self):
+        print'AqnThread: Where the time went:'
+        print >>self.log,'AqnThread: Where the time went:'
+        for line in self.budget.Report(self.predicted):
+            print line
+            print >>self.log,line
+
+    def SetSwitchbox(self,conf):
+        # Set switchbox via the instrument executor, then report it (SetupPage display)
+        devices.Call('switchbox','SendCmd',devices.SWITCH_CONFIGS[conf])
+        self.sb_conf = conf
+        self.sink.Switchbox(conf) # update switchbox configuration icb
+
+    def Checkpoint(self,next_row,phase):
+        # Record progress - next_row is the first row not yet completed
+        src_V = {'SRC1':self.V1_set,'SRC2':self.V2_set}
+        with self.data_lock: # Copies - the measuring thread may be adding to the lists
+            readings = {'V1':list(self.V1Data),'V1_t':list(self.V1Times),
+                        'V2':list(self.V2Data),'V2_t':list(self.V2Times),
+                        'Vd':list(self.VdData),'Vd_t':list(self.VdTimes)}
+        state = {'kind':'run','run_id':self.run_id,'xlfile':self.xlfilename,
+                 'start_row':self.start_row,'stop_row':self.stop_row,
+                 'next_row':next_row,'phase':phase,
+                 'instruments':checkpoint.InstrSnapshot(self.config.roles,src_V,self.sb_conf),
+                 'readings':readings}
+        self.checkpoint.Save(state)
+
+    def SetSrcV(self,role,V):
+        # Set source voltage via the instrument executor, then report it (RunPage display)
+        devices.SetSrcV(role,V)
+        self.sink.SrcV(role,V)
         
     def abort(self):
         """abort worker thread."""
         # Method for use by main thread to signal an abort
-        stat_ev = evts.StatusEvent(msg='abort(): Run aborted', field=0)
-        wx.PostEvent(self.TopLevel, stat_ev)
+        self.sink.Status('abort(): Run aborted', field=0)
         self._want_abort = 1
 
     def filt(self,char):
@@ -617,3 +746,44 @@ class AqnThread(Thread):
     
 
 """--------------End of Thread class definition-------------------"""
+
+
+class RowWriter(Thread):
+    """
+    Consumer thread: writes, saves and plots completed rows (in order) for an
+    AqnThread, so that row N is processed while row N+1 is measured.
+    """
+    def __init__(self, aqn):
+        Thread.__init__(self)
+        self.aqn = aqn
+        self.rows = Queue.Queue()
+        self.error = None # Exception that stopped the writer
+        self.daemon = True
+        self.start()
+
+    def Put(self, rd):
+        self.rows.put(rd)
+
+    def Finish(self):
+        # No more rows - wait until all queued rows are done
+        self.rows.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            rd = self.rows.get()
+            if rd is None:
+                return
+            if self.error is not None:
+                continue # Don't write past a failed row
+            try:
+                self.aqn.WriteDataThisRow(rd) # (saves workbook)
+                self.aqn.next_row = rd['row'] + 1
+                self.aqn.Checkpoint(self.aqn.next_row, 'row') # Row complete
+                self.aqn.PlotRow(rd)
+                self.aqn.AnalyseRow(rd)
+            except Exception as msg:
+                self.error = msg
+                print'RowWriter.run(): Failed to write row',rd['row']
+                traceback.print_exc()
+                traceback.print_exc(file=self.aqn.log)
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+aqnproc.py - Acquisition in a separate process, watched through a
+shared-memory ring buffer.
+
+The GUI can run an acquisition (or R-link) run as a separate hrbc_cli.py
+process instead of a thread in its own process, so wx event handling and
+matplotlib redraws can't jitter the reading timestamps. The run process
+reports progress through a StreamSink: every sink call (Status, Data,
+Plot, ...) is pickled into a ring buffer in a memory-mapped file next to
+the data file (<xlfile>.stream). The GUI follows the stream with a
+StreamReader and passes each call on to its own WxSink - it's just a
+viewer. Closing the GUI doesn't disturb the run, and a GUI that opens the
+same data file later picks the stream up again (with as much history as
+the ring still holds).
+
+The run process never waits for viewers: when the ring is full the oldest
+messages are overwritten (a slow reader skips ahead and counts the loss).
+The only message back is an abort request - a flag in the file header,
+checked by hrbc_cli.WaitFor() about once a second, which also updates a
+heartbeat so viewers can tell a live run from a stale file.
+
+This module must not import wx.
+"""
+
+import os
+import sys
+import mmap
+import time
+import zlib
+import struct
+import cPickle
+import threading
+import subprocess
+import collections
+
+SUFFIX = '.stream'
+CAPACITY = 4*1024*1024 # Ring size (bytes)
+MAGIC = 'HRBS'
+VERSION = 1
+HEADER = struct.Struct('<4sHIQQdBI') # magic, version, capacity, head, tail, heartbeat, state, pid
+ABORT_OFFSET = 63 # Abort-request flag (written by viewers)
+DATA_OFFSET = 64
+FRAME = struct.Struct('<II') # payload length, crc32
+STALE = 10.0 # s without a heartbeat: the run process has gone
+
+# States
+RUNNING = 1
+FINISHED = 2
+
+
+class StreamWriter():
+    """
+    The run process's end of the stream. Thread-safe.
+    """
+    def __init__(self, filename, capacity=CAPACITY):
+        self.filename = filename
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.f = open(filename,'w+b')
+        self.f.truncate(DATA_OFFSET + capacity)
+        self.m = mmap.mmap(self.f.fileno(), DATA_OFFSET + capacity)
+        self.head = 0 # Bytes written, ever
+        self.tail = 0 # Start of oldest complete frame still in the ring
+        self.frames = collections.deque() # (start, length) of frames in the ring
+        self.state = RUNNING
+        self.WriteHeader()
+
+    def WriteHeader(self):
+        self.m[:HEADER.size] = HEADER.pack(MAGIC, VERSION, self.capacity, self.head, self.tail,
+                                           time.time(), self.state, os.getpid())
+
+    def Put(self, pos, data):
+        # Copy data into the ring at (absolute) position pos, wrapping round
+        i = pos % self.capacity
+        n = min(len(data), self.capacity - i)
+        self.m[DATA_OFFSET+i:DATA_OFFSET+i+n] = data[:n]
+        if n < len(data):
+            self.m[DATA_OFFSET:DATA_OFFSET+len(data)-n] = data[n:]
+
+    def Write(self, obj):
+        payload = cPickle.dumps(obj, 2)
+        frame = FRAME.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+        assert len(frame) <= self.capacity,'Stream message too big (%d bytes)'%len(frame)
+        with self.lock:
+            # Drop the frames this one will overwrite - and tell readers first
+            while self.frames and self.head + len(frame) - self.frames[0][0] > self.capacity:
+                self.frames.popleft()
+                self.tail = self.frames[0][0] if self.frames else self.head
+            self.WriteHeader()
+            self.Put(self.head, frame)
+            self.frames.append((self.head, len(frame)))
+            self.head += len(frame)
+            self.WriteHeader()
+
+    def Beat(self):
+        with self.lock:
+            self.WriteHeader()
+
+    def AbortRequested(self):
+        return self.m[ABORT_OFFSET] != '\x00'
+
+    def Close(self):
+        # Mark the run finished (the file stays, for late viewers)
+        with self.lock:
+            self.state = FINISHED
+            self.WriteHeader()
+            self.m.flush()
+            self.m.close()
+            self.f.close()
+
+
+class StreamReader():
+    """
+    A viewer's end of the stream. Poll() returns the messages written since
+    the last Poll() - oldest first - starting with the oldest still in the ring.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename,'r+b')
+        self.m = mmap.mmap(self.f.fileno(), 0)
+        magic,version,self.capacity = self.Header()[:3]
+        assert magic == MAGIC and version == VERSION,'Not an HRBC stream: %s'%filename
+        self.pos = self.Header()[4] # Oldest available
+        self.lost = 0 # Times we fell behind and skipped messages
+
+    def Header(self):
+        # magic, version, capacity, head, tail, heartbeat, state, pid
+        return HEADER.unpack(self.m[:HEADER.size])
+
+    def Get(self, pos, n):
+        i = pos % self.capacity
+        k = min(n, self.capacity - i)
+        data = self.m[DATA_OFFSET+i:DATA_OFFSET+i+k]
+        if k < n:
+            data += self.m[DATA_OFFSET:DATA_OFFSET+n-k]
+        return data
+
+    def Poll(self):
+        msgs = []
+        head,tail = self.Header()[3:5]
+        while self.pos < head:
+            if self.pos < tail:
+                self.lost += 1
+                self.pos = tail
+                continue
+            length,crc = FRAME.unpack(self.Get(self.pos, FRAME.size))
+            payload = self.Get(self.pos + FRAME.size, length)
+            tail = self.Header()[4]
+            if self.pos < tail:
+                continue # Overwritten while we read it
+            if zlib.crc32(payload) & 0xffffffff != crc:
+                break # Caught mid-write - try again next time
+            msgs.append(cPickle.loads(payload))
+            self.pos += FRAME.size + length
+        return msgs
+
+    def State(self):
+        return self.Header()[6]
+
+    def Alive(self):
+        # Run process still running (heartbeat recent)?
+        beat,state = self.Header()[5:7]
+        return state == RUNNING and time.time() - beat < STALE
+
+    def RequestAbort(self):
+        self.m[ABORT_OFFSET] = '\x01'
+
+    def Close(self):
+        self.m.close()
+        self.f.close()
+
+
+class StreamSink():
+    """
+    Progress sink (see progress.py) that sends every call down the stream.
+    """
+    def __init__(self, writer):
+        self.writer = writer
+
+    def __getattr__(self, name):
+        def Send(*args, **kwargs):
+            self.writer.Write((name, args, kwargs))
+        return Send
+
+
+def Replay(msgs, sink):
+    # Pass streamed sink calls on to a local sink
+    for name,args,kwargs in msgs:
+        getattr(sink, name)(*args, **kwargs)
+
+
+def Live(xlfilename):
+    # StreamReader for a run in progress on this data file, or None
+    filename = xlfilename + SUFFIX
+    if not os.path.isfile(filename):
+        return None
+    try:
+        reader = StreamReader(filename)
+    except (AssertionError, struct.error, ValueError, EnvironmentError):
+        return None
+    if reader.Alive():
+        return reader
+    reader.Close()
+    return None
+
+
+def CliArgs(config, kind, resume=False):
+    # hrbc_cli.py arguments for this runconfig.RunConfig
+    argv = [config.xlfilename, '--quiet', '--stream', '--publish',
+            '--r1', config.R1Name, '--r2', config.R2Name,
+            '--comment', config.comment, '--run-id', config.run_id,
+            '--settle', str(int(config.settle_time)),
+            '--min-readings', str(config.min_readings),
+            '--sequence', config.sequence]
+    for r,d in sorted(config.roles.items()):
+        argv += ['--role', '%s=%s'%(r,d)]
+    if kind == 'rlink':
+        argv.append('--rlink')
+    if config.auto_range:
+        argv.append('--auto-range')
+    if config.sem_ppm is not None:
+        argv += ['--sem-ppm', repr(config.sem_ppm)]
+    if config.sem_Vd is not None:
+        argv += ['--sem-vd', repr(config.sem_Vd)]
+    if resume:
+        argv.append('--resume')
+    return [a.encode(sys.getfilesystemencoding() or 'utf-8') if isinstance(a, unicode) else a for a in argv]
+
+
+def Launch(argv):
+    """
+    Start hrbc_cli.py with these arguments as an independent process - it
+    keeps running if the GUI is closed. Removes any old stream file first.
+    """
+    stream = argv[0] + SUFFIX
+    if os.path.isfile(stream):
+        os.remove(stream)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hrbc_cli.py')
+    flags = 0
+    if sys.platform == 'win32':
+        flags = 0x00000008 | 0x00000200 # DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP
+    with open(os.devnull,'w') as null:
+        return subprocess.Popen([sys.executable, script] + argv, cwd=os.path.dirname(argv[0]),
+                                stdin=null, stdout=null, stderr=null, creationflags=flags,
+                                close_fds=(sys.platform != 'win32'))
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+bus_bench.py - GPIB / VISA bus benchmark for the HRBC instruments.
+
+For each VISA instrument in the Excel file's Parameters sheet (or one
+VISA address given with --resource) this measures:
+* query round-trip latency (the instrument's 'test' query, e.g. ID?),
+* write time / throughput (the write half of each query),
+* read time versus reply size (test query plus any --query commands),
+* latency, timeouts and errors for each termination setting and timeout
+  in TERMINATIONS x TIMEOUTS (a wrong read termination shows up as a
+  timeout on every query).
+
+Only queries are sent - instruments whose test string isn't a query
+(switchbox, sources that would change state) are skipped. GMH sensors
+aren't on the VISA bus and are skipped too.
+
+Results are printed and saved as JSON, so runs on different days,
+interfaces or backends can be compared (--compare OLD.json). Use
+--backend @sim to run against a simulated VISA backend (pyvisa-sim).
+
+Examples:
+python bus_bench.py data.xlsx
+python bus_bench.py data.xlsx --n 200 --compare HRBC_bench_20261019_101500.json
+python bus_bench.py --resource GPIB0::22::INSTR --test ID? --query DCV?
+python bus_bench.py --resource GPIB0::22::INSTR --backend @sim
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import datetime as dt
+
+import numpy as np
+import visa
+from openpyxl import load_workbook
+
+import bustrace
+
+# Best timer: time.time() only has ~15 ms resolution on Windows
+if sys.platform == 'win32':
+    timer = time.clock
+else:
+    timer = time.time
+
+TERMINATIONS = (('\r\n','\r\n'), ('\n','\n'), ('\r','\r')) # (write, read)
+TIMEOUTS = (500, 2000) # ms
+DEFAULT_TERM = ('\r\n','\r\n')
+DEFAULT_TIMEOUT = 2000 # ms, as devices.instrument.Open()
+
+
+def IsQuery(s):
+    # Same rule as devices.instrument.SendCmd()
+    return s is not None and any(x in s for x in '?X')
+
+
+def Stats(x):
+    # Summary of a list of times (s)
+    if len(x) == 0:
+        return None
+    x = sorted(x)
+    return {'n':len(x), 'mean':float(np.mean(x)), 'sd':float(np.std(x, ddof=1)) if len(x) > 1 else 0.0,
+            'min':x[0], 'p50':bustrace.Percentile(x,50), 'p95':bustrace.Percentile(x,95), 'max':x[-1]}
+
+
+def Query(instr, cmd):
+    # One timed query: (write time, read time, reply)
+    t0 = timer()
+    instr.write(cmd)
+    t1 = timer()
+    reply = instr.read()
+    t2 = timer()
+    return t1-t0, t2-t1, reply
+
+
+def Settings(instr, term, timeout):
+    instr.write_termination, instr.read_termination = term
+    instr.timeout = timeout
+
+
+def Recover(instr):
+    # After a timeout: clear the instrument's output and the interface buffers
+    try:
+        instr.clear()
+    except (visa.VisaIOError, AttributeError):
+        pass
+
+
+def Latency(instr, cmd, n):
+    """
+    n queries of cmd with the current settings. Returns write and read
+    times, round-trip times, reply sizes and error count.
+    """
+    res = {'write':[], 'read':[], 'round_trip':[], 'bytes':[], 'errors':0}
+    for i in range(n):
+        try:
+            tw,tr,reply = Query(instr, cmd)
+        except visa.VisaIOError:
+            res['errors'] += 1
+            Recover(instr)
+            continue
+        res['write'].append(tw)
+        res['read'].append(tr)
+        res['round_trip'].append(tw+tr)
+        res['bytes'].append(len(reply))
+    return res
+
+
+def SizeFit(sizes):
+    """
+    Read time vs reply size: least-squares t = a + b*bytes over all
+    replies, if there's more than one size. sizes: [(bytes, read time),...]
+    """
+    b = np.array([s[0] for s in sizes], dtype=float)
+    t = np.array([s[1] for s in sizes])
+    if len(set(b)) < 2:
+        return None
+    slope,intercept = np.polyfit(b, t, 1)
+    return {'overhead':float(intercept), 'per_byte':float(slope)}
+
+
+def Bench(instr, test, queries, n, n_term):
+    """
+    Benchmark one open VISA resource: test is its test query, queries are
+    extra queries for the read-size measurement.
+    """
+    result = {}
+    Settings(instr, DEFAULT_TERM, DEFAULT_TIMEOUT)
+    lat = Latency(instr, test, n)
+    result['latency'] = Stats(lat['round_trip'])
+    result['write'] = Stats(lat['write'])
+    result['errors'] = lat['errors']
+    w_bytes = len(test) + len(DEFAULT_TERM[0])
+    if len(lat['write']) > 0 and sum(lat['write']) > 0:
+        result['write_throughput'] = {'writes_per_s':len(lat['write'])/sum(lat['write']),
+                                      'bytes_per_s':w_bytes*len(lat['write'])/sum(lat['write'])}
+
+    # Read time vs reply size
+    sizes = zip(lat['bytes'], lat['read'])
+    per_cmd = {}
+    for cmd in [test] + list(queries):
+        if cmd == test:
+            r = lat
+        else:
+            r = Latency(instr, cmd, max(n//4, 1))
+            sizes += zip(r['bytes'], r['read'])
+        per_cmd[cmd] = {'bytes':int(np.mean(r['bytes'])) if len(r['bytes']) > 0 else None,
+                        'read':Stats(r['read']), 'errors':r['errors']}
+    result['reads'] = per_cmd
+    result['read_fit'] = SizeFit(sizes)
+
+    # Termination and timeout settings
+    result['settings'] = []
+    for term in TERMINATIONS:
+        for timeout in TIMEOUTS:
+            Settings(instr, term, timeout)
+            t0 = timer()
+            r = Latency(instr, test, n_term)
+            result['settings'].append({'write_term':term[0], 'read_term':term[1], 'timeout':timeout,
+                                       'ok':len(r['round_trip']), 'errors':r['errors'],
+                                       'latency':Stats(r['round_trip']), 'elapsed':timer()-t0})
+    Settings(instr, DEFAULT_TERM, DEFAULT_TIMEOUT)
+    return result
+
+
+def Targets(xlfilename):
+    """
+    (description, VISA address, test query) for each VISA instrument in the
+    Parameters sheet. The sheet is read here (columns I-K, as
+    devices.LoadInstrData()) rather than by importing devices, which opens a
+    VISA resource manager and loads the GMH DLL.
+    """
+    ws_params = load_workbook(xlfilename, data_only = True).get_sheet_by_name('Parameters')
+    instr_data = {}
+    for r in ws_params.rows:
+        descr,param,value = r[8].value,r[9].value,r[10].value # I,J,K: description, parameter, value
+        if param in ('str_addr','test'):
+            instr_data.setdefault(descr, {})[param] = value
+    targets = []
+    for d,info in sorted(instr_data.items()):
+        addr = info.get('str_addr')
+        if addr is None or addr == 'NO_ADDRESS' or addr.startswith('COM') or 'GMH' in d:
+            continue
+        targets.append((d, addr, info.get('test')))
+    return targets
+
+
+def Ms(s):
+    # Formatted ms (or '-')
+    if s is None:
+        return '%8s'%'-'
+    return '%8.2f'%(1e3*s)
+
+
+def Report(report, old=None):
+    # Text lines: one summary line per instrument, then the settings table
+    lines = ['%-28s %-18s %8s %8s %8s %8s %10s %8s %4s'%('instrument','address','p50 ms','p95 ms','max ms',
+                                                         'write ms','query/s','ms/kB','err')]
+    for d,res in sorted(report['results'].items()):
+        if 'skipped' in res:
+            lines.append('%-28s %-18s %s'%(d[:28], res['address'][:18], res['skipped']))
+            continue
+        lat = res['latency'] or {}
+        fit = res['read_fit']
+        rate = 1.0/lat['mean'] if lat.get('mean') else 0.0
+        lines.append('%-28s %-18s %s %s %s %s %10.1f %s %4d'%(d[:28], res['address'][:18], Ms(lat.get('p50')),
+                                                             Ms(lat.get('p95')), Ms(lat.get('max')),
+                                                             Ms((res['write'] or {}).get('p50')), rate,
+                                                             Ms(fit['per_byte']*1024 if fit else None), res['errors']))
+        if old is not None and d in old['results'] and old['results'][d].get('latency'):
+            p50 = old['results'][d]['latency']['p50']
+            if lat.get('p50') is None: # Every query failed this time
+                lines.append('%-28s %-18s %s (no latencies now)'%('', '  was', Ms(p50)))
+            else:
+                lines.append('%-28s %-18s %s (%+.1f%%)'%('', '  was', Ms(p50), 100*(lat['p50']-p50)/p50 if p50 else 0))
+    for d,res in sorted(report['results'].items()):
+        if 'settings' not in res:
+            continue
+        lines.append('')
+        lines.append('%s: termination (write/read) and timeout'%d)
+        for s in res['settings']:
+            lat = s['latency'] or {}
+            lines.append('  %-4s/%-4s %5d ms: %3d ok %3d errors, p50 %s ms, %.2f s elapsed'%(repr(s['write_term'])[1:-1],
+                         repr(s['read_term'])[1:-1], s['timeout'], s['ok'], s['errors'], Ms(lat.get('p50')), s['elapsed']))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='VISA bus latency / throughput benchmark for HRBC instruments.')
+    parser.add_argument('xlfile', nargs='?', default=None, help='Excel data file (Parameters sheet: instruments to test)')
+    parser.add_argument('--resource', default=None, help='benchmark just this VISA address (e.g. GPIB0::22::INSTR)')
+    parser.add_argument('--test', default='ID?', help='test query for --resource (default ID?)')
+    parser.add_argument('--query', action='append', default=[], help='extra query for the read-size test (repeatable)')
+    parser.add_argument('--backend', default='', help='VISA backend (e.g. @sim, @py; default: the system VISA library)')
+    parser.add_argument('--n', type=int, default=100, help='queries per latency test (default 100)')
+    parser.add_argument('--n-term', type=int, default=5, help='queries per termination / timeout setting (default 5)')
+    parser.add_argument('--out', default=None, help='JSON report file (default HRBC_bench_<date_time>.json)')
+    parser.add_argument('--compare', default=None, help='earlier JSON report to compare latencies with')
+    args = parser.parse_args(argv)
+
+    if (args.xlfile is None) == (args.resource is None):
+        parser.error('Give an Excel file or --resource (not both)')
+    if args.resource is not None:
+        targets = [(args.resource, args.resource, args.test)]
+        directory = os.getcwd()
+    else:
+        xlfilename = os.path.abspath(args.xlfile)
+        directory = os.path.dirname(xlfilename)
+        targets = Targets(xlfilename)
+
+    rm = visa.ResourceManager(args.backend)
+    report = {'created':dt.datetime.now().strftime("%d/%m/%Y %H:%M:%S"), 'backend':args.backend or 'default',
+              'n':args.n, 'results':{}}
+    for d,addr,test in targets:
+        res = {'address':addr}
+        report['results'][d] = res
+        if not IsQuery(test):
+            res['skipped'] = 'skipped - test string %s is not a query'%repr(test)
+            continue
+        print 'bus_bench: %s (%s)...'%(d, addr)
+        try:
+            instr = rm.open_resource(addr)
+        except visa.VisaIOError as e:
+            res['skipped'] = 'skipped - %s'%e
+            continue
+        try:
+            res.update(Bench(instr, test, args.query, args.n, args.n_term))
+        finally:
+            instr.close()
+    rm.close()
+
+    out = args.out
+    if out is None:
+        out = os.path.join(directory, 'HRBC_bench_%s.json'%dt.datetime.now().strftime('%Y%m%d_%H%M%S'))
+    with open(out,'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+
+    old = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old = json.load(f)
+    for line in Report(report, old):
+        print line
+    print 'Report saved to',out
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
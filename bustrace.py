@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+"""
+bustrace.py - Binary trace of instrument bus transactions.
+
+Every traced instrument method (devices.instrument SendCmd, Read,
+CheckErr, SetV, ... and GMH_Sensor Transmit, Measure) is recorded as one
+event: role, command (method and arguments), reply, start and end times,
+demo/error flags and any error message. The acquisition thread adds a
+'mark' at the start of each row.
+Functions in LISTENERS are also called for every traced call, whether or
+not a trace is being written (e.g. publish.Publisher's instrument health).
+
+Records are packed with struct into a buffered file (low overhead - no
+text formatting on the bus path). Roles, commands and error messages are
+written once per file as numbered strings. When the file reaches
+MAX_BYTES it's renamed <name>.1 (older files shift up to <name>.<BACKUPS>)
+and a new, self-contained file is started.
+
+Run as a script to turn trace files into latency histograms per
+instrument and command, sorted by total bus time:
+python bustrace.py HRBC_trace.bin
+python bustrace.py HRBC_trace.bin --raw --top 5
+
+This module must not import visa, ctypes.windll or wx.
+"""
+
+import os
+import re
+import sys
+import time
+import struct
+import argparse
+import threading
+import collections
+
+FILENAME = 'HRBC_trace.bin'
+MAX_BYTES = 16*1024*1024
+BACKUPS = 5
+FLUSH_INTERVAL = 1.0 # s
+
+MAGIC = 'HRBT'
+VERSION = 1
+HEADER = struct.Struct('<4sHd') # magic, version, time created
+REC_STRING = 0
+REC_EVENT = 1
+REC_MARK = 2
+STRING = struct.Struct('<BHH') # REC_STRING, string id, length (+ utf-8 bytes)
+EVENT = struct.Struct('<BHHBHcIdd') # REC_EVENT, role id, command id, flags, error id, reply kind, reply length, t_start, t_end (+ reply)
+MARK = struct.Struct('<BHd') # REC_MARK, label id, time
+
+# Event flags
+ERROR = 1
+DEMO = 2
+
+EventRec = collections.namedtuple('EventRec', 'role cmd flags error reply t0 t1')
+MarkRec = collections.namedtuple('MarkRec', 'label t')
+
+TRACE = None # The current Tracer (None: not tracing)
+LISTENERS = [] # Also told of every traced call: fn(role, method, args, reply, t0, t1, demo, exc)
+
+
+def EncodeReply(reply):
+    # (kind, bytes) - kind lets the reply be rebuilt with its original type
+    if reply is None:
+        return 'n',''
+    elif isinstance(reply, bool):
+        return 'b',str(int(reply))
+    elif isinstance(reply, unicode):
+        return 'u',reply.encode('utf-8')
+    elif isinstance(reply, str):
+        return 's',reply
+    elif isinstance(reply, (int, long)):
+        return 'i',str(reply)
+    elif isinstance(reply, float):
+        return 'f',repr(reply)
+    return 'r',repr(reply)
+
+
+def DecodeReply(kind, data):
+    if kind == 'n':
+        return None
+    elif kind == 'b':
+        return bool(int(data))
+    elif kind == 'u':
+        return data.decode('utf-8')
+    elif kind == 's':
+        return data
+    elif kind == 'i':
+        return int(data)
+    elif kind == 'f':
+        return float(data)
+    return data # 'r': repr() only
+
+
+def FormatCmd(method, args):
+    # 'SendCmd DCV,10' - ctypes arguments (GMH) by value
+    if len(args) == 0:
+        return method
+    return method+' '+','.join(['%s'%getattr(a,'value',a) for a in args])
+
+
+class Tracer():
+    """
+    Writes trace records to a rotating set of files. Thread-safe.
+    """
+    def __init__(self, filename, max_bytes=MAX_BYTES, backups=BACKUPS):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = threading.Lock()
+        self.f = None
+        self.NewFile()
+
+    def NewFile(self):
+        self.f = open(self.filename,'ab')
+        self.size = self.f.tell()
+        self.ids = {} # string -> id, for this file (or appended session) only
+        self.Write(HEADER.pack(MAGIC, VERSION, time.time())) # Strings start again after every header
+        self.last_flush = time.time()
+
+    def Rotate(self):
+        self.f.close()
+        for i in range(self.backups-1, 0, -1):
+            old = '%s.%d'%(self.filename, i)
+            if os.path.exists(old):
+                new = '%s.%d'%(self.filename, i+1)
+                if os.path.exists(new):
+                    os.remove(new)
+                os.rename(old, new)
+        new = self.filename+'.1'
+        if os.path.exists(new):
+            os.remove(new)
+        os.rename(self.filename, new)
+        self.NewFile()
+
+    def Write(self, data):
+        self.f.write(data)
+        self.size += len(data)
+
+    def Id(self, s):
+        # Number for string s, defining it in the file if new
+        if s not in self.ids:
+            self.ids[s] = len(self.ids) + 1 # 0 means 'none'
+            b = s.encode('utf-8') if isinstance(s, unicode) else s
+            self.Write(STRING.pack(REC_STRING, self.ids[s], len(b)) + b)
+        return self.ids[s]
+
+    def Event(self, role, cmd, reply, t0, t1, flags=0, error=''):
+        kind,data = EncodeReply(reply)
+        with self.lock:
+            if self.f is None:
+                return
+            rec = EVENT.pack(REC_EVENT, self.Id(role), self.Id(cmd), flags,
+                             self.Id(error) if error else 0, kind, len(data), t0, t1)
+            self.Write(rec + data)
+            self.Housekeeping(t1)
+
+    def Mark(self, label, t):
+        with self.lock:
+            if self.f is None:
+                return
+            self.Write(MARK.pack(REC_MARK, self.Id(label), t))
+            self.Housekeeping(t)
+
+    def Housekeeping(self, t):
+        # Caller holds self.lock
+        if self.size >= self.max_bytes:
+            self.Rotate()
+        elif t - self.last_flush > FLUSH_INTERVAL:
+            self.f.flush()
+            self.last_flush = t
+
+    def Close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+
+def Start(directory):
+    # Trace to <directory>/HRBC_trace.bin (no change if already doing so)
+    global TRACE
+    filename = os.path.join(directory, FILENAME)
+    if TRACE is not None:
+        if TRACE.filename == filename:
+            return TRACE
+        Stop()
+    TRACE = Tracer(filename)
+    return TRACE
+
+
+def Stop():
+    global TRACE
+    if TRACE is not None:
+        TRACE.Close()
+        TRACE = None
+
+
+def Record(role, method, args, reply, t0, t1, demo, exc=None):
+    # Called by devices for every traced instrument method
+    for fn in LISTENERS:
+        try:
+            fn(role, method, args, reply, t0, t1, demo, exc)
+        except Exception as msg:
+            print'bustrace.Record(): Listener failed:',msg
+    if TRACE is None:
+        return
+    flags = 0
+    if demo:
+        flags |= DEMO
+    error = ''
+    if exc is not None:
+        flags |= ERROR
+        error = '%s: %s'%(exc.__class__.__name__, exc)
+    try:
+        TRACE.Event(str(role), FormatCmd(method, args), reply, t0, t1, flags, error)
+    except Exception as msg: # Never let tracing break instrument I/O
+        print'bustrace.Record(): Trace failed:',msg
+
+
+def Mark(label):
+    if TRACE is not None:
+        TRACE.Mark(label, time.time())
+
+
+"""
+---------------------------------------------------------------
+Reading traces
+"""
+
+def Files(filename):
+    # A trace and its rotated predecessors, oldest first
+    names = ['%s.%d'%(filename, i) for i in range(BACKUPS, 0, -1)] + [filename]
+    return [n for n in names if os.path.exists(n)]
+
+
+def ReadFile(filename):
+    """
+    Generate the EventRec and MarkRec records of one trace file, in order.
+    A truncated last record (e.g. after a crash) is ignored.
+    """
+    with open(filename,'rb') as f:
+        data = f.read()
+    strings = {0:''}
+    pos = 0
+    while pos < len(data):
+        if data[pos:pos+4] == MAGIC: # File (or appended session) header
+            magic,version,t = HEADER.unpack_from(data, pos)
+            assert version == VERSION,'Unknown trace version %d in %s'%(version, filename)
+            strings = {0:''}
+            pos += HEADER.size
+            continue
+        rec = ord(data[pos])
+        try:
+            if rec == REC_STRING:
+                r,i,n = STRING.unpack_from(data, pos)
+                pos += STRING.size
+                strings[i] = data[pos:pos+n].decode('utf-8')
+                pos += n
+            elif rec == REC_EVENT:
+                r,role,cmd,flags,err,kind,n,t0,t1 = EVENT.unpack_from(data, pos)
+                pos += EVENT.size
+                if pos + n > len(data):
+                    return
+                reply = DecodeReply(kind, data[pos:pos+n])
+                pos += n
+                yield EventRec(strings[role], strings[cmd], flags, strings[err], reply, t0, t1)
+            elif rec == REC_MARK:
+                r,label,t = MARK.unpack_from(data, pos)
+                pos += MARK.size
+                yield MarkRec(strings[label], t)
+            else:
+                raise ValueError('Bad record type %d at byte %d of %s'%(rec, pos, filename))
+        except struct.error:
+            return # Truncated
+
+
+def Read(filename):
+    # All records of a trace, including its rotated predecessors
+    for name in Files(filename):
+        for rec in ReadFile(name):
+            yield rec
+
+
+"""
+---------------------------------------------------------------
+Latency histograms
+"""
+NUMBER = re.compile(r'[-+]?\d+\.?\d*(?:[eE][-+]?\d+)?')
+
+
+def Group(cmd):
+    # 'SendCmd DCV,-1.00037' -> 'SendCmd DCV,#'
+    return NUMBER.sub('#', cmd)
+
+
+def Percentile(sorted_x, p):
+    return sorted_x[min(len(sorted_x)-1, int(p/100.0*len(sorted_x)))]
+
+
+def Histogram(latencies, width=40):
+    # Text histogram, 1-2-5 bins from 0.1 ms
+    edges = [m*10**e for e in range(-4, 3) for m in (1,2,5)]
+    counts = [0]*(len(edges)+1)
+    for x in latencies:
+        i = 0
+        while i < len(edges) and x >= edges[i]:
+            i += 1
+        counts[i] += 1
+    top = max(counts)
+    lines = []
+    lo = 0
+    for i,c in enumerate(counts):
+        hi = edges[i] if i < len(edges) else None
+        if c > 0:
+            label = '%8.1f - %s ms'%(1e3*lo, '%8.1f'%(1e3*hi) if hi is not None else '     ...')
+            lines.append('  %s |%-*s %d'%(label, width, '#'*max(1, width*c//top), c))
+        lo = hi
+    return lines
+
+
+def Summary(records, raw=False, include_demo=False):
+    """
+    Latencies (s) grouped by (role, command), and the number of row marks.
+    """
+    groups = collections.defaultdict(list)
+    errors = collections.Counter()
+    n_rows = 0
+    for rec in records:
+        if isinstance(rec, MarkRec):
+            if rec.label.startswith('row'):
+                n_rows += 1
+            continue
+        if rec.flags & DEMO and not include_demo:
+            continue
+        key = (rec.role, rec.cmd if raw else Group(rec.cmd))
+        groups[key].append(rec.t1 - rec.t0)
+        if rec.flags & ERROR:
+            errors[key] += 1
+    return groups, errors, n_rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bus-latency histograms from an HRBC trace.')
+    parser.add_argument('trace', help='trace file (rotated predecessors are included)')
+    parser.add_argument('--raw', action='store_true', help="don't group commands that differ only in numbers")
+    parser.add_argument('--demo', action='store_true', help='include demo-mode (no bus) calls')
+    parser.add_argument('--role', default=None, help='only this role')
+    parser.add_argument('--top', type=int, default=10, help='histograms for the top N groups by total time')
+    args = parser.parse_args(argv)
+
+    groups,errors,n_rows = Summary(Read(args.trace), args.raw, args.demo)
+    if args.role is not None:
+        groups = dict([(k,v) for k,v in groups.items() if k[0] == args.role])
+    if len(groups) == 0:
+        print 'No bus transactions in',args.trace
+        return 1
+    bus_total = sum([sum(v) for v in groups.values()])
+    ranked = sorted(groups.items(), key=lambda kv: -sum(kv[1]))
+
+    print '%-10s %-28s %7s %9s %6s %9s %8s %8s %8s %8s %5s'%('role','command','count','total s','%',
+                                                           'per row s','p50 ms','p90 ms','p99 ms','max ms','err')
+    for (role,cmd),lat in ranked:
+        lat = sorted(lat)
+        per_row = '%9.2f'%(sum(lat)/n_rows) if n_rows > 0 else '%9s'%'-'
+        print '%-10s %-28s %7d %9.2f %6.1f %s %8.1f %8.1f %8.1f %8.1f %5d'%(role, cmd[:28], len(lat), sum(lat),
+                                                                     100*sum(lat)/bus_total, per_row,
+                                                                     1e3*Percentile(lat,50), 1e3*Percentile(lat,90),
+                                                                     1e3*Percentile(lat,99), 1e3*lat[-1],
+                                                                     errors[(role,cmd)])
+    print 'Total bus time %.1f s over %d rows'%(bus_total, n_rows)
+    for (role,cmd),lat in ranked[:args.top]:
+        print
+        print '%s %s:'%(role, cmd)
+        for line in Histogram(lat):
+            print line
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
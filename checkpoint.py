@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+checkpoint.py - Crash-safe record of run progress.
+
+While a run is in progress AqnThread and RLThread keep a checkpoint file
+next to the Excel data file (<xlfile>.ckpt.json). It's re-written (atomically)
+as each measurement phase completes and holds:
+* the run id, rows / reversal reached and the next row / reversal to measure,
+* a snapshot of the instrument state (roles, source voltages, switchbox,
+  demo status),
+* the readings collected so far for the row / reversal in progress.
+
+The workbook itself is saved after every completed row (reversal), so a
+restarted session can resume from the last completed row (reversal) rather
+than starting again at B1. Partial readings of an unfinished row are kept in
+the checkpoint (and logged on resume) but not re-used - the row is measured
+again from the start, with the sources freshly set and settled.
+
+The checkpoint is removed when a run finishes. After an abort or a failure
+it's kept, so the run can be resumed.
+"""
+
+import os
+import json
+import datetime as dt
+from threading import Lock
+
+import devices
+
+SUFFIX = '.ckpt.json'
+
+
+def WriteJSON(filename, data):
+    # Write a new file, then replace the old one, so a crash can't leave a half-written file
+    tmp = filename + '.tmp'
+    with open(tmp,'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    if os.path.exists(filename):
+        os.remove(filename) # os.rename() won't replace a file on Windows
+    os.rename(tmp, filename)
+
+
+def InstrSnapshot(roles, src_V, switchbox):
+    # Instrument state for a checkpoint
+    return {'roles':roles,
+            'src_V':src_V,
+            'switchbox':switchbox,
+            'demo':dict([(r,devices.ROLES_INSTR[r].demo) for r in devices.ROLES_INSTR.keys()])}
+
+
+class Checkpoint():
+    """
+    The checkpoint file for one Excel data file.
+    """
+    def __init__(self, xlfilename):
+        self.filename = xlfilename + SUFFIX
+        self.lock = Lock() # Saved from the measurement and row-writer threads
+
+    def Save(self, state):
+        state['saved'] = dt.datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+        with self.lock:
+            WriteJSON(self.filename, state)
+
+    def Load(self):
+        if not os.path.isfile(self.filename):
+            return None
+        with open(self.filename) as f:
+            return json.load(f)
+
+    def Remove(self):
+        with self.lock:
+            if os.path.isfile(self.filename):
+                os.remove(self.filename)
+
+
+def Load(xlfilename, kind):
+    """
+    Return the checkpoint state of an unfinished run of kind 'run' (AqnThread)
+    or 'rlink' (RLThread) for this data file, or None.
+    """
+    state = Checkpoint(xlfilename).Load()
+    if state is None or state['kind'] != kind:
+        return None
+    return state
+
+
+def Describe(state):
+    # One-line summary, for resume prompts
+    if state['kind'] == 'run':
+        where = 'row %s (rows %s to %s)'%(state['next_row'], state['start_row'], state['stop_row'])
+    else:
+        where = 'reversal %s of %s'%(state['next_rev'], state['N_reversals'])
+    return 'Run id "%s" stopped at %s - checkpoint saved %s'%(state['run_id'], where, state['saved'])
@@ -19,8 +19,16 @@ Created on Fri Mar 17 13:52:15 2017
 
 import numpy as np
 import os
+import time
 import ctypes as ct
+import threading
+import Queue
 import visa
+from openpyxl import cell
+
+import bustrace
+import metrics
+import seqplan
 
 
 INSTR_DATA = {} # Dictionary of instrument parameter dictionaries, keyed by description
@@ -55,6 +63,26 @@ GMH_DESCR = ('GMH, s/n627',
 LANG_OFFSET = 4096            
 '''--------------------------------------------------------------'''
 
+
+def Traced(fn):
+    '''
+    Decorator for instrument methods that talk to the bus: every call is
+    recorded (role, command, reply, timing, errors) in the bus trace.
+    '''
+    method = fn.__name__
+    def TracedMethod(self, *args):
+        t0 = time.time()
+        try:
+            reply = fn(self, *args)
+        except Exception as e:
+            bustrace.Record(self.role, method, args, None, t0, time.time(), self.demo, e)
+            raise
+        bustrace.Record(self.role, method, args, reply, t0, time.time(), self.demo)
+        return reply
+    TracedMethod.__name__ = method
+    TracedMethod.__doc__ = fn.__doc__
+    return TracedMethod
+
 class device():
     """
     A generic external device or instrument
@@ -158,6 +186,7 @@ class GMH_Sensor(device):
         return 1
 
   
+    @Traced
     def Transmit(self,Addr,Func):
         """
         A wrapper for the general-purpose interrogation function GMH_Transmit().
@@ -229,6 +258,7 @@ class GMH_Sensor(device):
         return len(self.info)
 
 
+    @Traced
     def Measure(self, meas):
         """
         Measure either temperature, pressure or humidity, based on parameter meas
@@ -312,6 +342,7 @@ class instrument(device):
             self.VStr = ''
 
 
+    @Traced
     def Open(self):
         try:
             self.instr = RM.open_resource(self.str_addr)
@@ -331,6 +362,7 @@ class instrument(device):
         return self.instr
 
 
+    @Traced
     def Close(self):
         # Close comms with instrument
         if self.demo == True:
@@ -343,6 +375,7 @@ class instrument(device):
         self.is_open = 0
 
 
+    @Traced
     def Init(self):
         # Send initiation string
         if self.demo == True:
@@ -362,6 +395,7 @@ class instrument(device):
         return reply
 
 
+    @Traced
     def SetV(self,V):
         # set output voltage (SRC) or input range (DVM)
         if self.demo == True:
@@ -386,6 +420,7 @@ class instrument(device):
             return -1
 
 
+    @Traced
     def SetFn(self):
         # Set DVM function
         if self.demo == True:
@@ -401,6 +436,7 @@ class instrument(device):
             return -1
 
 
+    @Traced
     def Oper(self):
         # Enable O/P terminals
         # For V-source instruments only
@@ -421,6 +457,7 @@ class instrument(device):
             return -1
 
 
+    @Traced
     def Stby(self):
         # Disable O/P terminals
         # For V-source instruments only
@@ -437,6 +474,7 @@ class instrument(device):
             return -1
 
 
+    @Traced
     def CheckErr(self):
         # Get last error string and clear error queue
         # For V-source instruments only (F5520A)
@@ -453,6 +491,7 @@ class instrument(device):
             return -1
 
 
+    @Traced
     def SendCmd(self,s):
         demo_reply = 'SendCmd(): DEMO resp. to '+s
         reply = 1
@@ -477,6 +516,7 @@ class instrument(device):
             return reply
 
 
+    @Traced
     def Read(self):
         reply = 0
         if self.demo == True:
@@ -498,3 +538,279 @@ class instrument(device):
         """ Used to test that the instrument is functioning. """
         return self.SendCmd(s)
 #__________________________________________
+
+
+'''
+###############################################################################
+Instrument command executor:
+ALL VISA and GMH traffic goes through a single executor thread. The GUI and
+the acquisition threads submit commands and get a CmdFuture back, so no
+instrument I/O happens in the wx GUI thread and no two threads ever talk to
+the bus at the same time.
+'''
+
+class CmdFuture():
+    """
+    The (eventual) result of a command submitted to the executor.
+    Result() blocks until the command has been executed and returns its
+    return value, or re-raises any exception it raised.
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def SetResult(self, result, exc=None):
+        with self._lock:
+            self._result = result
+            self._exc = exc
+            self._done.set()
+            callbacks = self._callbacks[:]
+        for fn in callbacks:
+            fn(self)
+
+    def Done(self):
+        return self._done.is_set()
+
+    def Result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError('devices.CmdFuture.Result(): Timed out waiting for instrument.')
+        if self._exc is not None:
+            raise self._exc
+        return self._result
+
+    def OnDone(self, fn):
+        """
+        Call fn(future) once the command has completed (from the executor
+        thread - GUI callers should wrap fn with wx.CallAfter).
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+
+class InstrExecutor(threading.Thread):
+    """
+    A thread with a command queue that owns all instrument I/O.
+    Commands are executed strictly in the order they were submitted.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self, name='InstrExecutor')
+        self.daemon = True
+        self.q = Queue.Queue()
+        self.start()
+
+    def Submit(self, fn, *args, **kwargs):
+        f = CmdFuture()
+        if threading.current_thread() is self: # Called from a queued command - don't deadlock
+            self.Execute(fn, args, kwargs, f)
+        else:
+            self.q.put((fn, args, kwargs, f))
+            metrics.Set('hrbc_executor_queue_depth', self.q.qsize())
+        return f
+
+    def Execute(self, fn, args, kwargs, f):
+        try:
+            f.SetResult(fn(*args, **kwargs))
+        except Exception as e:
+            print'devices.InstrExecutor.Execute():',getattr(fn,'__name__',fn),'failed:',e
+            f.SetResult(None, e)
+
+    def run(self):
+        while True:
+            item = self.q.get()
+            metrics.Set('hrbc_executor_queue_depth', self.q.qsize())
+            if item is None: # Stop() called
+                break
+            self.Execute(*item)
+
+    def Stop(self):
+        # Commands already queued are executed before the thread ends
+        self.q.put(None)
+
+
+EXECUTOR = None
+
+def GetExecutor():
+    global EXECUTOR
+    if EXECUTOR is None or not EXECUTOR.is_alive():
+        EXECUTOR = InstrExecutor()
+    return EXECUTOR
+
+
+def StopExecutor():
+    global EXECUTOR
+    if EXECUTOR is not None:
+        EXECUTOR.Stop()
+        EXECUTOR.join(10)
+        EXECUTOR = None
+
+
+def Submit(role, method, *args):
+    """
+    Queue ROLES_INSTR[role].<method>(*args) for execution.
+    Returns a CmdFuture - doesn't wait.
+    """
+    return GetExecutor().Submit(getattr(ROLES_INSTR[role], method), *args)
+
+
+def Call(role, method, *args):
+    """
+    Execute ROLES_INSTR[role].<method>(*args) via the executor and
+    wait for the reply. For use by worker threads, NOT the GUI thread.
+    """
+    return Submit(role, method, *args).Result()
+
+
+def _SetSrcV(role, V):
+    # Set a source output voltage and enable (V != 0) or disable (V == 0) its output.
+    src = ROLES_INSTR[role]
+    src.SetV(V)
+    time.sleep(seqplan.SRC_SETTLE_DEL)
+    if V == 0:
+        src.Stby()
+    else:
+        src.Oper()
+    time.sleep(seqplan.SRC_SETTLE_DEL)
+    return V
+
+
+def SubmitSrcV(role, V):
+    """ Queue a source-voltage change as a single command. Returns a CmdFuture. """
+    return GetExecutor().Submit(_SetSrcV, role, V)
+
+
+def SetSrcV(role, V):
+    """ Change a source voltage and wait until it has been applied. """
+    return SubmitSrcV(role, V).Result()
+
+
+"""
+---------------------------------------------------------------
+GUI-independent setup:
+Used by the SetupPage and by the command-line interface (hrbc_cli.py).
+"""
+# Default role -> instrument description assignments (SetupPage 'AutoPopulate')
+DEFAULT_ROLES = {'SRC1':'SRC: D4808',
+                 'SRC2':'SRC: F5520A',
+                 'DVM12':'DVM: HP3458A, s/n452',
+                 'DVMd':'DVM: HP3458A, s/n230',
+                 'DVMT1':'none',#'DVM: HP34401A, s/n976'
+                 'DVMT2':'none',#'DVM: HP34420A, s/n130'
+                 'GMH1':'GMH: s/n627',
+                 'GMH2':'GMH: s/n628',
+                 'GMHroom':'GMH: s/n367',
+                 'switchbox':'V1'}
+
+
+def LoadInstrData(wb, log):
+    """
+    Read the 'Parameters' sheet of workbook wb and compile INSTR_DATA.
+    wb must be opened with data_only = True (need cell VALUE, not FORMULA).
+    """
+    ws_params = wb.get_sheet_by_name('Parameters')
+
+    headings = (None, u'description',u'Instrument Info:',u'parameter',u'value',u'uncert',u'dof',u'label')
+
+    # Determine colummn indices from column letters:
+    col_I = cell.cell.column_index_from_string('I') - 1
+    col_J = cell.cell.column_index_from_string('J') - 1
+    col_K = cell.cell.column_index_from_string('K') - 1
+    col_L = cell.cell.column_index_from_string('L') - 1
+    col_M = cell.cell.column_index_from_string('M') - 1
+    col_N = cell.cell.column_index_from_string('N') - 1
+
+    params = []
+    values = []
+    del DESCR[:] # Not the descriptions of any earlier load
+    del sublist[:]
+
+    for r in ws_params.rows: # a tuple of row objects
+        descr = r[col_I].value # cell.value
+        param = r[col_J].value # cell.value
+        v_u_d_l = [r[col_K].value, r[col_L].value, r[col_M].value, r[col_N].value] # value,uncert,dof,label
+
+        if descr in headings and param in headings:
+            continue # Skip this row
+        else: # not header
+            params.append(param)
+            if v_u_d_l[1] is None: # single-valued (no uncert)
+                values.append(v_u_d_l[0]) # append value as next item
+                print descr,' : ',param,' = ',v_u_d_l[0]
+                print >>log, descr,' : ',param,' = ',v_u_d_l[0]
+            else: # multi-valued
+                while v_u_d_l[-1] is None: # remove empty cells
+                    del v_u_d_l[-1] # v_u_d_l.pop()
+                values.append(v_u_d_l) # append value-list as next item
+                print descr,' : ',param,' = ',v_u_d_l
+                print >>log, descr,' : ',param,' = ',v_u_d_l
+
+            if param == u'test': # last parameter for this description
+                DESCR.append(descr) # build description list
+                sublist.append(dict(zip(params,values))) # adds parameter dictionary to sublist
+                del params[:]
+                del values[:]
+
+    print '----END OF PARAMETER LIST----'
+    print >>log, '----END OF PARAMETER LIST----'
+
+    # Compile into a dictionary
+    INSTR_DATA.clear()
+    INSTR_DATA.update(dict(zip(DESCR,sublist)))
+    return INSTR_DATA
+
+
+def CreateInstr(d, r):
+    """
+    Create the instrument object with description d in role r and queue
+    opening of its visa session (for GPIB instruments).
+    For GMH instruments, use GMH dll not visa. Returns a CmdFuture for the
+    Open() call, or None for GMH instruments.
+    """
+    assert INSTR_DATA.has_key(d),'Unknown instrument: %s - check Excel file is loaded.'%d
+    INSTR_DATA[d]['role'] = r # update default role
+    if 'GMH' in r:
+        print'\ndevices.CreateInstr(): Creating GMH device (%s -> %s).'%(d,r)
+        ROLES_INSTR.update({r:GMH_Sensor(d)})
+        return None
+    else:
+        print'\ndevices.CreateInstr(): Creating VISA device (%s -> %s).'%(d,r)
+        ROLES_INSTR.update({r:instrument(d)})
+        return Submit(r,'Open') # Opened by the instrument executor
+
+
+def CreateRoles(roles):
+    """
+    Create instruments for all roles in the dictionary roles (role -> description)
+    and wait until they're open.
+    """
+    futures = [CreateInstr(roles[r],r) for r in roles.keys()]
+    for f in futures:
+        if f is not None:
+            f.Result()
+
+
+def CloseRoles():
+    """
+    Close all instrument sessions (before re-assigning roles) and wait until they're closed.
+    """
+    futures = [Submit(r,'Close') for r in ROLES_INSTR.keys()]
+    for f in futures:
+        f.Result()
+    ROLES_INSTR.clear()
+
+
+def CloseAll():
+    """
+    Close all instrument sessions and the VISA resource manager, then stop
+    the instrument executor (after queued commands have finished).
+    """
+    for r in ROLES_INSTR.keys():
+        Submit(r,'Close')
+    GetExecutor().Submit(RM.close)
+    StopExecutor()
+    bustrace.Stop()
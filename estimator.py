@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+estimator.py - Run-duration estimates, live ETA and timing budget.
+
+Estimate() predicts how long an acquisition run will take - before it
+starts - from the Data-sheet rows (n, start, AZ1 and range delays in
+columns C-F), the built-in delays of AqnThread and the measurement order
+chosen by seqplan.py (whose cost model is the timing schedule).
+EstimateRLink() does the same for an R-link measurement.
+
+While a run is in progress an Eta object refines the prediction: the
+predicted durations of the remaining rows are scaled by the ratio of
+measured to predicted time for the rows done so far.
+
+A Budget records where the time actually went (settling, delays, range
+changes, readings, ...) and is reported when the run ends.
+"""
+
+import time
+import datetime as dt
+import collections
+
+import seqplan
+import metrics
+
+# Built-in delays (s) outside the row schedule - see AqnThread.Run(), initialise()
+INIT_DEL = 1.0 # Per instrument
+POST_INIT_DEL = 3.0
+
+# R-link schedule (s) - see RLThread.Run()
+RL_SETUP_DEL = 3.0
+RL_REVERSAL_DEL = 65.0 + 2*2*seqplan.SRC_SETTLE_DEL # Between setting SRC1 and SRC2 (5 s), then settling (60 s)
+RL_READ_TIME = 2.0 + seqplan.READ_TIME # LFREQ, AZERO (1 s each) + reading
+
+# Budget categories, in reporting order
+CATEGORIES = ('settle', 'initialise', 'row overhead', 'start del.', 'range change', 'range del.',
+              'V1 readings', 'V2 readings', 'Vd readings', 'temperatures')
+
+
+def FormatDuration(s):
+    # h:mm:ss
+    s = int(round(s))
+    return '%d:%02d:%02d'%(s//3600, (s//60)%60, s%60)
+
+
+def Estimate(rows, auto_range, plan, settle_time=0, n_instr=0, offset=0):
+    """
+    Predicted durations (s) of an acquisition run:
+    'start' (settle + initialise), 'rows' (list, one per row) and 'total'.
+    rows: seqplan.ReadRows(), offset: index (from the start row) of rows[0].
+    """
+    sim = seqplan.Simulate(plan, rows, auto_range, offset)
+    start = settle_time + n_instr*INIT_DEL + POST_INIT_DEL
+    ends = [0.0] + sim['row_ends']
+    row_durations = [ends[i+1]-ends[i] for i in range(len(rows))]
+    return {'start':start, 'rows':row_durations, 'total':start+sim['duration']}
+
+
+def EstimateRun(config, first_row=None):
+    """
+    Estimate an acquisition run from a runconfig.RunConfig (Data sheet rows B1-B2,
+    or first_row-B2). Returns (estimate, rows, plan).
+    """
+    ws = config.wb.get_sheet_by_name('Data')
+    start_row = ws['B1'].value
+    stop_row = ws['B2'].value
+    if first_row is None:
+        first_row = start_row
+    rows = seqplan.ReadRows(ws, first_row, stop_row)
+    offset = first_row - start_row
+    if config.sequence == 'auto':
+        plan = seqplan.Choose(rows, config.auto_range, offset)[0]
+    else:
+        plan = seqplan.Find(config.sequence)
+    est = Estimate(rows, config.auto_range, plan, config.settle_time, len(config.roles), offset)
+    return est, rows, plan
+
+
+def EstimateRLink(config):
+    # Predicted duration (s) of an R-link measurement (Rlink sheet B2, B3)
+    ws = config.wb.get_sheet_by_name('Rlink')
+    N_reversals = ws['B2'].value
+    N_readings = ws['B3'].value
+    return RL_SETUP_DEL + N_reversals*(RL_REVERSAL_DEL + N_readings*RL_READ_TIME)
+
+
+def Report(est, rows, plan, first_row):
+    # Text lines: per-row and total estimate
+    lines = ['Measurement sequence: %s'%plan.name,
+             'Settle + initialise: %s'%FormatDuration(est['start'])]
+    for i,d in enumerate(est['rows']):
+        rs = rows[i]
+        lines.append('Row %3d: V1 = %8s, V2 = %10s, n = %3s: %s'%(first_row+i, rs['V1'], rs['V2'],
+                                                                  rs['n'], FormatDuration(d)))
+    finish = dt.datetime.now() + dt.timedelta(seconds=est['total'])
+    lines.append('Total: %s (finish at about %s if started now)'%(FormatDuration(est['total']),
+                                                                  finish.strftime("%d/%m/%Y %H:%M")))
+    return lines
+
+
+class Eta():
+    """
+    Live ETA from the predicted row durations, refined with measured row times.
+    """
+    def __init__(self, row_durations):
+        self.predicted = list(row_durations)
+        self.done = 0 # Rows completed
+        self.pred_done = 0.0
+        self.meas_done = 0.0
+
+    def RowDone(self, measured):
+        self.pred_done += self.predicted[self.done]
+        self.meas_done += measured
+        self.done += 1
+
+    def Scale(self):
+        # Measured/predicted so far (1 until a row is done)
+        if self.pred_done > 0:
+            return self.meas_done/self.pred_done
+        return 1.0
+
+    def Remaining(self):
+        return self.Scale()*sum(self.predicted[self.done:])
+
+    def Finish(self):
+        return dt.datetime.now() + dt.timedelta(seconds=self.Remaining())
+
+
+class Budget():
+    """
+    Where the time went: seconds spent in each category since Start().
+    """
+    def __init__(self):
+        self.t = collections.OrderedDict([(c,0.0) for c in CATEGORIES])
+        self.Start()
+
+    def Start(self):
+        self.start = time.time()
+
+    def Add(self, category, seconds):
+        assert category in self.t,'Unknown timing category: %s'%category
+        self.t[category] += seconds
+        metrics.Observe('hrbc_phase_seconds', seconds, phase=category)
+
+    def Report(self, predicted=None):
+        # Text lines: time per category, % of elapsed time, and the unaccounted rest
+        elapsed = time.time() - self.start
+        lines = []
+        for c,s in self.t.items() + [('other', elapsed - sum(self.t.values()))]:
+            pc = 100.0*s/elapsed if elapsed > 0 else 0.0
+            lines.append('%-13s %9s %5.1f%%'%(c, FormatDuration(s), pc))
+        lines.append('%-13s %9s'%('total', FormatDuration(elapsed)))
+        if predicted is not None:
+            lines.append('%-13s %9s'%('(predicted)', FormatDuration(predicted)))
+        return lines
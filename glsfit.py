@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+glsfit.py - Joint generalised least-squares fit of R1 against T, V and t.
+
+HRBA's R1-T fits (R_info.write_R1_T_fit()) treat LV and HV separately
+and get gamma from just two points. Here all blocks of a run are fitted
+at once to
+
+    R1 = R0 + dR/dT*(T - T0) + dR/dV*(V - V0) + dR/dt*(t - t0)
+
+(T0, V0, t0: the run's mean temperature, voltage and time) by GLS, with
+the full covariance matrix of the blocks' R1 values: blocks share
+corrections, R2's parameters and Rd, so their errors are correlated.
+The covariance comes from r1kernel's u-components - the same first-order
+covariance GTC would give. A term is left out if its variable doesn't
+change during the run (e.g. gamma when LV = HV), or if the run has too
+few blocks to fit it with at least one degree of freedom to spare.
+
+Several runs can be fitted in one solve (each with its own parameters),
+which also gives the covariance between runs' results.
+
+Results are R0, alpha = (dR/dT)/R0, gamma = (dR/dV)/R0 and the drift
+rate (dR/dt)/R0 per year, with their full covariance matrix and the
+fit's chi-squared. T, V and t are taken as exact.
+"""
+
+import numpy as np
+
+NAMES = ('R0','alpha','gamma','drift')
+UNITS = ('Ohm','/C','/V','/yr')
+DAY = 86400.0 # s
+YEAR = 365.25 # days
+MIN_SPREAD = {'T':1e-3, 'V':1e-3, 't':1e-3} # C, V, days - less: term not fitted
+
+
+def Covariance(comp, IDS):
+    """
+    Covariance matrix (blocks x blocks) of R1 from u-components comp and
+    quantity ids IDS (both blocks x inputs - see r1kernel.RunInputs()).
+    """
+    own = IDS < 0
+    V = np.diag((np.where(own, comp, 0)**2).sum(axis=1))
+    shared = np.unique(IDS[~own])
+    if len(shared) > 0:
+        rows,cols = np.nonzero(~own)
+        C = np.zeros((len(comp), len(shared)))
+        np.add.at(C, (rows, np.searchsorted(shared, IDS[rows,cols])), comp[rows,cols])
+        V += C.dot(C.T)
+    return V
+
+
+def Design(groups, T, V, t):
+    """
+    Design matrix: for each run (groups: run index of each block), an
+    intercept and slopes in T, V and t (days) about the run's means -
+    no more slopes than leave the run's fit with dof > 0.
+    Returns (A, [(run, term),...], {run: (T0, V0, t0)}).
+    """
+    x = {'T':T, 'V':V, 't':t/DAY}
+    columns = []
+    centres = {}
+    cols = []
+    for g in np.unique(groups):
+        sel = groups == g
+        centres[g] = (T[sel].mean(), V[sel].mean(), t[sel].mean())
+        cols.append(np.where(sel, 1.0, 0.0))
+        columns.append((g, 'R0'))
+        n_terms = 1
+        for term in ('T','V','t'):
+            if n_terms >= sel.sum() - 1:
+                break
+            dx = np.where(sel, x[term] - x[term][sel].mean(), 0.0)
+            if np.ptp(dx[sel]) > MIN_SPREAD[term]:
+                n_terms += 1
+                cols.append(dx)
+                columns.append((g, term))
+    return (np.array(cols).T, columns, centres)
+
+
+def Fit(y, A, V):
+    """
+    GLS estimate of b in y = A.b with cov(y) = V.
+    Returns (b, cov(b), chi-squared, dof). Raises LinAlgError if V isn't
+    positive definite or the terms can't be told apart (var(b) not > 0).
+    """
+    L = np.linalg.cholesky(V)
+    Aw = np.linalg.solve(L, A) # 'Whitened' - uncorrelated, unit variance
+    yw = np.linalg.solve(L, y)
+    b = np.linalg.lstsq(Aw, yw, rcond=None)[0]
+    cov = np.linalg.inv(Aw.T.dot(Aw))
+    if not np.all(np.isfinite(cov)) or np.any(np.diag(cov) <= 0):
+        raise np.linalg.LinAlgError('fit terms are degenerate')
+    r = yw - Aw.dot(b)
+    return (b, cov, r.dot(r), len(y) - len(b))
+
+
+def Coefficients(b, cov):
+    """
+    (R0, alpha, gamma, drift) and their covariance from one run's
+    (R0, dR/dT, dR/dV, dR/dt per day) - missing terms as 0 (with cov 0).
+    """
+    R0 = b[0]
+    x = np.array([R0, b[1]/R0, b[2]/R0, YEAR*b[3]/R0])
+    J = np.zeros((4,4)) # d(x)/d(b)
+    J[0,0] = 1
+    for i,scale in ((1,1.0), (2,1.0), (3,YEAR)):
+        J[i,0] = -scale*b[i]/R0**2
+        J[i,i] = scale/R0
+    return (x, J.dot(cov).dot(J.T))
+
+
+def JointFit(runs):
+    """
+    Fit all runs (r1kernel.QuickLook()-style dicts with per-block R, comp,
+    IDS, T, V and time_fl) in one solve. Adds 'fit' to each run: the values
+    x and covariance cov of NAMES, the mean T, V and time they refer to,
+    and the overall chi-squared and dof - or None if there's no valid fit,
+    when the reason is returned (otherwise None).
+    """
+    if len(runs) == 0:
+        return 'no runs'
+    groups = np.concatenate([np.ones(len(run['R']), dtype=int)*g for g,run in enumerate(runs)])
+    y,T,V,t = [np.concatenate([run[k] for run in runs]) for k in ('R','T','V','time_fl')]
+    A,columns,centres = Design(groups, T, V, t)
+    comp = np.vstack([run['comp'] for run in runs])
+    IDS = np.vstack([run['IDS'] for run in runs])
+    if len(y) <= len(columns):
+        reason = '%d blocks - too few for %d fit terms'%(len(y), len(columns))
+    else:
+        try:
+            b,cov,chi2,dof = Fit(y, A, Covariance(comp, IDS))
+            reason = None
+        except np.linalg.LinAlgError as msg:
+            reason = 'singular fit (%s)'%msg
+    if reason is not None:
+        for run in runs:
+            run['fit'] = None
+        return reason
+
+    full = {'T':1, 'V':2, 't':3}
+    for g,run in enumerate(runs):
+        # This run's parameters, in (R0, dR/dT, dR/dV, dR/dt) order
+        idx = [i for i,(k,term) in enumerate(columns) if k == g]
+        pos = [0 if columns[i][1] == 'R0' else full[columns[i][1]] for i in idx]
+        b_g = np.zeros(4)
+        cov_g = np.zeros((4,4))
+        b_g[pos] = b[idx]
+        cov_g[np.ix_(pos,pos)] = cov[np.ix_(idx,idx)]
+        x,cov_x = Coefficients(b_g, cov_g)
+        run['fit'] = {'x':x, 'cov':cov_x, 'fitted':[NAMES[p] for p in sorted(pos)],
+                      'T':centres[g][0], 'V':centres[g][1], 'time_fl':centres[g][2],
+                      'chi2':chi2, 'dof':dof}
+    return None
+
+
+def Describe(fit):
+    # Lines of text for a run's fit
+    u = np.sqrt(np.diag(fit['cov']))
+    lines = ['Joint fit R1(T,V,t) at T = %.3f C, V = %.5g V (chi2/dof = %.3g/%d):'%(fit['T'], fit['V'], fit['chi2'], fit['dof'])]
+    for i,name in enumerate(NAMES):
+        if name in fit['fitted']:
+            lines.append('  %-6s %-14.9g u = %.3g %s'%(name, fit['x'][i], u[i], UNITS[i]))
+        else:
+            lines.append('  %-6s (not fitted - no variation)'%name)
+    return lines
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+hrbc_cli.py - Run HRBC measurements from the command line, without wxPython.
+
+Uses the same Excel data file as the GUI: the 'Parameters' sheet for
+instrument info, the 'Data' sheet (start/stop rows in B1/B2) for an
+acquisition run or the 'Rlink' sheet for an R-link measurement.
+Progress is written to the console and to the usual log file (in the
+data-file directory). Ctrl-C aborts the run and leaves the sources safe.
+
+Examples:
+python hrbc_cli.py data.xlsx --r1 "HRBC 1G" --r2 "HRBC 1M"
+python hrbc_cli.py data.xlsx --rlink --r1 "HRBC 1G" --r2 "HRBC 1M"
+python hrbc_cli.py data.xlsx --role "DVMT1=DVM: HP34401A, s/n976" --settle 600
+python hrbc_cli.py data.xlsx --resume --r1 "HRBC 1G" --r2 "HRBC 1M"
+python hrbc_cli.py data.xlsx --dry-run --auto-range --settle 600
+python hrbc_cli.py copy.xlsx --replay HRBC_trace.bin --r1 "HRBC 1G" --r2 "HRBC 1M"
+python hrbc_cli.py data.xlsx --stream --quiet ... (as started by the GUI - see aqnproc.py)
+"""
+
+import os
+import sys
+import socket
+import argparse
+import datetime as dt
+
+import devices
+import checkpoint
+import progress
+import runconfig
+import seqplan
+import estimator
+import bustrace
+import replay
+import aqnproc
+import publish
+import metrics
+import acquisition as acq
+import RLink as rl
+
+VERSION = runconfig.VERSION
+
+
+def GetParser():
+    parser = argparse.ArgumentParser(description='HRBC v'+VERSION+': run the high resistance bridge without the GUI.')
+    parser.add_argument('xlfile', help='Excel data file')
+    parser.add_argument('--rlink', action='store_true', help='measure R-link (Rlink sheet) instead of an acquisition run (Data sheet)')
+    AddRunArguments(parser)
+    parser.add_argument('--resume', action='store_true', help='continue an unfinished run from its checkpoint')
+    parser.add_argument('--dry-run', action='store_true', help="predict the run's duration (per row and total) and exit")
+    parser.add_argument('--replay', metavar='TRACE', default=None,
+                        help='no instruments: answer them from a recorded bus trace (use a copy of the data file)')
+    parser.add_argument('--real-time', action='store_true', help='replay at the recorded speed (default: full speed)')
+    parser.add_argument('--strict', action='store_true', help='replay: stop at the first call that differs from the recording')
+    parser.add_argument('--stream', action='store_true',
+                        help='report progress to <xlfile>%s for GUI viewers (see aqnproc.py)'%aqnproc.SUFFIX)
+    parser.add_argument('--publish', nargs='?', type=int, const=publish.PORT, default=None, metavar='PORT',
+                        help='publish live run status on local port PORT (default %d) for monitors (see publish.py)'%publish.PORT)
+    parser.add_argument('--metrics-port', type=int, default=None, metavar='PORT',
+                        help='also serve metrics at http://127.0.0.1:PORT/metrics (always written to %s)'%metrics.FILENAME)
+    parser.add_argument('--quiet', action='store_true', help='no console output (log file only)')
+    return parser
+
+
+def AddRunArguments(parser):
+    # Run settings shared with runqueue.py
+    parser.add_argument('--r1', default='', help='R1 name, ending with its nominal value (e.g. "HRBC 1G")')
+    parser.add_argument('--r2', default='', help='R2 name, ending with its nominal value (e.g. "HRBC 1M")')
+    parser.add_argument('--comment', default='', help='comment written to every data row')
+    parser.add_argument('--run-id', default=None, help='run id (default: a new id from R1, R2 and the time)')
+    parser.add_argument('--settle', type=int, default=0, help='settle delay (s) before the first measurement')
+    parser.add_argument('--auto-range', action='store_true', help='set DVM12 range to V2 for V2 measurements (default: V1 range)')
+    parser.add_argument('--role', action='append', default=[], metavar='ROLE=DESCR',
+                        help='assign instrument DESCR to ROLE (default: '+', '.join(sorted(devices.DEFAULT_ROLES.keys()))+' as SetupPage AutoPopulate)')
+    parser.add_argument('--sem-ppm', type=float, default=None,
+                        help='stop V1, V2 phases once the SEM reaches this (ppm of setting); n (column C) is then the maximum')
+    parser.add_argument('--sem-vd', type=float, default=None, help='stop Vd phases once the SEM reaches this (V)')
+    parser.add_argument('--min-readings', type=int, default=runconfig.MIN_READINGS,
+                        help='minimum readings per phase when stopping on SEM (default %d)'%runconfig.MIN_READINGS)
+    parser.add_argument('--sequence', default='auto', choices=['auto']+seqplan.Names(),
+                        help='order of V1, V2, Vd phases (default: auto - least settle time; %s is the original order)'%seqplan.FIXED)
+
+
+def ParseRoles(parser, role_args):
+    roles = dict(devices.DEFAULT_ROLES)
+    for a in role_args:
+        if '=' not in a:
+            parser.error('--role must be ROLE=DESCR, not %s'%a)
+        r,d = a.split('=',1)
+        if r not in roles:
+            parser.error('Unknown role %s (expected one of %s)'%(r,', '.join(sorted(roles.keys()))))
+        roles[r] = d
+    return roles
+
+
+def OpenLog(directory):
+    # Same log file as the GUI uses
+    logname = 'HRBCv'+VERSION+'_'+str(dt.date.today())+'.log'
+    return open(os.path.join(directory, logname),'a')
+
+
+def WaitFor(thread, stream=None):
+    """
+    Wait for a run thread to finish. Ctrl-C (or an abort request from a
+    viewer of the progress stream) aborts the run (sources to standby).
+    Returns True if interrupted.
+    """
+    interrupted = False
+    while thread.is_alive():
+        try:
+            thread.join(1)
+        except KeyboardInterrupt:
+            print 'hrbc_cli.WaitFor(): Ctrl-C - aborting run...'
+            thread.abort()
+            interrupted = True
+        if stream is not None:
+            stream.Beat()
+            if stream.AbortRequested() and not interrupted:
+                print 'hrbc_cli.WaitFor(): Abort requested by viewer - aborting run...'
+                thread.abort()
+                interrupted = True
+    return interrupted
+
+
+def MakeConfig(args, xlfilename, wb, log, roles):
+    run_id = args.run_id
+    if run_id is None:
+        run_id = runconfig.NewRunId(VERSION, args.r1, args.r2)
+    return runconfig.RunConfig(xlfilename, wb, log, roles,
+                               comment = args.comment,
+                               run_id = run_id,
+                               settle_time = args.settle,
+                               auto_range = args.auto_range,
+                               R1Name = args.r1,
+                               R2Name = args.r2,
+                               sem_ppm = args.sem_ppm,
+                               sem_Vd = args.sem_vd,
+                               min_readings = args.min_readings,
+                               sequence = args.sequence)
+
+
+def DryRun(config, kind, resume):
+    # Predict run duration - no instruments needed
+    if resume is not None:
+        print checkpoint.Describe(resume)
+    if kind == 'rlink':
+        # (Resumed R-link runs are shorter - not estimated)
+        print 'R-link measurement: %s'%estimator.FormatDuration(estimator.EstimateRLink(config))
+        return
+    first_row = None
+    if resume is not None:
+        first_row = resume['next_row']
+    est,rows,plan = estimator.EstimateRun(config, first_row)
+    if first_row is None:
+        first_row = config.wb.get_sheet_by_name('Data')['B1'].value
+    for line in estimator.Report(est, rows, plan, first_row):
+        print line
+
+
+def main(argv=None):
+    parser = GetParser()
+    args = parser.parse_args(argv)
+    roles = ParseRoles(parser, args.role)
+
+    xlfilename = os.path.abspath(args.xlfile)
+    if not os.path.isfile(xlfilename):
+        parser.error('No such file: %s'%xlfilename)
+    kind = 'rlink' if args.rlink else 'run'
+    resume = None
+    if args.resume:
+        resume = checkpoint.Load(xlfilename, kind)
+        if resume is None:
+            parser.error('No %s checkpoint to resume for %s'%(kind, xlfilename))
+    if args.dry_run:
+        config = MakeConfig(args, xlfilename, runconfig.OpenWorkbook(xlfilename), None, roles)
+        DryRun(config, kind, resume)
+        return 0
+    player = None
+    if args.replay is not None:
+        if not os.path.isfile(args.replay):
+            parser.error('No such trace: %s'%args.replay)
+        player = replay.Player(args.replay, args.strict, args.real_time)
+    log = OpenLog(os.path.dirname(xlfilename))
+    if player is None:
+        bustrace.Start(os.path.dirname(xlfilename)) # Instrument bus trace, alongside the log
+    else:
+        replay.Start(player)
+        print >>log, 'hrbc_cli.main(): replaying', os.path.abspath(args.replay)
+
+    sinks = [progress.LogSink(log)]
+    if not args.quiet:
+        sinks.append(progress.ConsoleSink())
+    stream = None
+    if args.stream:
+        stream = aqnproc.StreamWriter(xlfilename + aqnproc.SUFFIX)
+        sinks.append(aqnproc.StreamSink(stream))
+    try:
+        metrics.Start(os.path.dirname(xlfilename), args.metrics_port)
+    except socket.error as msg:
+        print 'hrbc_cli.main(): Not serving metrics -',msg
+        print >>log,'hrbc_cli.main(): Not serving metrics -',msg
+    publisher = None
+    if args.publish is not None:
+        try:
+            publisher = publish.Publisher(port=args.publish)
+        except socket.error as msg:
+            print 'hrbc_cli.main(): Not publishing run status -',msg
+            print >>log,'hrbc_cli.main(): Not publishing run status -',msg
+    if publisher is not None:
+        sinks.append(publish.PublishSink(publisher))
+        bustrace.LISTENERS.append(publisher.OnBus)
+    sink = progress.TeeSink(*sinks)
+
+    try:
+        # Read parameters sheet - gather instrument info, then create and open instruments
+        wb = runconfig.OpenWorkbook(xlfilename)
+        devices.LoadInstrData(wb, log)
+        if player is None:
+            devices.CreateRoles(roles)
+        else:
+            replay.CreateRoles(roles, player)
+
+        config = MakeConfig(args, xlfilename, wb, log, roles)
+        print >>log, 'hrbc_cli.main():', config
+
+        if args.rlink:
+            thread = rl.RLThread(config, sink, resume)
+        else:
+            thread = acq.AqnThread(config, sink, resume)
+        WaitFor(thread, stream)
+    finally:
+        devices.CloseAll()
+        if stream is not None:
+            stream.Close()
+        if publisher is not None:
+            bustrace.LISTENERS.remove(publisher.OnBus)
+            publisher.Close()
+        metrics.Stop() # Final metrics file
+        if player is not None:
+            replay.Stop()
+            for line in player.Report():
+                print line
+                print >>log, line
+        log.close()
+    if thread.outcome != 'finished':
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+incremental.py - Saved HRBA state, so a re-run only processes new blocks.
+
+After each full analysis HRBA saves what it needs to carry on where it
+left off: the resistor and instrument parameters, Rd, each block's R1,
+T and V (with the Results-sheet row it was written to, and the labels
+and values of the parameters it depends on) and the next Data and
+Results rows. Uncertain numbers go into a GTC archive, so their
+correlations survive (blocks share Rd, corrections, R2's parameters...);
+everything else into a pickle. Both live in a sidecar directory next to
+the workbook ('<workbook>.hrba'), one pair of files per run id.
+
+An incremental re-run then picks up the saved state, analyses only the
+blocks appended since, and refits the whole run. The state is not used
+if the Parameters sheet has changed, the Results sheet has been written
+since, or it was saved by a different version of HRBA (or this file).
+"""
+
+import os
+import re
+import cPickle
+
+import GTC
+
+VERSION = 2 # Format of saved state
+SUFFIX = '.hrba'
+
+
+class Ref(str):
+    # Name of an archived ureal, in place of the ureal itself
+    pass
+
+
+class Exact(tuple):
+    # (value, dof, label) of a ureal with no uncertainty - not archived, so its label is kept
+    pass
+
+
+def IsUreal(x):
+    return all([hasattr(x, a) for a in ('x', 'u', 'df', 'label')])
+
+
+def Path(xlfile, Run_Id, ext):
+    # Sidecar file for a run - also used by resultcache.py
+    name = re.sub('[^A-Za-z0-9.-]+', '_', str(Run_Id))
+    return os.path.join(xlfile + SUFFIX, name + ext)
+
+
+def Files(xlfile, Run_Id, kind=''):
+    # (archive, record) file names for a run - kind distinguishes other saved things (e.g. '.rd')
+    return (Path(xlfile, Run_Id, kind + '.gar'), Path(xlfile, Run_Id, kind + '.pkl'))
+
+
+def Flatten(x, ureals, names=None):
+    # Copy of x (nested dicts/lists) with each ureal replaced by a Ref - ureals collected in dict ureals
+    if names is None:
+        names = {} # id(ureal): name - the same ureal may turn up in several places
+    if isinstance(x, dict):
+        return dict([(k, Flatten(v, ureals, names)) for k,v in x.items()])
+    if isinstance(x, (list, tuple)):
+        return type(x)([Flatten(v, ureals, names) for v in x])
+    if IsUreal(x):
+        if x.u == 0:
+            return Exact((x.x, x.df, x.label))
+        if id(x) not in names:
+            names[id(x)] = 'u%d'%len(ureals)
+            ureals[names[id(x)]] = x
+        return Ref(names[id(x)])
+    return x
+
+
+def Unflatten(x, ureals):
+    # Inverse of Flatten()
+    if isinstance(x, Exact):
+        return GTC.ureal(x[0], 0, x[1], x[2])
+    if isinstance(x, dict):
+        return dict([(k, Unflatten(v, ureals)) for k,v in x.items()])
+    if isinstance(x, (list, tuple)):
+        return type(x)([Unflatten(v, ureals) for v in x])
+    if isinstance(x, Ref):
+        return ureals[x]
+    return x
+
+
+def Save(xlfile, Run_Id, state, kind=''):
+    """
+    Save state (a dict, possibly nested, of ureals and plain data) for
+    run Run_Id of workbook xlfile.
+    """
+    gar,pkl = Files(xlfile, Run_Id, kind)
+    if not os.path.isdir(os.path.dirname(gar)):
+        os.makedirs(os.path.dirname(gar))
+    ureals = {}
+    record = Flatten(state, ureals)
+    archive = GTC.ar.Archive()
+    archive.add(**dict([(name, GTC.ar.result(un)) for name,un in ureals.items()])) # Intermediates must be declared
+    with open(gar, 'wb') as f:
+        GTC.ar.dump(f, archive)
+    with open(pkl, 'wb') as f:
+        cPickle.dump({'version':VERSION, 'names':sorted(ureals.keys()), 'state':record}, f, 2)
+
+
+def Records(xlfile):
+    """
+    Saved states of every run of workbook xlfile, as saved - ureals are
+    not restored (just Refs), so this is a quick way to find the runs
+    worth loading.
+    """
+    records = []
+    sidecar = xlfile + SUFFIX
+    if not os.path.isdir(sidecar):
+        return records
+    for name in sorted(os.listdir(sidecar)):
+        if not name.endswith('.pkl'):
+            continue
+        with open(os.path.join(sidecar, name), 'rb') as f:
+            record = cPickle.load(f)
+        if record['version'] == VERSION and 'Run_Id' in record['state']: # Not some other kind of saved thing
+            records.append(record['state'])
+    return records
+
+
+def Load(xlfile, Run_Id, kind=''):
+    """
+    Saved state for run Run_Id of workbook xlfile (with its ureals
+    restored), or None if there isn't any.
+    """
+    gar,pkl = Files(xlfile, Run_Id, kind)
+    if not (os.path.isfile(gar) and os.path.isfile(pkl)):
+        return None
+    with open(pkl, 'rb') as f:
+        record = cPickle.load(f)
+    if record['version'] != VERSION:
+        return None
+    with open(gar, 'rb') as f:
+        archive = GTC.ar.load(f)
+    ureals = dict([(name, archive.extract(name)) for name in record['names']])
+    return Unflatten(record['state'], ureals)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+liveanalysis.py - R1 estimates while a run is still measuring.
+
+As each 4-row block of a run is completed (and written to the Data
+sheet), R1 and its standard uncertainty are calculated for it, as HRBA
+would (r1kernel.py), and a joint fit of all the run's blocks so far to T,
+V and t (glsfit.py) gives a running estimate of R1 at the run's mean
+conditions, once there are enough blocks for the fit to have dof > 0.
+Both are reported through the run's progress sink
+(ProgressSink.LiveR1()), so a run that's going wrong can be stopped
+early.
+
+Resistor and instrument parameters and Rd are read once, at the start
+of the run - from HRBA's saved state for this run id if there is any
+(see incremental.py), otherwise from the Parameters and Rlink sheets.
+If they can't be found (e.g. no Rlink data yet, or an unknown R2) the
+run just goes ahead without live analysis.
+
+This module must not import wx.
+"""
+
+import time
+import traceback
+
+import R_info
+import r1kernel
+import glsfit
+import incremental
+
+
+class LiveAnalysis():
+    """
+    Live R1 estimates for one run (run_id) on the Data sheet of workbook
+    wb (file xlfilename), starting at start_row. Call Row() for each row
+    as soon as it's written.
+    """
+    def __init__(self, wb, xlfilename, run_id, start_row, comment, sink, log):
+        self.ws = wb.get_sheet_by_name('Data')
+        self.start_row = start_row
+        self.sink = sink
+        self.log = log
+        self.ok = False
+        try:
+            self.R1_name,self.R2_name = R_info.ExtractNames(comment)
+            self.role_descr = R_info.GetRoles(self.ws, start_row)
+            state = incremental.Load(xlfilename, run_id)
+            if state is not None:
+                self.I_INFO,self.R_INFO,self.Rd = state['I_INFO'],state['R_INFO'],state['Rd']
+            else:
+                self.I_INFO,self.R_INFO = R_info.ReadParams(wb.get_sheet_by_name('Parameters'), log)[:2]
+                self.Rd = R_info.StoredRd(xlfilename, wb.get_sheet_by_name('Rlink'), run_id, log)[0]
+            assert self.R2_name in self.R_INFO,'Unknown Rs: '+self.R2_name
+            self.ok = True
+        except Exception as msg:
+            print'LiveAnalysis: No live analysis for this run -',msg
+            print >>log,'LiveAnalysis: No live analysis for this run -',msg
+
+    def Row(self, row):
+        # Row written - analyse the run so far if it completes a block
+        if not self.ok or (row - self.start_row)%4 != 3:
+            return
+        try:
+            self.Analyse(row)
+        except Exception as msg:
+            print'LiveAnalysis.Row(): Analysis of row',row,'failed -',msg
+            traceback.print_exc(file=self.log)
+
+    def Analyse(self, stop_row):
+        # R1 for every complete block so far, and the running fit
+        t0 = time.time()
+        X,U,DF,IDS,run = r1kernel.RunInputs(self.ws, self.start_row, stop_row, self.I_INFO, self.R_INFO,
+                                            self.role_descr, self.R2_name, self.Rd)
+        run['IDS'] = IDS
+        run['R'],run['u'],run['df'],run['comp'] = r1kernel.Propagate(X, U, DF)
+        no_fit = glsfit.JointFit([run])
+        if no_fit is None:
+            R0,u0 = float(run['fit']['x'][0]),float(run['fit']['cov'][0,0]**0.5)
+            fit_msg = 'fit R1 = %.10g, u = %.3g'%(R0, u0)
+        else:
+            R0,u0 = None,None # Just this block's R1 until the fit has dof > 0
+            fit_msg = 'no fit - '+no_fit
+        print >>self.log,'LiveAnalysis: Row %d: R1 = %.10g, u = %.3g (dof %.1f); %s (%d blocks, %.3f s)'%(
+            stop_row, run['R'][-1], run['u'][-1], run['df'][-1], fit_msg, len(run['R']), time.time() - t0)
+        self.sink.LiveR1(r=stop_row, R1=float(run['R'][-1]), u=float(run['u'][-1]),
+                         R0=R0, u0=u0, n=len(run['R']))
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+metrics.py - Counters, gauges and timings for acquisition and analysis,
+in Prometheus text format.
+
+Instrumented code calls Inc(), Set() or Observe() (cheap - a lock and
+a dict update); nothing is written unless exporting has been started:
+* Start(directory) re-writes <directory>/HRBC_metrics.prom (or another
+  filename - the GUI uses HRBC_GUI_metrics.prom) every
+  WRITE_INTERVAL s (atomically - e.g. for the node_exporter textfile
+  collector, or just to read after the event),
+* Start(port=PORT) also serves the metrics at http://127.0.0.1:PORT/metrics.
+
+What's measured (see DEFS):
+* rows (and R-link reversals) done, rows per hour, time per row,
+* time per run-budget category - settle, delays, range changes and each
+  phase's readings (estimator.Budget),
+* instrument call latency and errors per role and method (all traced
+  calls - see bustrace.LISTENERS),
+* Excel workbook save time,
+* instrument-executor queue depth and pending GUI events,
+* HRBA stage durations.
+Summaries give count, sum and quantiles of the last WINDOW samples.
+
+This module must not import wx.
+"""
+
+import os
+import time
+import threading
+import collections
+import BaseHTTPServer
+
+import bustrace
+
+FILENAME = 'HRBC_metrics.prom'
+GUI_FILENAME = 'HRBC_GUI_metrics.prom' # GUI process (runs may be in another process)
+HRBA_FILENAME = 'HRBA_metrics.prom'
+PORT = 50522
+WRITE_INTERVAL = 15.0 # s
+WINDOW = 1000 # Samples kept per summary, for quantiles
+QUANTILES = (0.5, 0.9, 0.99)
+
+# name: (type, help)
+DEFS = collections.OrderedDict([
+    ('hrbc_rows_total', ('counter', 'Data rows completed')),
+    ('hrbc_rows_per_hour', ('gauge', 'Data rows completed per hour in the current run')),
+    ('hrbc_row_seconds', ('summary', 'Time to measure one data row')),
+    ('hrbc_reversals_total', ('counter', 'R-link reversals completed')),
+    ('hrbc_reversal_seconds', ('summary', 'Time to measure one R-link reversal')),
+    ('hrbc_phase_seconds', ('summary', 'Time per run-budget category (settle, delays, V1/V2/Vd readings, ...)')),
+    ('hrbc_instrument_call_seconds', ('summary', 'Instrument call latency by role and method')),
+    ('hrbc_instrument_errors_total', ('counter', 'Instrument calls that raised an error, by role and method')),
+    ('hrbc_workbook_save_seconds', ('summary', 'Excel workbook save time')),
+    ('hrbc_executor_queue_depth', ('gauge', 'Commands waiting for the instrument executor')),
+    ('hrbc_gui_events_pending', ('gauge', 'Events waiting on the GUI event bus')),
+    ('hrba_stage_seconds', ('gauge', 'Duration of each HRBA stage in the last analysis')),
+])
+
+
+class Samples():
+    """
+    Summary data: count and sum of all samples, and the last WINDOW samples.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.recent = collections.deque(maxlen=WINDOW)
+
+    def Add(self, x):
+        self.count += 1
+        self.total += x
+        self.recent.append(x)
+
+    def Quantile(self, q):
+        x = sorted(self.recent)
+        return x[min(len(x)-1, int(q*len(x)))]
+
+
+class Registry():
+    """
+    Current values of all metrics, keyed by (name, labels). Thread-safe.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def Key(self, name, labels):
+        assert name in DEFS,'Unknown metric: %s'%name
+        return (name, tuple(sorted(labels.items())))
+
+    def Inc(self, name, value=1, **labels):
+        key = self.Key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def Set(self, name, value, **labels):
+        key = self.Key(name, labels)
+        with self.lock:
+            self.values[key] = value
+
+    def Observe(self, name, value, **labels):
+        key = self.Key(name, labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = Samples()
+            self.values[key].Add(value)
+
+    def Text(self):
+        # Prometheus text exposition format
+        lines = []
+        with self.lock:
+            for name,(kind,text) in DEFS.items():
+                keys = sorted([k for k in self.values.keys() if k[0] == name])
+                if len(keys) == 0:
+                    continue
+                lines.append('# HELP %s %s'%(name, text))
+                lines.append('# TYPE %s %s'%(name, kind))
+                for k in keys:
+                    v = self.values[k]
+                    labels = k[1]
+                    if isinstance(v, Samples):
+                        for q in QUANTILES:
+                            lines.append('%s%s %r'%(name, Labels(labels + (('quantile',q),)), v.Quantile(q)))
+                        lines.append('%s_sum%s %r'%(name, Labels(labels), v.total))
+                        lines.append('%s_count%s %d'%(name, Labels(labels), v.count))
+                    else:
+                        lines.append('%s%s %r'%(name, Labels(labels), float(v)))
+        return '\n'.join(lines) + '\n'
+
+
+def Labels(labels):
+    # {k="v",...} (or '' for none)
+    if len(labels) == 0:
+        return ''
+    esc = lambda v: str(v).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+    return '{' + ','.join(['%s="%s"'%(k, esc(v)) for k,v in labels]) + '}'
+
+
+REGISTRY = Registry()
+
+
+def Inc(name, value=1, **labels):
+    REGISTRY.Inc(name, value, **labels)
+
+
+def Set(name, value, **labels):
+    REGISTRY.Set(name, value, **labels)
+
+
+def Observe(name, value, **labels):
+    REGISTRY.Observe(name, value, **labels)
+
+
+def Text():
+    return REGISTRY.Text()
+
+
+class Timed():
+    """
+    with Timed(name, **labels): ... - observes the time the block takes.
+    """
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.t = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        Observe(self.name, time.time() - self.t, **self.labels)
+        return False
+
+
+class Stopwatch():
+    """
+    Times consecutive stages: Lap(stage) records the time since the last Lap().
+    """
+    def __init__(self, name):
+        self.name = name
+        self.t = time.time()
+
+    def Lap(self, stage):
+        now = time.time()
+        Set(self.name, now - self.t, stage=stage)
+        self.t = now
+
+
+def OnBus(role, method, args, reply, t0, t1, demo, exc=None):
+    # bustrace listener: instrument call latency and errors
+    if demo:
+        return # No bus
+    Observe('hrbc_instrument_call_seconds', t1 - t0, role=role, method=method)
+    if exc is not None:
+        Inc('hrbc_instrument_errors_total', role=role, method=method)
+
+
+def WriteFile(filename):
+    # New file, then replace the old one - readers never see half a file
+    tmp = filename + '.tmp'
+    with open(tmp,'w') as f:
+        f.write(Text())
+    if os.path.exists(filename):
+        os.remove(filename) # os.rename() won't replace a file on Windows
+    os.rename(tmp, filename)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = Text()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Not to the console
+
+
+class Exporter(threading.Thread):
+    """
+    Writes the metrics file every WRITE_INTERVAL s (and on Stop()).
+    """
+    def __init__(self, filename):
+        threading.Thread.__init__(self, name='MetricsExporter')
+        self.daemon = True
+        self.filename = filename
+        self._want_stop = threading.Event()
+        self.start()
+
+    def Write(self):
+        try:
+            WriteFile(self.filename)
+        except EnvironmentError as msg:
+            print'metrics.Exporter: Write failed:',msg
+
+    def run(self):
+        while not self._want_stop.wait(WRITE_INTERVAL):
+            self.Write()
+        self.Write()
+
+    def Stop(self):
+        self._want_stop.set()
+        self.join(5)
+
+
+EXPORTER = None
+SERVER = None
+
+
+def Start(directory=None, port=None, filename=FILENAME):
+    """
+    Export to <directory>/<filename> and / or serve on 127.0.0.1:port.
+    Also starts collecting instrument-call metrics.
+    """
+    global EXPORTER, SERVER
+    if OnBus not in bustrace.LISTENERS:
+        bustrace.LISTENERS.append(OnBus)
+    filename = os.path.join(directory, filename) if directory is not None else None
+    if EXPORTER is not None and EXPORTER.filename != filename:
+        EXPORTER.Stop()
+        EXPORTER = None
+    if filename is not None and EXPORTER is None:
+        EXPORTER = Exporter(filename)
+    if port is not None and SERVER is None:
+        SERVER = BaseHTTPServer.HTTPServer(('127.0.0.1', port), Handler) # socket.error if in use
+        t = threading.Thread(target=SERVER.serve_forever, name='MetricsServer')
+        t.daemon = True
+        t.start()
+        print'metrics.Start(): Serving http://127.0.0.1:%d/metrics'%port
+
+
+def Stop():
+    # Final file write, then stop exporting
+    global EXPORTER, SERVER
+    if OnBus in bustrace.LISTENERS:
+        bustrace.LISTENERS.remove(OnBus)
+    if EXPORTER is not None:
+        EXPORTER.Stop()
+        EXPORTER = None
+    if SERVER is not None:
+        SERVER.shutdown()
+        SERVER.server_close()
+        SERVER = None
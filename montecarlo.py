@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+montecarlo.py - Monte Carlo uncertainty propagation for HRBA.
+
+An alternative to GTC's first-order (linear) propagation: every input
+quantity of r1kernel's R1 model is drawn TRIALS times as a NumPy array
+and the model is evaluated for all draws of all blocks in one batched
+pass (GUM Supplement 1). Inputs with finite degrees of freedom are drawn
+from scaled and shifted t-distributions, the rest from Gaussians. A
+quantity used in several blocks (a correction, R2's parameters, Rd) gets
+the same draw in each of them, so correlations between blocks are kept.
+
+Draws are made in chunks of at most MAX_ELEMENTS numbers, each with its
+own seed, so results are repeatable - and don't depend on how the chunks
+are shared among worker processes. Workers are separate python processes
+running this file (HRBA is a plain script, which multiprocessing would
+re-run in each worker on Windows).
+
+Summary() gives the mean, standard deviation and probabilistically
+symmetric coverage interval of each block's R1.
+"""
+
+import os
+import sys
+import cPickle
+import subprocess
+import numpy as np
+
+import r1kernel
+
+TRIALS = 100000
+P = 0.95 # Coverage probability
+SEED = 1
+MAX_ELEMENTS = 2e7 # Input draws held at once, per process (x 8 bytes)
+
+
+def Standard(df, m, rs):
+    # m draws of t(df) - or N(0,1) where df is inf - for each df
+    z = rs.standard_normal((m, len(df)))
+    t = np.isfinite(df)
+    if t.any():
+        z[:,t] = rs.standard_t(df[t], size=(m, t.sum()))
+    return z
+
+
+def Draws(X, U, DF, IDS, m, rs):
+    """
+    m draws of every input (m x blocks x INPUTS), for values X, std
+    uncerts U, dofs DF and quantity ids IDS (see r1kernel.RunInputs()).
+    """
+    D = np.empty((m,) + X.shape)
+    D[:] = X
+    own = -1 - np.arange(X.shape[0]) # Keys of quantities used in one block only
+    for j in range(X.shape[1]):
+        if not U[:,j].any():
+            continue # Exact
+        keys = np.where(IDS[:,j] < 0, own, IDS[:,j])
+        first,inverse = np.unique(keys, return_index=True, return_inverse=True)[1:]
+        z = Standard(DF[first,j], m, rs)*U[first,j]
+        D[:,:,j] += z[:,inverse]
+    return D
+
+
+def Chunk(X, U, DF, IDS, m, seed, i):
+    # R1 for m trials (m x blocks) - chunk i
+    rs = np.random.RandomState([seed, i])
+    return r1kernel.Evaluate(Draws(X, U, DF, IDS, m, rs))
+
+
+def Chunks(X, n):
+    # [(chunk, trials),...] for n trials
+    size = max(1, int(MAX_ELEMENTS/X.size))
+    return [(i, min(size, n - i*size)) for i in range((n + size - 1)/size)]
+
+
+def Run(X, U, DF, IDS, n=TRIALS, seed=SEED, processes=1):
+    """
+    n trials of R1 (n x blocks), using this process or a pool of processes.
+    """
+    chunks = Chunks(X, n)
+    if processes <= 1 or len(chunks) == 1:
+        return np.vstack([Chunk(X, U, DF, IDS, m, seed, i) for i,m in chunks])
+
+    # Share chunks round-robin among workers
+    script = os.path.abspath(__file__).replace('.pyc', '.py')
+    workers = []
+    for k in range(min(processes, len(chunks))):
+        p = subprocess.Popen([sys.executable, script, '--worker'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        p.stdin.write(cPickle.dumps((X, U, DF, IDS, seed, chunks[k::processes]), 2))
+        p.stdin.close()
+        workers.append(p)
+    results = []
+    for p in workers:
+        results.append(cPickle.loads(p.stdout.read()))
+        assert p.wait() == 0,'montecarlo.Run(): Worker process failed!'
+    R1 = [None]*len(chunks)
+    for k,result in enumerate(results):
+        for (i,m),r in zip(chunks[k::processes], result):
+            R1[i] = r
+    return np.vstack(R1)
+
+
+def Summary(R1, p=P):
+    """
+    Mean, std u and coverage interval (probability p) of each block's trials.
+    """
+    low,high = np.percentile(R1, [50*(1 - p), 50*(1 + p)], axis=0)
+    return {'mean':R1.mean(axis=0), 'u':R1.std(axis=0, ddof=1), 'low':low, 'high':high,
+            'trials':len(R1), 'p':p}
+
+
+def AddToRuns(runs, n=TRIALS, processes=1):
+    # Monte Carlo results ('mc') for r1kernel.QuickLook() runs - all blocks in one go
+    if len(runs) == 0:
+        return
+    X,U,DF,IDS = [np.vstack([run[k] for run in runs]) for k in ('X','U','DF','IDS')]
+    mc = Summary(Run(X, U, DF, IDS, n, processes=processes))
+    i = 0
+    for run in runs:
+        k = len(run['X'])
+        run['mc'] = dict([(name, v[i:i+k]) if isinstance(v, np.ndarray) else (name, v) for name,v in mc.items()])
+        i += k
+
+
+def Worker():
+    # Worker process: inputs and chunk list from stdin, R1 trials to stdout
+    if sys.platform == 'win32':
+        import msvcrt
+        msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
+        msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+    X,U,DF,IDS,seed,chunks = cPickle.load(sys.stdin)
+    cPickle.dump([Chunk(X, U, DF, IDS, m, seed, i) for i,m in chunks], sys.stdout, 2)
+    sys.stdout.flush()
+
+
+if __name__ == '__main__' and '--worker' in sys.argv:
+    Worker()
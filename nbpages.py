@@ -18,20 +18,31 @@ import time
 import matplotlib
 matplotlib.use('WXAgg') # Agg renderer for drawing on a wx canvas
 from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as FigureCanvas
-#from matplotlib.backends.backend_wx import NavigationToolbar2Wx
+from matplotlib.backends.backend_wx import NavigationToolbar2Wx
 from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import matplotlib.ticker as mtick
-from openpyxl import load_workbook, cell
 
 import HighRes_events as evts
 import acquisition as acq
 import RLink as rl
 import devices
+import plot_history
+import progress
+import runconfig
+import checkpoint
+import estimator
+import bustrace
+import aqnproc
+import metrics
 
 matplotlib.rc('lines', linewidth=1, color='blue')
 
+PLOT_MAX_FPS = 2 # Max. PlotPage redraw rate (Hz)
+HISTORY_FILE = 'HRBC_history.npz' # HistoryPage data, saved in the data directory
+STREAM_POLL = 200 # ms between polls of a run process's progress stream
+
 #os.environ['XLPATH'] = 'C:\Documents and Settings\\t.lawson\My Documents\Python Scripts\High_Res_Bridge'
 '''
 ------------------------
@@ -45,6 +56,7 @@ class SetupPage(wx.Panel):
         
         # Event bindings
         self.Bind(evts.EVT_FILEPATH, self.UpdateFilepath)
+        self.Bind(evts.EVT_SBCONF, self.UpdateSwitchbox)
 
         self.status = self.GetTopLevelParent().sb
 
@@ -313,57 +325,23 @@ class SetupPage(wx.Panel):
         logname = 'HRBCv'+str(e.v)+'_'+str(dt.date.today())+'.log'
         logfile = os.path.join(e.d, logname)
         self.log = open(logfile,'a')
+        bustrace.Start(e.d) # Instrument bus trace, alongside the log
+        metrics.Start(e.d, filename=metrics.GUI_FILENAME)
         
         # Read parameters sheet - gather instrument info:
-        self.wb = load_workbook(self.XLFile.GetValue(),data_only = True) # Need cell VALUE, not FORMULA, so set data_only = True
-        self.ws_params = self.wb.get_sheet_by_name('Parameters')
-        
-        headings = (None, u'description',u'Instrument Info:',u'parameter',u'value',u'uncert',u'dof',u'label')
-        
-        # Determine colummn indices from column letters:
-        col_I = cell.cell.column_index_from_string('I') - 1
-        col_J = cell.cell.column_index_from_string('J') - 1
-        col_K = cell.cell.column_index_from_string('K') - 1
-        col_L = cell.cell.column_index_from_string('L') - 1
-        col_M = cell.cell.column_index_from_string('M') - 1
-        col_N = cell.cell.column_index_from_string('N') - 1
-
-        params = []
-        values = []
-        
-        for r in self.ws_params.rows: # a tuple of row objects
-            descr = r[col_I].value # cell.value
-            param = r[col_J].value # cell.value
-            v_u_d_l = [r[col_K].value, r[col_L].value, r[col_M].value, r[col_N].value] # value,uncert,dof,label
-        
-            if descr in headings and param in headings:
-                continue # Skip this row
-            else: # not header
-                params.append(param)
-                if v_u_d_l[1] is None: # single-valued (no uncert)
-                    values.append(v_u_d_l[0]) # append value as next item
-                    print descr,' : ',param,' = ',v_u_d_l[0]
-                    print >>self.log, descr,' : ',param,' = ',v_u_d_l[0]
-                else: # multi-valued
-                    while v_u_d_l[-1] is None: # remove empty cells
-                        del v_u_d_l[-1] # v_u_d_l.pop()
-                    values.append(v_u_d_l) # append value-list as next item 
-                    print descr,' : ',param,' = ',v_u_d_l
-                    print >>self.log, descr,' : ',param,' = ',v_u_d_l # self.log.write(logline)
-                
-                if param == u'test': # last parameter for this description
-                    devices.DESCR.append(descr) # build description list
-                    devices.sublist.append(dict(zip(params,values))) # adds parameter dictionary to sublist
-                    del params[:]
-                    del values[:] 
-
-        print '----END OF PARAMETER LIST----' 
-        print >>self.log, '----END OF PARAMETER LIST----'
-        
-        # Compile into a dictionary that lives in devices.py...  
-        devices.INSTR_DATA = dict(zip(devices.DESCR,devices.sublist))
+        self.wb = runconfig.OpenWorkbook(self.XLFile.GetValue()) # Need cell VALUE, not FORMULA (data_only = True)
+        devices.LoadInstrData(self.wb, self.log) # Compile into a dictionary that lives in devices.py
         self.BuildComboChoices()
 
+        # Restore run-history plots saved with this data
+        self.GetParent().GetPage(3).SetFile(os.path.join(e.d, HISTORY_FILE))
+
+        # How long will a run of these rows take?
+        self.GetParent().GetPage(1).ShowEstimate()
+
+        # Already being measured by a run process (GUI closed and re-opened)?
+        self.GetParent().GetPage(1).FollowRunning()
+
 
     def OnAutoPop(self, e):
         '''
@@ -371,16 +349,7 @@ class SetupPage(wx.Panel):
         Choose from instrument descriptions listed in devices.DESCR
         (Uses address assignments in devices.INSTR_DATA)
         '''
-        self.instrument_choice = {'SRC1':'SRC: D4808',
-                                  'SRC2':'SRC: F5520A',
-                                  'DVM12':'DVM: HP3458A, s/n452',
-                                  'DVMd':'DVM: HP3458A, s/n230',
-                                  'DVMT1':'none',#'DVM: HP34401A, s/n976'
-                                  'DVMT2':'none',#'DVM: HP34420A, s/n130'
-                                  'GMH1':'GMH: s/n627',
-                                  'GMH2':'GMH: s/n628',
-                                  'GMHroom':'GMH: s/n367',
-                                  'switchbox':'V1'}
+        self.instrument_choice = dict(devices.DEFAULT_ROLES)
         for r in self.instrument_choice.keys():
             d = self.instrument_choice[r]
             devices.ROLES_WIDGETS[r]['icb'].SetValue(d) # Update i_cb
@@ -406,15 +375,7 @@ class SetupPage(wx.Panel):
         # Create each instrument in software & open visa session (for GPIB instruments)
         # For GMH instruments, use GMH dll not visa
 
-        if 'GMH' in r: # Changed from d to r
-            # create and open a GMH instrument instance
-            print'\nnbpages.SetupPage.CreateInstr(): Creating GMH device (%s -> %s).'%(d,r)
-            devices.ROLES_INSTR.update({r:devices.GMH_Sensor(d)})
-        else:
-            # create a visa instrument instance
-            print'\nnbpages.SetupPage.CreateInstr(): Creating VISA device (%s -> %s).'%(d,r)
-            devices.ROLES_INSTR.update({r:devices.instrument(d)})
-            devices.ROLES_INSTR[r].Open()
+        devices.CreateInstr(d,r) # VISA instruments are opened by the instrument executor, not the GUI thread
         self.SetInstr(d,r)
 
 
@@ -468,18 +429,40 @@ class SetupPage(wx.Panel):
         assert devices.INSTR_DATA[d].has_key('test'), 'No test exists for this device.'
         test = devices.INSTR_DATA[d]['test'] # test string
         print '\tTest string:',test
-        self.Response.SetValue(str(devices.ROLES_INSTR[r].Test(test)))
+        self.Response.SetValue('')
         self.status.SetStatusText('Testing %s with cmd %s' % (d,test),0)
+        # Don't wait for the reply here - display it when the executor has it
+        reply = devices.Submit(r,'Test',test)
+        reply.OnDone(lambda f: wx.CallAfter(self.ShowResponse,f))
+
+
+    def ShowResponse(self, f):
+        # Called (in the GUI thread) with a completed devices.CmdFuture
+        try:
+            self.Response.SetValue(str(f.Result()))
+        except Exception as e:
+            self.Response.SetValue('Test failed: '+str(e))
 
 
     def OnSwitchTest(self, e):
         resource = self.SwitchboxAddr.GetValue()
         config = str(devices.SWITCH_CONFIGS[self.Switchbox.GetValue()])
+        reply = devices.GetExecutor().Submit(self.SwitchTest,resource,config)
+        reply.OnDone(lambda f: wx.CallAfter(self.ShowResponse,f))
+
+    def SwitchTest(self,resource,config):
+        # Executed by the instrument executor
         try:
             instr = devices.RM.open_resource(resource)
             instr.write(config)
         except devices.visa.VisaIOError:
-            self.Response.SetValue('Couldn\'t open visa resource for switchbox!')
+            return 'Couldn\'t open visa resource for switchbox!'
+        return 'Switchbox set to '+config
+
+
+    def UpdateSwitchbox(self, e):
+        # Triggered by an 'update switchbox config' event
+        self.Switchbox.SetValue(e.conf)
 
 
     def BuildCommStr(self,e):
@@ -502,7 +485,7 @@ class SetupPage(wx.Panel):
 
 
     def OnVisaList(self, e):
-        res_list = devices.RM.list_resources()
+        res_list = devices.GetExecutor().Submit(devices.RM.list_resources).Result()
         del self.ResourceList[:] # list of COM ports ('COM X') & GPIB addresses
         del self.ComList[:] # list of COM ports (numbers only)
         del self.GPIBList[:] # list of GPIB addresses (numbers only)
@@ -553,9 +536,17 @@ class RunPage(wx.Panel):
         self.Bind(evts.EVT_DELAYS, self.UpdateDels)
         self.Bind(evts.EVT_START_ROW, self.UpdateStartRow)
         self.Bind(evts.EVT_STOP_ROW, self.UpdateStopRow)
+        self.Bind(evts.EVT_SRC_V, self.UpdateSrcV)
+        self.Bind(evts.EVT_LIVE_R1, self.UpdateLiveR1)
 
         self.RunThread = None
         self.RLinkThread = None
+        self.Stream = None # Progress stream of a run process (see aqnproc.py)
+        self.Proc = None # Run process started by this GUI
+        self.ProcRoles = {}
+        self.StreamTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnStreamTimer, self.StreamTimer)
+        self.src_V = {'SRC1':0,'SRC2':0} # Last voltages sent to sources
 
         # Comment widgets
         CommentLbl = wx.StaticText(self,id = wx.ID_ANY, label = 'Comment:')
@@ -579,8 +570,8 @@ class RunPage(wx.Panel):
         self.V2Setting = NumCtrl(self, id = wx.ID_ANY, integerWidth=3, fractionWidth=8, groupDigits=True)
         self.V2Setting.Bind(wx.lib.masked.EVT_NUM , self.OnV2Set)
 
-        ZeroVoltsBtn = wx.Button(self, id = wx.ID_ANY, label='Set zero volts')
-        ZeroVoltsBtn.Bind(wx.EVT_BUTTON, self.OnZeroVolts)
+        self.ZeroVoltsBtn = wx.Button(self, id = wx.ID_ANY, label='Set zero volts')
+        self.ZeroVoltsBtn.Bind(wx.EVT_BUTTON, self.OnZeroVolts)
         
         self.RangeTBtn = wx.ToggleButton(self,id = wx.ID_ANY,label='DVM12 Range mode')
         self.RangeTBtn.Bind(wx.EVT_TOGGLEBUTTON,self.OnRangeMode)
@@ -620,11 +611,20 @@ class RunPage(wx.Panel):
         self.StopBtn.Bind(wx.EVT_BUTTON, self.OnAbort)
         self.StopBtn.Enable(False)
         self.RLinkBtn = wx.Button(self, id = wx.ID_ANY, label='Measure R-link')
+        self.SeparateProc = wx.CheckBox(self, id = wx.ID_ANY, label='Run in separate process')
+        self.SeparateProc.SetValue(True)
+        proctip = 'Measure in a separate process - the GUI only watches, and can be closed and re-opened during a run.'
+        self.SeparateProc.SetToolTipString(proctip)
         self.RLinkBtn.Bind(wx.EVT_BUTTON, self.OnRLink)
         
         ProgressLbl = wx.StaticText(self,id = wx.ID_ANY, style=wx.ALIGN_RIGHT, label = 'Run progress:')
         self.Progress = wx.Gauge(self,id = wx.ID_ANY,range=100, name='Progress')
 
+        LiveR1Lbl = wx.StaticText(self,id = wx.ID_ANY, style=wx.ALIGN_RIGHT, label = 'R1 so far:')
+        self.LiveR1 = wx.TextCtrl(self, id = wx.ID_ANY, style = wx.TE_READONLY)
+        livetip = 'Estimated as each 4-row block is completed - last block, and a fit of all blocks so far (see liveanalysis.py).'
+        self.LiveR1.SetToolTipString(livetip)
+
         gbSizer = wx.GridBagSizer()
 
         # Comment widgets
@@ -635,7 +635,7 @@ class RunPage(wx.Panel):
         #gbSizer.Add(self.h_sep1, pos=(2,0), span=(1,5), flag=wx.ALL|wx.EXPAND, border=5)
 
         # Voltage source widgets
-        gbSizer.Add(ZeroVoltsBtn, pos=(2,0), span=(1,1), flag=wx.ALL|wx.EXPAND, border=5)
+        gbSizer.Add(self.ZeroVoltsBtn, pos=(2,0), span=(1,1), flag=wx.ALL|wx.EXPAND, border=5)
         gbSizer.Add(V1SrcLbl,pos=(2,1), span=(1,1), flag=wx.ALL|wx.EXPAND, border=5)
         gbSizer.Add(self.V1Setting,pos=(2,2), span=(1,1), flag=wx.ALL|wx.EXPAND, border=5)
         gbSizer.Add(V2SrcLbl,pos=(2,3), span=(1,1), flag=wx.ALL|wx.EXPAND, border=5)
@@ -675,6 +675,9 @@ class RunPage(wx.Panel):
         gbSizer.Add(self.StopBtn, pos=(7,2), span=(1,1), flag=wx.ALL|wx.EXPAND, border=5)
         gbSizer.Add(ProgressLbl, pos=(7,3), span=(1,1), flag=wx.ALL|wx.EXPAND, border=5)
         gbSizer.Add(self.Progress, pos=(7,4), span=(1,3), flag=wx.ALL|wx.EXPAND, border=5)
+        gbSizer.Add(self.SeparateProc, pos=(8,1), span=(1,2), flag=wx.ALL|wx.EXPAND, border=5)
+        gbSizer.Add(LiveR1Lbl, pos=(8,3), span=(1,1), flag=wx.ALL|wx.EXPAND, border=5)
+        gbSizer.Add(self.LiveR1, pos=(8,4), span=(1,3), flag=wx.ALL|wx.EXPAND, border=5)
         
         self.SetSizerAndFit(gbSizer)
 
@@ -688,6 +691,17 @@ class RunPage(wx.Panel):
             e.GetEventObject().SetLabel("AUTO-range DVM12")
         else:
             e.GetEventObject().SetLabel("FIXED-range DVM12")
+        self.ShowEstimate() # Range mode affects the measurement sequence
+
+    def ShowEstimate(self):
+        # Predicted run duration (Data sheet rows B1-B2) in status bar field 2
+        try:
+            est,rows,plan = estimator.EstimateRun(self.GetRunConfig())
+        except Exception as msg:
+            print'RunPage.ShowEstimate(): No estimate -',msg
+            return
+        self.status.SetStatusText('Run: ~'+estimator.FormatDuration(est['total']),2)
+        print >>self.GetParent().GetPage(0).log,'RunPage.ShowEstimate(): %s (%s)'%(estimator.FormatDuration(est['total']),plan.name)
 
     def OnNewRunID(self,e):
         start = self.fullstr.find('R1: ')
@@ -696,8 +710,7 @@ class RunPage(wx.Panel):
         start = self.fullstr.find('R2: ')
         end = self.fullstr.find(' monitored',start)
         R2name = self.fullstr[start+4:end]
-        self.run_id = str('HRBC.v' + self.version + ' ' + R1name + ':' + R2name + ' ' +
-                          dt.datetime.now().strftime("%d/%m/%Y %H:%M:%S"))
+        self.run_id = runconfig.NewRunId(self.version, R1name, R2name)
         self.status.SetStatusText('Id for subsequent runs:',0)
         self.status.SetStatusText(str(self.run_id),1)
         self.RunID.SetValue(str(self.run_id))
@@ -730,6 +743,13 @@ class RunPage(wx.Panel):
             self.Row.SetValue(str(e.r))
             self.Progress.SetValue(e.P)
 
+    def UpdateLiveR1(self,e):
+        # Triggered by a 'live R1' event
+        if e.R0 is None: # No fit yet
+            self.LiveR1.SetValue('%.10g +/- %.2g (row %s)'%(e.R1,e.u,e.r))
+            return
+        self.LiveR1.SetValue('%.10g +/- %.2g (row %s); fit of %d blocks: %.10g +/- %.2g'%(e.R1,e.u,e.r,e.n,e.R0,e.u0))
+
     def UpdateDels(self,e):
         # Triggered by an 'update delays' event
         self.StartDel.SetValue(str(e.s))
@@ -745,48 +765,53 @@ class RunPage(wx.Panel):
         # Triggered by an 'update stoprow' event
         self.StopRow.SetValue(str(e.row))
 
+    def UpdateSrcV(self,e):
+        # Triggered by an 'update source V' event - the acquisition thread has
+        # already set the source, so just update the display.
+        self.src_V[e.role] = e.V
+        if e.role == 'SRC1':
+            self.V1Setting.SetValue(str(e.V)) # OnV1Set() sees no change and does nothing
+        else:
+            self.V2Setting.SetValue(str(e.V))
+
     def OnV1Set(self,e):
         # Called by change in value (manually OR by software!)
         V1 = e.GetValue()
-        src1 = devices.ROLES_INSTR['SRC1']
-        src1.SetV(V1) #'M+0R0='
-        time.sleep(0.5)
-        if V1 == 0:
-            src1.Stby()
-        else:
-            src1.Oper()
-        time.sleep(0.5)
+        if V1 == self.src_V['SRC1']:
+            return # Already set (probably by acquisition thread)
+        if self.Following():
+            return # The run process has the sources
+        self.src_V['SRC1'] = V1
+        devices.SubmitSrcV('SRC1',V1) # 'M+0R0=' - don't wait for the source
 
 
     def OnV2Set(self,e):
         # Called by change in value (manually OR by software!)
         V2 = e.GetValue()
-        src2 = devices.ROLES_INSTR['SRC2']
-        src2.SetV(V2)
-        time.sleep(0.5)
-        if V2 == 0:
-            src2.Stby()
-        else:
-            src2.Oper()
-        time.sleep(0.5)
+        if V2 == self.src_V['SRC2']:
+            return # Already set (probably by acquisition thread)
+        if self.Following():
+            return # The run process has the sources
+        self.src_V['SRC2'] = V2
+        devices.SubmitSrcV('SRC2',V2)
 
     def OnZeroVolts(self,e):
+        if self.Following():
+            return # The run process has the sources
         # V1:
-        src1 = devices.ROLES_INSTR['SRC1']
         if self.V1Setting.GetValue() == 0:
             print'RunPage.OnZeroVolts(): Zero/Stby directly (not via V1 display)'
-            src1.SetV(0)
-            src1.Stby()
+            self.src_V['SRC1'] = 0
+            devices.SubmitSrcV('SRC1',0)
         else:
             self.V1Setting.SetValue('0') # Calls OnV1Set() ONLY IF VALUE CHANGES
             print'RunPage.OnZeroVolts():  Zero/Stby via V1 display'
 
         # V2:
-        src2 = devices.ROLES_INSTR['SRC2']
         if self.V2Setting.GetValue() == 0:
             print'RunPage.OnZeroVolts(): Zero/Stby directly (not via V2 display)'
-            src2.SetV(0)
-            src2.Stby()
+            self.src_V['SRC2'] = 0
+            devices.SubmitSrcV('SRC2',0)
         else:
             self.V2Setting.SetValue('0') # Calls OnV2Set() ONLY IF VALUE CHANGES
             print'RunPage.OnZeroVolts():  Zero/Stby via V2 display'
@@ -799,11 +824,19 @@ class RunPage(wx.Panel):
         if self.RunThread is None:
             self.StopBtn.Enable(True) # Enable Stop button
             self.StartBtn.Enable(False) # Disable Start button
-            # start acquisition thread here
-            self.RunThread = acq.AqnThread(self)
+            # start acquisition thread (or process) here
+            config = self.GetRunConfig()
+            resume = self.AskResume(config,'run')
+            if self.SeparateProc.GetValue():
+                self.StartProcess(config,'run',resume)
+            else:
+                self.RunThread = acq.AqnThread(config, WxSink(self), resume)
 
     def OnAbort(self,e):
-        if self.RunThread:
+        if self.Stream is not None:
+            self.StopBtn.Enable(False)
+            self.Stream.RequestAbort() # The run process ends the run
+        elif self.RunThread:
             self.StartBtn.Enable(True)
             self.StopBtn.Enable(False) # Disable Stop button
             self.RunThread.abort()
@@ -820,7 +853,166 @@ class RunPage(wx.Panel):
         if self.RLinkThread is None:
             self.StopBtn.Enable(True) # Enable Stop button
             self.RLinkBtn.Enable(False)
-            self.RLinkThread = rl.RLThread(self)
+            config = self.GetRunConfig()
+            resume = self.AskResume(config,'rlink')
+            if self.SeparateProc.GetValue():
+                self.StartProcess(config,'rlink',resume)
+            else:
+                self.RLinkThread = rl.RLThread(config, WxSink(self), resume)
+
+    def StartProcess(self,config,kind,resume):
+        # Measure in a hrbc_cli.py process and watch its progress stream
+        self.ProcRoles = dict(config.roles)
+        devices.CloseRoles() # The run process opens its own instrument sessions...
+        bustrace.Stop() # ...and writes the bus trace
+        self.Proc = aqnproc.Launch(aqnproc.CliArgs(config,kind,resume is not None))
+        self.EnableSources(False)
+        print'RunPage.StartProcess(): %s process started, pid %s'%(kind,self.Proc.pid)
+        print >>config.log,'RunPage.StartProcess(): %s process started, pid %s'%(kind,self.Proc.pid)
+        self.StreamSink = WxSink(self)
+        self.StreamTimer.Start(STREAM_POLL)
+
+    def FollowRunning(self):
+        # Watch a run process already measuring this data file
+        reader = aqnproc.Live(self.GetParent().GetPage(0).XLFile.GetValue())
+        if reader is None:
+            return
+        self.status.SetStatusText('Following run in progress (separate process)',0)
+        self.Stream = reader
+        self.StreamSink = WxSink(self)
+        self.SetRunning(True)
+        self.EnableSources(False)
+        self.StreamTimer.Start(STREAM_POLL)
+
+    def OnStreamTimer(self,e):
+        if self.Stream is None: # Run process starting up
+            filename = self.GetParent().GetPage(0).XLFile.GetValue() + aqnproc.SUFFIX
+            if os.path.isfile(filename):
+                try:
+                    self.Stream = aqnproc.StreamReader(filename)
+                except Exception as msg:
+                    print'RunPage.OnStreamTimer(): Stream not ready -',msg
+            elif self.Proc is not None and self.Proc.poll() is not None:
+                print'RunPage.OnStreamTimer(): Run process ended (exit code %s) without a progress stream'%self.Proc.returncode
+                self.StopFollowing()
+            return
+        alive = self.Stream.Alive()
+        aqnproc.Replay(self.Stream.Poll(), self.StreamSink)
+        if not alive:
+            self.StopFollowing()
+
+    def StopFollowing(self):
+        # Run process has finished
+        self.StreamTimer.Stop()
+        SetupPage = self.GetParent().GetPage(0)
+        if self.Stream is not None:
+            if self.Stream.lost > 0:
+                print'RunPage.StopFollowing(): Fell behind the run %d times - some updates missed'%self.Stream.lost
+            self.Stream.Close()
+            self.Stream = None
+        if self.Proc is not None: # Take the instruments back
+            self.Proc = None
+            bustrace.Start(os.path.dirname(SetupPage.XLFile.GetValue()))
+            for r,d in self.ProcRoles.items():
+                SetupPage.CreateInstr(d,r)
+        # The run process has written to the data file - don't save over it with the old workbook
+        SetupPage.wb = runconfig.OpenWorkbook(SetupPage.XLFile.GetValue())
+        self.EnableSources(True)
+        self.SetRunning(False)
+
+    def Following(self):
+        # True while a run process (not this GUI) has the instruments and data file
+        return self.Proc is not None or self.Stream is not None
+
+    def EnableSources(self, enable):
+        # Manual source settings - not while a run process has the sources
+        self.V1Setting.Enable(enable)
+        self.V2Setting.Enable(enable)
+        self.ZeroVoltsBtn.Enable(enable)
+
+    def AskResume(self,config,kind):
+        # Offer to continue an unfinished run of this kind (see checkpoint.py)
+        state = checkpoint.Load(config.xlfilename,kind)
+        if state is None:
+            return None
+        dlg = wx.MessageDialog(self, checkpoint.Describe(state)+'\n\nResume this run?',
+                               'Unfinished run', wx.YES_NO|wx.ICON_QUESTION)
+        answer = dlg.ShowModal()
+        dlg.Destroy()
+        if answer == wx.ID_YES:
+            return state
+        return None
+
+    def GetRunConfig(self):
+        # Gather run settings from the Setup and Run pages
+        SetupPage = self.GetParent().GetPage(0)
+        roles = dict([(r,devices.ROLES_WIDGETS[r]['icb'].GetValue()) for r in devices.ROLES_WIDGETS.keys()])
+        return runconfig.RunConfig(SetupPage.XLFile.GetValue(), SetupPage.wb, SetupPage.log, roles,
+                                   comment = self.Comment.GetValue(),
+                                   run_id = self.run_id,
+                                   settle_time = self.SettleDel.GetValue(),
+                                   auto_range = self.RangeTBtn.GetValue(),
+                                   R1Name = SetupPage.R1Name.GetValue(),
+                                   R2Name = SetupPage.R2Name.GetValue())
+
+    def SetRunning(self, running):
+        # Set button availability
+        self.StopBtn.Enable(running)
+        self.StartBtn.Enable(not running)
+        self.RLinkBtn.Enable(not running)
+
+
+class WxSink(progress.ProgressSink):
+    """
+    Progress sink for the GUI: reports from the acquisition and R-link
+    threads become wx events (via the event bus) for the notebook pages.
+    """
+    def __init__(self, RunPage):
+        self.RunPage = RunPage
+        self.SetupPage = RunPage.GetParent().GetPage(0)
+        self.PlotPage = RunPage.GetParent().GetPage(2)
+        self.TopLevel = RunPage.GetTopLevelParent()
+
+    def Status(self, msg, field=0):
+        evts.Post(self.TopLevel, evts.StatusEvent(msg=msg, field=field))
+
+    def Data(self, t, Vm, Vsd, P, r, flag):
+        evts.Post(self.RunPage, evts.DataEvent(t=t, Vm=Vm, Vsd=Vsd, P=P, r=r, flag=flag))
+
+    def Rows(self, start, stop):
+        evts.Post(self.RunPage, evts.StartRowEvent(row = start))
+        evts.Post(self.RunPage, evts.StopRowEvent(row = stop))
+
+    def Row(self, r):
+        evts.Post(self.RunPage, evts.RowEvent(r = r))
+
+    def Delays(self, n, s, AZ1, r):
+        evts.Post(self.RunPage, evts.DelaysEvent(n=n, s=s, AZ1=AZ1, r=r))
+
+    def Switchbox(self, conf):
+        evts.Post(self.SetupPage, evts.SB_ConfEvent(conf=conf)) # update switchbox configuration icb
+
+    def SrcV(self, role, V):
+        evts.Post(self.RunPage, evts.SrcVEvent(role=role, V=V))
+
+    def ClearPlot(self):
+        evts.Post(self.PlotPage, evts.ClearPlotEvent())
+
+    def Plot(self, **data):
+        evts.Post(self.PlotPage, evts.PlotEvent(**data))
+
+    def Eta(self, finish, remaining):
+        msg = 'ETA '+finish.strftime("%H:%M")+' ('+estimator.FormatDuration(remaining)+' to go)'
+        evts.Post(self.TopLevel, evts.StatusEvent(msg=msg, field=2))
+
+    def LiveR1(self, r, R1, u, R0, u0, n):
+        evts.Post(self.RunPage, evts.LiveR1Event(r=r, R1=R1, u=u, R0=R0, u0=u0, n=n))
+
+    def Running(self, running):
+        wx.CallAfter(self.RunPage.SetRunning, running)
+        if not running:
+            print'WxSink.Running(): GUI events',evts.BusStats()
+            print >>self.SetupPage.log,'WxSink.Running(): GUI events',evts.BusStats()
 
 '''
 __________________________________________
@@ -846,29 +1038,49 @@ class PlotPage(wx.Panel):
         self.Vdax = self.figure.add_subplot(3,1,3) # 3high x 1wide, 3rd plot down 
         self.Vdax.ticklabel_format(style='sci', useOffset=False, axis='y', scilimits=(2,-2)) # Auto offset to centre on data
         self.Vdax.yaxis.set_major_formatter(mtick.ScalarFormatter(useMathText=True, useOffset=False)) # Scientific notation .
-        self.Vdax.autoscale(enable=True, axis='y', tight=False) # Autoscale with 'buffer' around data extents
+        self.Vdax.autoscale(enable=False) # Limits are managed by Rescale()
+        self.Vdax.xaxis_date()
         self.Vdax.set_xlabel('time')
         self.Vdax.set_ylabel('Vd')
 
         self.V1ax = self.figure.add_subplot(3,1,1, sharex=self.Vdax) # 3high x 1wide, 1st plot down 
         self.V1ax.ticklabel_format(useOffset=False, axis='y') # Auto offset to centre on data
-        self.V1ax.autoscale(enable=True, axis='y', tight=False) # Autoscale with 'buffer' around data extents
+        self.V1ax.autoscale(enable=False)
         plt.setp(self.V1ax.get_xticklabels(), visible=False) # Hide x-axis labels
         self.V1ax.set_ylabel('V1')
-        self.V1ax.set_ylim(auto=True)
         V1_y_ost = self.V1ax.get_xaxis().get_offset_text()
         V1_y_ost.set_visible(False)
 
         self.V2ax = self.figure.add_subplot(3,1,2, sharex=self.Vdax) # 3high x 1wide, 2nd plot down 
         self.V2ax.ticklabel_format(useOffset=False, axis='y') # Auto offset to centre on data
-        self.V2ax.autoscale(enable=True, axis='y', tight=False) # Autoscale with 'buffer' around data extents
+        self.V2ax.autoscale(enable=False)
         plt.setp(self.V2ax.get_xticklabels(), visible=False) # Hide x-axis labels
         self.V2ax.set_ylabel('V2')
-        self.V2ax.set_ylim(auto=True)
         V2_y_ost = self.V2ax.get_xaxis().get_offset_text()
         V2_y_ost.set_visible(False)
 
+        # One persistent (animated) line per axis - updated with set_data(),
+        # drawn by blitting, so redraw cost doesn't grow during a run.
+        self.axes = (self.V1ax, self.V2ax, self.Vdax)
+        self.lines = {self.V1ax:self.V1ax.plot([], [], 'bo', animated=True)[0],
+                      self.V2ax:self.V2ax.plot([], [], 'go', animated=True)[0],
+                      self.Vdax:self.Vdax.plot([], [], 'ro', animated=True)[0]}
+        self.xdata = dict([(ax,[]) for ax in self.axes])
+        self.ydata = dict([(ax,[]) for ax in self.axes])
+        self.x_extent = None # (min,max) of all plotted times - kept up to date as points are added
+        self.y_extent = dict([(ax,None) for ax in self.axes]) # (min,max) of each axis' voltages
+        self.backgrounds = {}
+        self.changed = set() # axes waiting to be redrawn
+        self.fresh = True # No data plotted yet - set new limits
+        self.full_redraw = False
+        self.last_draw = 0
+        self.draw_timer = None
+
+        self.figure.autofmt_xdate() # default settings
+        self.Vdax.fmt_xdata = mdates.DateFormatter('%d-%m-%Y, %H:%M:%S')
+
         self.canvas = FigureCanvas(self, wx.ID_ANY, self.figure)
+        self.canvas.mpl_connect('draw_event', self.OnDraw)
         self.sizer = wx.BoxSizer(wx.VERTICAL)
         self.sizer.Add(self.canvas, 1, wx.LEFT | wx.TOP | wx.GROW)
         self.SetSizerAndFit(self.sizer)
@@ -877,20 +1089,243 @@ class PlotPage(wx.Panel):
     def UpdatePlot(self, e):
         # six event attributes: td, t1, t2 (list of n times),
         # and Vd, V1, V2 (list of n voltages) plus clear_plot flag
-        self.V1ax.plot_date(e.t1, e.V1, 'bo')
-        self.V2ax.plot_date(e.t2, e.V2, 'go')
-        self.Vdax.plot_date(e.td, e.Vd, 'ro')
-        self.figure.autofmt_xdate() # default settings
-        self.Vdax.fmt_xdata = mdates.DateFormatter('%d-%m-%Y, %H:%M:%S')
+        for ax,t,V in ((self.V1ax,e.t1,e.V1),(self.V2ax,e.t2,e.V2),(self.Vdax,e.td,e.Vd)):
+            if len(t) == 0:
+                continue
+            x = mdates.date2num(t)
+            self.xdata[ax].extend(x)
+            self.ydata[ax].extend(V)
+            self.x_extent = self.Extend(self.x_extent, x)
+            self.y_extent[ax] = self.Extend(self.y_extent[ax], V)
+            self.lines[ax].set_data(self.xdata[ax], self.ydata[ax])
+            if self.Rescale(ax):
+                self.full_redraw = True
+            self.changed.add(ax)
+        if len(self.changed) > 0 and self.RescaleX():
+            self.full_redraw = True
+        self.fresh = False
+        self.RequestDraw()
+        self.GetParent().GetPage(3).AddData(e) # HistoryPage
+
+    def Extend(self, extent, values):
+        # (min,max) of extent and new values - only the new values are looked at
+        lo,hi = min(values),max(values)
+        if extent is None:
+            return (lo,hi)
+        return (min(extent[0],lo),max(extent[1],hi))
+
+    """
+    Axes limits are only widened (with some headroom) when the data no
+    longer fits, so most updates can be blitted. Both return True if
+    any limits changed.
+    """
+    def RescaleX(self):
+        x_lo,x_hi = self.x_extent
+        x0,x1 = self.Vdax.get_xlim()
+        if self.fresh or x_lo < x0 or x_hi > x1:
+            span = max(x_hi - x_lo, 1.0/24) # at least 1 hour (in days)
+            self.Vdax.set_xlim(x_lo - 0.05*span, x_hi + 0.5*span) # shared x-axis
+            return True
+        return False
+
+    def Rescale(self, ax):
+        y_lo,y_hi = self.y_extent[ax]
+        y0,y1 = ax.get_ylim()
+        if self.fresh or y_lo < y0 or y_hi > y1:
+            span = max(y_hi - y_lo, 1e-6*max(abs(y_lo),abs(y_hi)), 1e-9)
+            ax.set_ylim(y_lo - 0.25*span, y_hi + 0.25*span)
+            return True
+        return False
+
+    def RequestDraw(self):
+        # Throttle redraws to at most PLOT_MAX_FPS
+        if self.draw_timer is not None:
+            return # A redraw is already scheduled
+        wait = self.last_draw + 1.0/PLOT_MAX_FPS - time.time()
+        if wait > 0:
+            self.draw_timer = wx.CallLater(int(1000*wait)+1, self.Redraw)
+        else:
+            self.Redraw()
+
+    def Redraw(self):
+        self.draw_timer = None
+        self.last_draw = time.time()
+        if self.full_redraw or len(self.backgrounds) == 0:
+            self.full_redraw = False
+            self.changed.clear()
+            self.canvas.draw() # OnDraw() re-caches backgrounds and blits all lines
+        else:
+            for ax in self.changed:
+                self.Blit(ax)
+            self.changed.clear()
+            self.canvas.Refresh()
+
+    def Blit(self, ax):
+        self.canvas.restore_region(self.backgrounds[ax])
+        ax.draw_artist(self.lines[ax])
+        self.canvas.blit(ax.bbox)
+
+    def OnDraw(self, event):
+        # After any full draw (incl. resizing) grab clean axes backgrounds
+        # (the animated lines are not part of them), then draw the lines.
+        for ax in self.axes:
+            self.backgrounds[ax] = self.canvas.copy_from_bbox(ax.bbox)
+        for ax in self.axes:
+            ax.draw_artist(self.lines[ax])
+            self.canvas.blit(ax.bbox)
+
+    def ClearPlot(self, e):
+        for ax in self.axes:
+            del self.xdata[ax][:]
+            del self.ydata[ax][:]
+            self.lines[ax].set_data([], [])
+            self.y_extent[ax] = None
+        self.x_extent = None
+        self.fresh = True
+        self.changed.clear()
         self.canvas.draw()
         self.canvas.Refresh()
 
-    def ClearPlot(self, e):
-        self.V1ax.cla()
-        self.V2ax.cla()
-        self.Vdax.cla()
-        self.Vdax.set_ylabel('Vd')
+
+'''
+--------------------------
+# History Page definition:
+--------------------------
+'''
+class HistoryPage(wx.Panel):
+    """
+    Every V1, V2, Vd and temperature reading since the history was last
+    cleared (spanning runs and days). Data are held in a
+    plot_history.History and only a screen's-width of min/max-decimated
+    points is plotted - zooming or panning (toolbar) fetches finer detail.
+    """
+    def __init__(self, parent):
+        wx.Panel.__init__(self, parent)
+
+        self.history = plot_history.History()
+        self.filename = None # Set when an Excel file is opened
+        self.updating = False # True while x-limits are being set in code
+
+        self.figure = Figure()
+        self.figure.subplots_adjust(hspace = 0.3)
+
+        self.Tax = self.figure.add_subplot(4,1,4) # 4high x 1wide, 4th plot down
+        self.Tax.xaxis_date()
+        self.Tax.set_xlabel('time')
+        self.Tax.set_ylabel('T')
+
+        self.V1ax = self.figure.add_subplot(4,1,1, sharex=self.Tax)
         self.V1ax.set_ylabel('V1')
+        self.V2ax = self.figure.add_subplot(4,1,2, sharex=self.Tax)
         self.V2ax.set_ylabel('V2')
-        self.canvas.draw()
-        self.canvas.Refresh()
+        self.Vdax = self.figure.add_subplot(4,1,3, sharex=self.Tax)
+        self.Vdax.ticklabel_format(style='sci', useOffset=False, axis='y', scilimits=(2,-2))
+        self.Vdax.yaxis.set_major_formatter(mtick.ScalarFormatter(useMathText=True, useOffset=False))
+        self.Vdax.set_ylabel('Vd')
+        for ax in (self.V1ax, self.V2ax, self.Vdax):
+            ax.ticklabel_format(useOffset=False, axis='y')
+            plt.setp(ax.get_xticklabels(), visible=False) # Hide x-axis labels
+
+        self.axes = (self.V1ax, self.V2ax, self.Vdax, self.Tax)
+        self.lines = {'V1':self.V1ax.plot([], [], 'b-')[0],
+                      'V2':self.V2ax.plot([], [], 'g-')[0],
+                      'Vd':self.Vdax.plot([], [], 'r-')[0],
+                      'T1':self.Tax.plot([], [], 'm-', label='T1')[0],
+                      'T2':self.Tax.plot([], [], 'c-', label='T2')[0]}
+        self.Tax.legend(loc='upper left', fontsize='small')
+        self.Tax.fmt_xdata = mdates.DateFormatter('%d-%m-%Y, %H:%M:%S')
+        self.figure.autofmt_xdate()
+
+        # Shared axes don't propagate 'xlim_changed', so watch them all
+        for ax in self.axes:
+            ax.callbacks.connect('xlim_changed', self.OnXlim)
+
+        self.canvas = FigureCanvas(self, wx.ID_ANY, self.figure)
+        self.toolbar = NavigationToolbar2Wx(self.canvas)
+        self.toolbar.Realize()
+
+        self.FollowTBtn = wx.ToggleButton(self, label='Follow run')
+        self.FollowTBtn.SetValue(True)
+        self.FollowTBtn.Bind(wx.EVT_TOGGLEBUTTON, self.OnFollow)
+        self.ClearBtn = wx.Button(self, label='Clear history')
+        self.ClearBtn.Bind(wx.EVT_BUTTON, self.OnClear)
+
+        ControlSizer = wx.BoxSizer(wx.HORIZONTAL)
+        ControlSizer.Add(self.toolbar, 1, wx.EXPAND)
+        ControlSizer.Add(self.FollowTBtn, 0, wx.ALL, 5)
+        ControlSizer.Add(self.ClearBtn, 0, wx.ALL, 5)
+
+        self.sizer = wx.BoxSizer(wx.VERTICAL)
+        self.sizer.Add(self.canvas, 1, wx.LEFT | wx.TOP | wx.GROW)
+        self.sizer.Add(ControlSizer, 0, wx.EXPAND)
+        self.SetSizerAndFit(self.sizer)
+
+    def SetFile(self, filename):
+        # Called when an Excel file is opened - load any history saved alongside it
+        self.filename = filename
+        if os.path.isfile(filename):
+            try:
+                self.history.Load(filename)
+                print 'HistoryPage.SetFile(): loaded',filename
+            except (IOError, ValueError, KeyError) as msg:
+                print 'HistoryPage.SetFile(): failed to load',filename,'-',msg
+                self.history.Clear()
+        self.ShowAll()
+
+    def Save(self):
+        if self.filename is not None:
+            self.history.Save(self.filename)
+            print 'HistoryPage.Save(): saved',self.filename
+
+    def AddData(self, e):
+        # Called by PlotPage.UpdatePlot() with each PlotEvent
+        for name,t,V in (('V1',e.t1,e.V1),('V2',e.t2,e.V2),('Vd',e.td,e.Vd)):
+            if len(t) > 0:
+                self.history.Append(name, mdates.date2num(t), V)
+        tT = getattr(e, 'tT', None)
+        if tT is not None: # RLink doesn't record temperatures
+            for name in ('T1','T2'):
+                T = getattr(e, name)
+                if T is not None:
+                    self.history.Append(name, [mdates.date2num(tT)], [float(T)])
+        if self.FollowTBtn.GetValue():
+            self.ShowAll()
+        else:
+            self.Requery()
+
+    def ShowAll(self):
+        # Set x-limits to the whole history
+        extent = self.history.Extent()
+        if extent is not None:
+            span = max(extent[1] - extent[0], 1.0/24) # at least 1 hour (in days)
+            self.updating = True
+            self.Tax.set_xlim(extent[0] - 0.02*span, extent[1] + 0.02*span)
+            self.updating = False
+        self.Requery()
+
+    def OnXlim(self, ax):
+        if self.updating:
+            return
+        # Zoomed or panned by the user - stop following the run
+        self.FollowTBtn.SetValue(False)
+        self.Requery()
+
+    def Requery(self):
+        # Fetch about 2 points per pixel-column of the visible x-range
+        x0,x1 = self.Tax.get_xlim()
+        max_points = max(2*int(self.Tax.bbox.width), 200)
+        for name,line in self.lines.items():
+            x,y = self.history.Query(name, x0, x1, max_points)
+            line.set_data(x, y)
+        for ax in self.axes:
+            ax.relim()
+            ax.autoscale_view(scalex=False, scaley=True)
+        self.canvas.draw_idle()
+
+    def OnFollow(self, e):
+        if self.FollowTBtn.GetValue():
+            self.ShowAll()
+
+    def OnClear(self, e):
+        self.history.Clear()
+        self.Requery()
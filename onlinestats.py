@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+onlinestats.py - Running (online) statistics.
+
+RunningStats accumulates mean and variance one reading at a time
+(Welford's method), so the mean, standard deviation and standard error
+of the mean are available after every reading without re-computing over
+the whole list - and without the round-off of the naive sum-of-squares
+method when the spread is tiny compared with the mean (e.g. 10 V +/- 10 uV).
+"""
+
+import math
+
+
+class RunningStats():
+    """
+    Mean, SD (n-1 denominator, as np.std(x,ddof=1)) and SEM of the readings so far.
+    """
+    def __init__(self):
+        self.Clear()
+
+    def Clear(self):
+        self.n = 0
+        self.mean = 0.0
+        self.M2 = 0.0 # Sum of squared deviations from the mean
+
+    def Add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta/self.n
+        self.M2 += delta*(x - self.mean)
+
+    def Mean(self):
+        assert self.n > 0,'No readings!'
+        return self.mean
+
+    def Var(self):
+        assert self.n > 1,"Can't take SD of one or less items!"
+        return self.M2/(self.n - 1)
+
+    def SD(self):
+        return math.sqrt(self.Var())
+
+    def SEM(self):
+        return math.sqrt(self.Var()/self.n)
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+plot_history.py
+
+Multi-resolution storage for the run-history plots (HistoryPage).
+
+Every reading of a run (and of earlier runs, until the history is cleared)
+is kept in a DecimatedSeries. Level 0 holds the raw (x,y) points. Each higher
+level k holds the min and max of DECIMATION consecutive level k-1 entries, so
+level k summarises DECIMATION**k raw points per entry. Levels are built
+incrementally as points arrive.
+
+Query() picks the finest level that gives no more than max_points points in
+the requested x-range and returns the min/max envelope from that level. So a
+plot of several hundred thousand readings only ever holds about a screen's
+width of points, and zooming in fetches finer detail.
+"""
+
+import numpy as np
+
+DECIMATION = 8 # Level-to-level reduction factor
+N_LEVELS = 7 # Level 6 entries cover 8**6 = 262144 raw points
+
+
+class GrowArray():
+    """
+    A 1-D numpy array with amortised O(1) append.
+    """
+    def __init__(self, capacity=1024):
+        self.data = np.empty(capacity)
+        self.n = 0
+
+    def Extend(self, values):
+        values = np.asarray(values, dtype=float)
+        need = self.n + len(values)
+        if need > len(self.data):
+            new_data = np.empty(max(need, 2*len(self.data)))
+            new_data[:self.n] = self.data[:self.n]
+            self.data = new_data
+        self.data[self.n:need] = values
+        self.n = need
+
+    def View(self):
+        return self.data[:self.n]
+
+
+class DecimatedSeries():
+    """
+    One plotted quantity (e.g. V1 or T2). x-values must be non-decreasing
+    (times as matplotlib date numbers).
+    """
+    def __init__(self, factor=DECIMATION, n_levels=N_LEVELS):
+        self.factor = factor
+        self.n_levels = n_levels
+        self.Clear()
+
+    def Clear(self):
+        self.x = [GrowArray() for k in range(self.n_levels)]
+        self.ymin = [GrowArray() for k in range(self.n_levels)]
+        self.ymax = [GrowArray() for k in range(self.n_levels)]
+
+    def __len__(self):
+        return self.x[0].n
+
+    def Append(self, x, y):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if len(x) == 0:
+            return
+        assert len(x) == len(y),'DecimatedSeries.Append(): x and y lengths differ!'
+        self.x[0].Extend(x)
+        self.ymin[0].Extend(y) # level 0: ymin and ymax are both the raw data
+        self.ymax[0].Extend(y)
+
+        # Summarise any newly-completed buckets at each level
+        f = self.factor
+        for k in range(1, self.n_levels):
+            done = self.x[k].n
+            new = self.x[k-1].n//f - done
+            if new <= 0:
+                break # No new buckets here means none at higher levels either
+            lo,hi = done*f,(done + new)*f
+            self.x[k].Extend(self.x[k-1].View()[lo:hi].reshape(new,f).mean(axis=1))
+            self.ymin[k].Extend(self.ymin[k-1].View()[lo:hi].reshape(new,f).min(axis=1))
+            self.ymax[k].Extend(self.ymax[k-1].View()[lo:hi].reshape(new,f).max(axis=1))
+
+    def Extent(self):
+        # (x_min, x_max) of all data, or None if empty
+        if len(self) == 0:
+            return None
+        x = self.x[0].View()
+        return (x[0], x[-1])
+
+    def _Level(self, k, x0, x1):
+        # Return (x, ymin, ymax) of level k entries in [x0,x1]
+        x = self.x[k].View()
+        i0 = np.searchsorted(x, x0, side='left')
+        i1 = np.searchsorted(x, x1, side='right')
+        return x[i0:i1], self.ymin[k].View()[i0:i1], self.ymax[k].View()[i0:i1]
+
+    def Query(self, x0=None, x1=None, max_points=2000):
+        """
+        Return (x, y) arrays to plot for the x-range [x0,x1] with no more
+        than about max_points points. Decimated levels give each bucket's
+        min and max, so narrow spikes are never lost.
+        """
+        if len(self) == 0:
+            return np.array([]), np.array([])
+        if x0 is None or x1 is None:
+            x0,x1 = self.Extent()
+        for k in range(self.n_levels):
+            x,lo,hi = self._Level(k, x0, x1)
+            n = len(x)*(1 if k == 0 else 2)
+            if n <= max_points or k == self.n_levels - 1:
+                break
+        if k == 0:
+            return x.copy(), lo.copy()
+
+        # Append the tail not yet summarised at level k: the incomplete last
+        # bucket of each lower level (fewer than factor entries per level).
+        xs,los,his = [x],[lo],[hi]
+        for j in range(k-1, -1, -1):
+            start = self.x[j+1].n*self.factor # 1st level-j entry not in level j+1
+            tx = self.x[j].View()[start:]
+            keep = (tx >= x0) & (tx <= x1)
+            xs.append(tx[keep])
+            los.append(self.ymin[j].View()[start:][keep])
+            his.append(self.ymax[j].View()[start:][keep])
+        x = np.concatenate(xs)
+        lo = np.concatenate(los)
+        hi = np.concatenate(his)
+
+        # Interleave min/max: a vertical stroke per bucket
+        xx = np.repeat(x, 2)
+        yy = np.empty(2*len(x))
+        yy[0::2] = lo
+        yy[1::2] = hi
+        return xx, yy
+
+    def RawData(self):
+        return self.x[0].View(), self.ymin[0].View()
+
+
+class History():
+    """
+    The set of DecimatedSeries shown on the HistoryPage, with save/load so
+    the history survives a restart of HRBC.
+    """
+    NAMES = ('V1','V2','Vd','T1','T2')
+
+    def __init__(self):
+        self.series = dict([(name, DecimatedSeries()) for name in self.NAMES])
+
+    def Append(self, name, x, y):
+        self.series[name].Append(x, y)
+
+    def Clear(self):
+        for s in self.series.values():
+            s.Clear()
+
+    def Extent(self):
+        extents = [s.Extent() for s in self.series.values() if s.Extent() is not None]
+        if len(extents) == 0:
+            return None
+        return (min([e[0] for e in extents]), max([e[1] for e in extents]))
+
+    def Query(self, name, x0=None, x1=None, max_points=2000):
+        return self.series[name].Query(x0, x1, max_points)
+
+    def Save(self, filename):
+        arrays = {}
+        for name in self.NAMES:
+            x,y = self.series[name].RawData()
+            arrays[name+'_x'] = x
+            arrays[name+'_y'] = y
+        np.savez_compressed(filename, **arrays)
+
+    def Load(self, filename):
+        self.Clear()
+        stored = np.load(filename)
+        for name in self.NAMES:
+            if name+'_x' in stored.files:
+                self.series[name].Append(stored[name+'_x'], stored[name+'_y'])
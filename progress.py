@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+progress.py
+
+Progress 'sinks' for the acquisition (AqnThread) and R-link (RLThread) threads.
+
+The threads don't know who's watching - they report everything (status
+messages, readings, row numbers, switchbox and source settings, plot data)
+through a sink. The GUI uses nbpages.WxSink, which turns each report into
+a wx event for the appropriate notebook page. The command-line interface
+(hrbc_cli.py) uses ConsoleSink and LogSink, so runs need no wx at all.
+Several sinks can be combined with TeeSink.
+
+This module must not import wx.
+"""
+
+import sys
+import datetime as dt
+
+import estimator
+
+
+class ProgressSink():
+    """
+    Base class - ignores everything. Sinks override whatever they need.
+    """
+    def Status(self, msg, field=0):
+        # Status message. field: 0, 1 or 'b' (both)
+        pass
+
+    def Data(self, t, Vm, Vsd, P, r, flag):
+        # Mean reading. flag: '1','2','d' (V1,V2,Vd), '-' (RLink), 'E' (ended), 'F' (finished)
+        pass
+
+    def Rows(self, start, stop):
+        pass
+
+    def Row(self, r):
+        pass
+
+    def Delays(self, n, s, AZ1, r):
+        pass
+
+    def Switchbox(self, conf):
+        pass
+
+    def SrcV(self, role, V):
+        pass
+
+    def ClearPlot(self):
+        pass
+
+    def Plot(self, **data):
+        # data: td, t1, t2 (lists of datetimes), Vd, V1, V2 (lists of voltages), clear, tT, T1, T2
+        pass
+
+    def Eta(self, finish, remaining):
+        # Estimated finish (datetime) and time remaining (s)
+        pass
+
+    def LiveR1(self, r, R1, u, R0, u0, n):
+        # R1 and std u of the block ending at row r, and the running fit's R1 (R0, u0) over n blocks
+        # (R0, u0 None until the fit has dof > 0)
+        pass
+
+    def Running(self, running):
+        # Called with True as a run starts and False when it stops (for any reason)
+        pass
+
+
+class ConsoleSink(ProgressSink):
+    """
+    Plain-text progress report, one line per event.
+    """
+    def __init__(self, stream=None):
+        if stream is None:
+            stream = sys.stdout
+        self.stream = stream
+        self.context = '' # Last status message in field 0
+
+    def Write(self, line):
+        print >>self.stream, dt.datetime.now().strftime("%H:%M:%S"), line
+
+    def Status(self, msg, field=0):
+        if field == 0:
+            self.context = msg
+        if msg == '':
+            return
+        if field == 1:
+            self.Write('%s %s'%(self.context, msg))
+        else:
+            self.Write(msg)
+
+    def Data(self, t, Vm, Vsd, P, r, flag):
+        if flag == 'E':
+            self.Write('Run ended early.')
+        elif flag == 'F':
+            self.Write('Run finished.')
+        else:
+            self.Write('Row %s, %s: %s V, sd %s V at %s (%d%%)'%(r, flag, Vm, Vsd, t, P))
+
+    def Rows(self, start, stop):
+        self.Write('Rows %s to %s'%(start, stop))
+
+    def Delays(self, n, s, AZ1, r):
+        self.Write('n = %s, start del. = %s s, AZ1 del. = %s s, range del. = %s s'%(n, s, AZ1, r))
+
+    def Eta(self, finish, remaining):
+        self.Write('ETA %s (%s to go)'%(finish.strftime("%d/%m/%Y %H:%M"), estimator.FormatDuration(remaining)))
+
+    def LiveR1(self, r, R1, u, R0, u0, n):
+        if R0 is None:
+            self.Write('Row %s: R1 = %.10g Ohm, u = %.3g'%(r, R1, u))
+        else:
+            self.Write('Row %s: R1 = %.10g Ohm, u = %.3g; run so far (%d blocks): %.10g Ohm, u = %.3g'%(r, R1, u, n, R0, u0))
+
+
+class LogSink(ConsoleSink):
+    """
+    As ConsoleSink, but date-stamped and flushed - for the run log file.
+    """
+    def __init__(self, log):
+        ConsoleSink.__init__(self, log)
+
+    def Write(self, line):
+        print >>self.stream, dt.datetime.now().strftime("%d/%m/%Y %H:%M:%S"), line
+        self.stream.flush()
+
+
+class TeeSink():
+    """
+    Pass everything on to each of several sinks.
+    """
+    def __init__(self, *sinks):
+        self.sinks = list(sinks)
+
+    def __getattr__(self, name):
+        def Fanout(*args, **kwargs):
+            for sink in self.sinks:
+                getattr(sink, name)(*args, **kwargs)
+        return Fanout
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+publish.py - Live run status on a local socket, for remote monitors.
+
+A Publisher listens on a TCP port on this PC (127.0.0.1 by default).
+Connected monitors get a stream of messages from the run through
+PublishSink (a progress sink - see progress.py) and instrument health
+from every traced bus call (see bustrace.LISTENERS):
+  'status'   - status messages,
+  'data'     - mean readings (and run ended / finished),
+  'progress' - rows, current row, delays, ETA, source voltages,
+               switchbox, running,
+  'plot'     - the readings of each completed row,
+  'health'   - per-role call and error counts, last latency, demo mode.
+
+Framing: every message (both ways) is a 4-byte big-endian length
+followed by compact JSON. Times are seconds since the epoch.
+Protocol: a monitor sends one request and then reads:
+  {"cmd":"snapshot"} - one reply with the latest value of everything
+                       (no plot data), then the connection is closed;
+  {"cmd":"subscribe","topics":["status","data"]} - the snapshot, then
+                       each new message of those topics (all if no topics).
+Messages look like {"topic":"progress","kind":"Row","t":...,"data":{...}}.
+
+The run never waits for a monitor: each subscriber has a queue of
+MAX_QUEUE messages, and a monitor that can't keep up loses messages
+(counted in its 'dropped' field of the health messages).
+
+Run as a script for a simple command-line monitor:
+python publish.py
+python publish.py --snapshot
+python publish.py --topics status,progress --port 50521
+
+This module must not import wx.
+"""
+
+import sys
+import json
+import time
+import Queue
+import socket
+import struct
+import argparse
+import threading
+import datetime as dt
+
+import progress
+
+HOST = '127.0.0.1'
+PORT = 50521
+FRAME = struct.Struct('>I') # Message length
+MAX_QUEUE = 1000 # Messages waiting per subscriber
+HEALTH_INTERVAL = 5.0 # s between health messages (errors are sent at once)
+TOPICS = ('status','data','progress','plot','health')
+
+
+def JSONDefault(obj):
+    # Datetimes as epoch seconds, numpy values as numbers / lists
+    if isinstance(obj, dt.datetime):
+        return time.mktime(obj.timetuple()) + obj.microsecond/1e6
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return str(obj)
+
+
+def Encode(obj):
+    data = json.dumps(obj, separators=(',',':'), default=JSONDefault)
+    return FRAME.pack(len(data)) + data
+
+
+def RecvAll(sock, n):
+    data = ''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if chunk == '':
+            return None
+        data += chunk
+    return data
+
+
+def Receive(sock):
+    # Next message from sock (None when the connection closes)
+    head = RecvAll(sock, FRAME.size)
+    if head is None:
+        return None
+    data = RecvAll(sock, FRAME.unpack(head)[0])
+    if data is None:
+        return None
+    return json.loads(data)
+
+
+class Subscriber(threading.Thread):
+    """
+    One monitor connection: answers its request, then (if subscribed)
+    sends queued messages until it disconnects.
+    """
+    def __init__(self, publisher, conn, addr):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.publisher = publisher
+        self.conn = conn
+        self.addr = addr
+        self.topics = ()
+        self.queue = Queue.Queue(MAX_QUEUE)
+        self.dropped = 0
+        self.start()
+
+    def Put(self, topic, msg):
+        if topic not in self.topics:
+            return
+        try:
+            self.queue.put_nowait(msg)
+        except Queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        try:
+            req = Receive(self.conn)
+            if req is None:
+                return
+            if req.get('cmd') == 'subscribe':
+                self.topics = tuple(req.get('topics') or TOPICS)
+                self.publisher.Add(self) # Before the snapshot, so nothing is missed
+            self.conn.sendall(Encode({'topic':'snapshot', 't':time.time(), 'data':self.publisher.Snapshot()}))
+            while req.get('cmd') == 'subscribe' and not self.publisher.closed:
+                try:
+                    msg = self.queue.get(timeout=1)
+                except Queue.Empty:
+                    continue
+                self.conn.sendall(msg)
+        except socket.error:
+            pass # Monitor went away
+        finally:
+            self.publisher.Remove(self)
+            self.conn.close()
+
+
+class Publisher():
+    """
+    The listening socket, the latest state of the run and the subscribers.
+    """
+    def __init__(self, host=HOST, port=PORT):
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.state = {'status':{}, 'data':{}, 'progress':{}, 'health':{}}
+        self.last_health = 0.0
+        self.closed = False
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind((host, port)) # socket.error if in use
+        self.server.listen(5)
+        self.server.settimeout(1)
+        self.thread = threading.Thread(target=self.Accept)
+        self.thread.daemon = True
+        self.thread.start()
+        print'publish.Publisher(): Run status on %s:%d'%(host, port)
+
+    def Accept(self):
+        while not self.closed:
+            try:
+                conn,addr = self.server.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            conn.settimeout(None)
+            Subscriber(self, conn, addr)
+
+    def Add(self, sub):
+        with self.lock:
+            self.subscribers.append(sub)
+
+    def Remove(self, sub):
+        with self.lock:
+            if sub in self.subscribers:
+                self.subscribers.remove(sub)
+
+    def Snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.state, default=JSONDefault)) # A copy
+
+    def Publish(self, topic, kind, data, key=None):
+        """
+        Send a message to subscribers. Its data is kept in the snapshot
+        (as state[topic][kind], or state[topic][kind][key]) unless topic is 'plot'.
+        """
+        now = time.time()
+        msg = Encode({'topic':topic, 'kind':kind, 't':now, 'data':data})
+        with self.lock:
+            if topic != 'plot':
+                if key is None:
+                    self.state[topic][kind] = data
+                else:
+                    self.state[topic].setdefault(kind, {})[str(key)] = data
+            for sub in self.subscribers:
+                sub.Put(topic, msg)
+
+    def OnBus(self, role, method, args, reply, t0, t1, demo, exc=None):
+        # bustrace listener: instrument health
+        with self.lock:
+            h = self.state['health'].setdefault(role, {'calls':0, 'errors':0, 'last_error':None})
+            h['calls'] += 1
+            h['demo'] = bool(demo)
+            h['last_ms'] = 1e3*(t1 - t0)
+            h['last_call'] = t1
+            if exc is not None:
+                h['errors'] += 1
+                h['last_error'] = '%s %s: %s'%(method, exc.__class__.__name__, exc)
+            if exc is None and t1 - self.last_health < HEALTH_INTERVAL:
+                return
+            self.last_health = t1
+            data = dict(self.state['health'])
+            data['dropped'] = dict([('%s:%d'%sub.addr, sub.dropped) for sub in self.subscribers])
+            msg = Encode({'topic':'health', 'kind':'Health', 't':t1, 'data':data})
+            for sub in self.subscribers:
+                sub.Put('health', msg)
+
+    def Close(self):
+        self.closed = True
+        self.server.close()
+
+
+class PublishSink(progress.ProgressSink):
+    """
+    Progress sink: publishes everything the run reports.
+    """
+    def __init__(self, publisher):
+        self.pub = publisher
+
+    def Status(self, msg, field=0):
+        self.pub.Publish('status', 'Status', msg, key=field)
+
+    def Data(self, t, Vm, Vsd, P, r, flag):
+        self.pub.Publish('data', 'Data', {'t':t, 'Vm':Vm, 'Vsd':Vsd, 'P':P, 'r':r, 'flag':flag}, key=flag)
+
+    def Rows(self, start, stop):
+        self.pub.Publish('progress', 'Rows', {'start':start, 'stop':stop})
+
+    def Row(self, r):
+        self.pub.Publish('progress', 'Row', r)
+
+    def Delays(self, n, s, AZ1, r):
+        self.pub.Publish('progress', 'Delays', {'n':n, 'start':s, 'AZ1':AZ1, 'range':r})
+
+    def Switchbox(self, conf):
+        self.pub.Publish('progress', 'Switchbox', conf)
+
+    def SrcV(self, role, V):
+        self.pub.Publish('progress', 'SrcV', V, key=role)
+
+    def ClearPlot(self):
+        self.pub.Publish('plot', 'ClearPlot', None)
+
+    def Plot(self, **data):
+        self.pub.Publish('plot', 'Plot', data)
+
+    def Eta(self, finish, remaining):
+        self.pub.Publish('progress', 'Eta', {'finish':finish, 'remaining':remaining})
+
+    def LiveR1(self, r, R1, u, R0, u0, n):
+        self.pub.Publish('progress', 'LiveR1', {'r':r, 'R1':R1, 'u':u, 'R0':R0, 'u0':u0, 'n':n})
+
+    def Running(self, running):
+        self.pub.Publish('progress', 'Running', running)
+
+
+"""
+---------------------------------------------------------------
+Command-line monitor
+"""
+
+def FormatTime(t):
+    return dt.datetime.fromtimestamp(t).strftime("%H:%M:%S")
+
+
+def Describe(msg):
+    # One line for a streamed message
+    kind,data = msg.get('kind'), msg.get('data')
+    if kind == 'Status':
+        return 'status: %s'%data
+    if kind == 'Data':
+        return 'row %s %s: %s V, sd %s V (%s%%)'%(data['r'], data['flag'], data['Vm'], data['Vsd'], data['P'])
+    if kind == 'Eta':
+        return 'ETA %s'%dt.datetime.fromtimestamp(data['finish']).strftime("%d/%m/%Y %H:%M")
+    if kind == 'LiveR1' and data['R0'] is None:
+        return 'row %s: R1 = %.10g, u = %.3g'%(data['r'], data['R1'], data['u'])
+    if kind == 'LiveR1':
+        return 'row %s: R1 = %.10g, u = %.3g; run so far (%d blocks): %.10g, u = %.3g'%(data['r'], data['R1'], data['u'],
+                                                                                        data['n'], data['R0'], data['u0'])
+    if kind == 'Plot':
+        return 'row done: %d V1, %d V2, %d Vd readings'%(len(data['V1']), len(data['V2']), len(data['Vd']))
+    if kind == 'Health':
+        return 'health: '+', '.join(['%s %s calls %s err%s'%(r, h['calls'], h['errors'], ' (demo)' if h.get('demo') else '')
+                                     for r,h in sorted(data.items()) if r != 'dropped'])
+    return '%s: %s'%(kind, json.dumps(data))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Follow an HRBC run published on a local socket.')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--snapshot', action='store_true', help='print the current state and exit')
+    parser.add_argument('--topics', default=None, help='comma-separated topics (default all): '+','.join(TOPICS))
+    args = parser.parse_args(argv)
+
+    sock = socket.create_connection((args.host, args.port))
+    if args.snapshot:
+        sock.sendall(Encode({'cmd':'snapshot'}))
+    else:
+        topics = args.topics.split(',') if args.topics else None
+        sock.sendall(Encode({'cmd':'subscribe', 'topics':topics}))
+    try:
+        while True:
+            msg = Receive(sock)
+            if msg is None:
+                break
+            if msg['topic'] == 'snapshot':
+                print json.dumps(msg['data'], indent=1, sort_keys=True)
+            else:
+                print FormatTime(msg['t']), Describe(msg)
+    except KeyboardInterrupt:
+        pass
+    sock.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
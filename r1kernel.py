@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+r1kernel.py - Vectorised R1 calculation for HRBA quick-look.
+
+HRBA builds dozens of GTC ureals for every 4-row block of data, then an
+uncertainty budget - fine for a certificate but slow for a quick look at
+a workbook full of runs. Here the same measurement model,
+
+    R1 = -R2*(1+vrc)*V1av*G/(G*V2av - Vdav)
+    R2 = R2_0*(1 + alpha*dT2 + beta*dT2**2 + gamma*dV2) + Rd
+    G = (Vd3 - Vd2 + Vlin_gain + Vdrift_gain)/(V2_3 - V2_2)
+
+is evaluated with NumPy for all blocks of all runs at once. Each block is
+one row of an array of its input quantities (INPUTS - the same elementary
+quantities HRBA lists in 'influencies'), and first-order uncertainties
+come from the analytic Jacobian of the model: u(R1)**2 = sum((c_i*u_i)**2),
+with Welch-Satterthwaite degrees of freedom.
+
+Differences from the full GTC analysis (use HRBA for final results):
+* correlations between blocks (shared corrections, Rd) aren't tracked -
+  each block's own uncertainty is the same, but combining blocks isn't,
+* Rd is one input (its GTC value, uncertainty and effective dof),
+* T-sensor DVM data are ignored - as in HRBA.
+"""
+
+import time
+import numpy as np
+from numbers import Number
+
+import R_info
+import glsfit
+
+INPUTS = ('V1_0','V1_1','V1_2','V1_3',
+          'V2_0','V2_1','V2_2','V2_3',
+          'Vd_0','Vd_1','Vd_2','Vd_3',
+          'vrc','Vlin_gain','Vlin_Vd','Vdrift_gain','Vdrift_Vd',
+          'R2_0','R2alpha','R2beta','R2gamma','R2TRef','R2VRef',
+          'T2_gmh','GMH2_cor','T_def','Rd')
+COL = dict([(name,i) for i,name in enumerate(INPUTS)])
+
+GMH_DIGI = 0.01 # GMH digitization (C)
+T_DEF_U = 0.01 # Temperature definition (sensor positioning) std uncert. (C)
+T_DEF_DF = 3
+VDRIFT_DF = 8
+
+
+def XUD(q):
+    # (value, std uncert, dof) of a ureal or plain number
+    if hasattr(q, 'x'):
+        return (q.x, q.u, q.df)
+    return (float(q), 0.0, np.inf)
+
+
+def Key(q):
+    # Same key wherever the same ureal is used (-1: this block's own quantity)
+    if hasattr(q, 'x'):
+        return id(q)
+    return -1
+
+
+def EstimateDigitized(x, delta):
+    """
+    Mean and std uncert. of each row of x (blocks x readings) - as
+    GTC.ta.estimate_digitized() for rounded data.
+    """
+    N = x.shape[-1]
+    mu = x.mean(axis=-1)
+    var = x.var(axis=-1, ddof=1)
+    x_max = x.max(axis=-1)
+    x_min = x.min(axis=-1)
+    root_c_12 = {2:np.sqrt(6.4/12.0), 3:np.sqrt(1.3/12.0)}.get(N, np.sqrt(1.0/12.0))
+    lsd_only = np.abs(x_max - x_min - delta) < 10*np.finfo(float).eps
+    u = np.where(x_max == x_min, root_c_12*delta,
+                 np.where(lsd_only, np.sqrt(np.maximum(var/N, ((x_max + x_min)/2.0 - mu)**2/3.0)),
+                          np.sqrt(var/N)))
+    return (mu, u)
+
+
+def Terms(X):
+    # Intermediate quantities of the model (X: ... x INPUTS)
+    x = lambda name: X[...,COL[name]]
+    t = {}
+    t['V1av'] = (x('V1_0') - 2*x('V1_1') + x('V1_2'))/4
+    t['V2av'] = (x('V2_0') - 2*x('V2_1') + x('V2_2'))/4
+    t['Vdav'] = (x('Vd_0') - 2*x('Vd_1') + x('Vd_2'))/4 + x('Vlin_Vd') + x('Vdrift_Vd')
+    t['dT2'] = x('T2_gmh') + x('GMH2_cor') - x('R2TRef') + x('T_def')
+    t['s'] = np.sign(np.abs(t['V2av']) - x('R2VRef')) # d(dV2)/d(|V2av|)
+    t['dV2'] = np.abs(np.abs(t['V2av']) - x('R2VRef'))
+    t['R2fac'] = 1 + x('R2alpha')*t['dT2'] + x('R2beta')*t['dT2']**2 + x('R2gamma')*t['dV2']
+    t['R2'] = x('R2_0')*t['R2fac'] + x('Rd')
+    t['num'] = x('Vd_3') - x('Vd_2') + x('Vlin_gain') + x('Vdrift_gain')
+    t['den'] = x('V2_3') - x('V2_2')
+    t['G'] = t['num']/t['den']
+    t['Q'] = t['G']*t['V2av'] - t['Vdav']
+    t['R1'] = -t['R2']*(1 + x('vrc'))*t['V1av']*t['G']/t['Q']
+    return t
+
+
+def Evaluate(X):
+    """
+    R1 for each row of X (any leading shape: blocks, or draws x blocks).
+    """
+    return Terms(X)['R1']
+
+
+def Jacobian(X):
+    """
+    dR1/d(input) for each row of X - same shape as X.
+    """
+    x = lambda name: X[...,COL[name]]
+    t = Terms(X)
+    R1,R2,G,Q = t['R1'],t['R2'],t['G'],t['Q']
+    J = np.zeros(X.shape)
+    def Add(name, value):
+        J[...,COL[name]] += value
+
+    F = R1/R2 # dR1/dR2
+    dR1_dV1av = -R2*(1 + x('vrc'))*G/Q
+    dR1_dVdav = R1/Q
+    dR1_dG = R2*(1 + x('vrc'))*t['V1av']*t['Vdav']/Q**2
+    dR2_dV2av = x('R2_0')*x('R2gamma')*t['s']*np.sign(t['V2av']) # through dV2
+    dR1_dV2av = -R1*G/Q + F*dR2_dV2av
+    dR1_dnum = dR1_dG/t['den']
+    dR1_dden = -dR1_dG*G/t['den']
+    dR1_ddT2 = F*x('R2_0')*(x('R2alpha') + 2*x('R2beta')*t['dT2'])
+
+    for i,c in enumerate((0.25, -0.5, 0.25)):
+        Add('V1_%d'%i, c*dR1_dV1av)
+        Add('V2_%d'%i, c*dR1_dV2av)
+        Add('Vd_%d'%i, c*dR1_dVdav)
+    Add('V2_3', dR1_dden)
+    Add('V2_2', -dR1_dden)
+    Add('Vd_3', dR1_dnum)
+    Add('Vd_2', -dR1_dnum)
+    Add('Vlin_gain', dR1_dnum)
+    Add('Vdrift_gain', dR1_dnum)
+    Add('Vlin_Vd', dR1_dVdav)
+    Add('Vdrift_Vd', dR1_dVdav)
+    Add('vrc', R1/(1 + x('vrc')))
+    Add('R2_0', F*t['R2fac'])
+    Add('R2alpha', F*x('R2_0')*t['dT2'])
+    Add('R2beta', F*x('R2_0')*t['dT2']**2)
+    Add('R2gamma', F*x('R2_0')*t['dV2'])
+    Add('R2VRef', -F*x('R2_0')*x('R2gamma')*t['s'])
+    for name in ('T2_gmh','GMH2_cor','T_def'):
+        Add(name, dR1_ddT2)
+    Add('R2TRef', -dR1_ddT2)
+    Add('Rd', F)
+    return J
+
+
+def Propagate(X, U, DF):
+    """
+    First-order uncertainty of R1 for each row of X (std uncerts U, dofs DF).
+    Returns (R1, u, dof, u-components) - u-components like GTC.component().
+    """
+    comp = Jacobian(X)*U
+    u = np.sqrt((comp**2).sum(axis=-1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df = u**4/(comp**4/DF).sum(axis=-1) # Welch-Satterthwaite
+    df = np.where(np.isnan(df), np.inf, df)
+    return (Evaluate(X), u, df, comp)
+
+
+"""
+---------------------------------------------------------------
+Reading blocks from the workbook
+"""
+
+def Runs(ws_Data):
+    """
+    [(Run_Id, start_row, stop_row),...] of every run on the Data sheet, where
+    stop_row is the last row of the last complete 4-row block.
+    """
+    runs = []
+    row = 1
+    while row <= ws_Data.max_row:
+        if ws_Data['A'+str(row)].value != 'Run Id:':
+            row += 1
+            continue
+        Run_Id = ws_Data['B'+str(row)].value
+        start = stop = row + 1
+        while all([isinstance(ws_Data[c+str(stop)].value, Number) for c in ('A','H','N','Q')]):
+            stop += 1 # Rows with settings and readings
+        n_blocks = (stop - start)/4
+        if n_blocks > 0:
+            runs.append((Run_Id, start, start + 4*n_blocks - 1))
+        row = stop
+    return runs
+
+
+def RunInputs(ws_Data, start, stop, I_INFO, R_INFO, role_descr, R2_name, Rd):
+    """
+    Inputs of each 4-row block from start to stop: values X, std uncerts U
+    and dofs DF (blocks x INPUTS), IDS - the same number (>= 0) where the
+    same quantity (e.g. a correction, or Rd) is used in several blocks,
+    or -1 - and a dict of per-block arrays of mean time (s from epoch),
+    V1av and T1 (values) for reporting.
+    """
+    rows = range(start, stop+1)
+    n_blocks = len(rows)/4
+    col = lambda c: [ws_Data[c+str(r)].value for r in rows]
+    block = lambda values: np.array(values, dtype=float).reshape(n_blocks, 4)
+
+    n = col('C')
+    X = np.zeros((n_blocks, len(INPUTS)))
+    U = np.zeros(X.shape)
+    DF = np.zeros(X.shape)
+    IDS = -np.ones(X.shape, dtype=np.int64)
+    # Raw voltage measurements: readings taken (J,K,L) may be fewer than n (C)
+    for name,(c_mean,c_sd,c_n) in (('V1',('Q','R','J')), ('V2',('H','I','K')), ('Vd',('N','O','L'))):
+        taken = block([k or n_row for k,n_row in zip(col(c_n), n)])
+        for i,(x,u,df) in enumerate(zip(block(col(c_mean)).T, block(col(c_sd)).T, (taken - 1).T)):
+            X[:,COL['%s_%d'%(name,i)]],U[:,COL['%s_%d'%(name,i)]],DF[:,COL['%s_%d'%(name,i)]] = x,u,df
+
+    # Drift of null-meter reading
+    Vd,V2 = X[:,COL['Vd_0']:COL['Vd_0']+4],X[:,COL['V2_0']:COL['V2_0']+4]
+    u_drift = np.abs(Vd[:,2]-(Vd[:,0]+((Vd[:,3]-Vd[:,2])/(V2[:,3]-V2[:,2]))*(V2[:,2]-V2[:,0])))/4
+    for name in ('Vdrift_gain','Vdrift_Vd'):
+        U[:,COL[name]],DF[:,COL[name]] = u_drift,VDRIFT_DF
+
+    # Temperatures
+    T2,U[:,COL['T2_gmh']] = EstimateDigitized(block(col('V')), GMH_DIGI)
+    X[:,COL['T2_gmh']],DF[:,COL['T2_gmh']] = T2,3
+    U[:,COL['T_def']],DF[:,COL['T_def']] = T_DEF_U,T_DEF_DF
+    GMH1_cor = XUD(I_INFO[role_descr['GMH1']]['T_correction'])[0]
+
+    # Corrections and R2 parameters - chosen per block by V settings
+    V1set,V2set = col('A')[::4],col('B')[::4]
+    R2_info = R_INFO[R2_name]
+    DVMd = I_INFO[role_descr['DVMd']]
+    times = col('G'),col('M'),col('P')
+    t_av = np.zeros(n_blocks)
+    for b in range(n_blocks):
+        R2_0,R2TRef,R2VRef = R_info.SelectR2(R2_info, V2set[b])
+        params = {'vrc':I_INFO[role_descr['DVM12']][R_info.VRatioCode(V1set[b], V2set[b])],
+                  'Vlin_gain':DVMd['linearity_gain'], 'Vlin_Vd':DVMd['linearity_Vd'],
+                  'R2_0':R2_0, 'R2TRef':R2TRef, 'R2VRef':R2VRef,
+                  'R2alpha':R2_info['alpha'], 'R2beta':R2_info['beta'], 'R2gamma':R2_info['gamma'],
+                  'GMH2_cor':I_INFO[role_descr['GMH2']]['T_correction'], 'Rd':Rd}
+        for name,q in params.items():
+            X[b,COL[name]],U[b,COL[name]],DF[b,COL[name]] = XUD(q)
+            IDS[b,COL[name]] = Key(q)
+        t_av[b] = R_info.av_t_strin([t[r] for r in range(4*b, 4*b+4) for t in times],'fl')
+
+    info = {'time_fl':t_av, 'V':Terms(X)['V1av'],
+            'T':block(col('U')).mean(axis=1) + GMH1_cor, 'row':np.array(rows[::4])}
+    return (X, U, DF, IDS, info)
+
+
+def QuickLook(ws_Data, ws_Rlink, I_INFO, R_INFO, log, xlfile=None):
+    """
+    R1 for every complete block of every run on the Data sheet.
+    Runs that can't be analysed (unknown R2, no Rlink data, ...) are skipped.
+    With xlfile (the workbook's filename), stored Rd values are used (see
+    R_info.StoredRd()).
+    Returns a list of dicts (one per run) of per-block arrays.
+    """
+    t0 = time.time()
+    runs = []
+    for Run_Id,start,stop in Runs(ws_Data):
+        try:
+            R1_name,R2_name = R_info.ExtractNames(ws_Data['Z'+str(start)].value or '')
+            assert R2_name in R_INFO,'Unknown Rs: '+R2_name
+            if xlfile is None:
+                Rd = R_info.GetRd(ws_Rlink, Run_Id, log)[0]
+            else:
+                Rd = R_info.StoredRd(xlfile, ws_Rlink, Run_Id, log)[0]
+            role_descr = R_info.GetRoles(ws_Data, start)
+            X,U,DF,IDS,info = RunInputs(ws_Data, start, stop, I_INFO, R_INFO, role_descr, R2_name, Rd)
+        except (AssertionError, KeyError, TypeError, ValueError) as msg:
+            print'QuickLook(): Skipping run',Run_Id,'-',msg
+            log.write('\nQuickLook(): Skipping run %s - %s'%(Run_Id, msg))
+            continue
+        info.update({'Run_Id':Run_Id, 'name':R1_name, 'X':X, 'U':U, 'DF':DF, 'IDS':IDS})
+        runs.append(info)
+    t1 = time.time()
+
+    # All blocks of all runs in one go
+    if len(runs) > 0:
+        X,U,DF = [np.vstack([run[k] for run in runs]) for k in ('X','U','DF')]
+        R1,u,df,comp = Propagate(X, U, DF)
+        i = 0
+        for run in runs:
+            n = len(run['X'])
+            run.update({'R':R1[i:i+n], 'u':u[i:i+n], 'df':df[i:i+n], 'comp':comp[i:i+n]})
+            i += n
+    print'QuickLook(): %d runs, %d blocks (read %.2f s, calculate %.4f s)'%(len(runs), sum([len(r['X']) for r in runs]),
+                                                                              t1 - t0, time.time() - t1)
+    return runs
+
+
+def Report(runs, log):
+    # Print and log one line per block (with Monte Carlo results, if any - see montecarlo.py)
+    for run in runs:
+        mc = run.get('mc')
+        lines = ['\nRun Id: %s (%s)'%(run['Run_Id'], run['name']),
+                 '  row   V1av        T (C)    R1                  std u       dof   largest u contrib.' +
+                 ('  MC: std u    95% interval' if mc else '')]
+        for b in range(len(run['R'])):
+            top = np.argmax(np.abs(run['comp'][b]))
+            line = '  %-5d %-11.5g %-8.3f %-19.12g %-11.3g %-5s %-18s'%(run['row'][b], run['V'][b], run['T'][b],
+                                                                     run['R'][b], run['u'][b],
+                                                                     'inf' if np.isinf(run['df'][b]) else int(round(run['df'][b])),
+                                                                     INPUTS[top])
+            if mc:
+                line += '    %-10.3g [%.12g, %.12g]'%(mc['u'][b], mc['low'][b], mc['high'][b])
+            lines.append(line.rstrip())
+        if run.get('fit') is not None:
+            lines += glsfit.Describe(run['fit'])
+        print '\n'.join(lines)
+        log.write('\n'.join(lines))
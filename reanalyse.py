@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+reanalyse.py - Re-analyse only the runs affected by changed parameters.
+
+When an entry on the Parameters sheet is corrected (e.g. a VRC_10to1 value
+or a GMH T_correction), every run whose results depend on it has to be
+re-analysed. HRBA saves, with each run's state (see incremental.py), the
+labels and values of the parameters each of the run's blocks depends on
+(from the block's list of influence quantities - see runanalysis.py).
+This command compares them with the Parameters sheet now and, for each
+run with a changed parameter, recalculates only what depends on it:
+- the blocks that use a changed parameter (R1, budget, Monte Carlo),
+  written over their old results on the Results sheet;
+- the run's fits and, if the run added R1 to the Parameters sheet,
+  those R1 parameters.
+Rd (from the Rlink sheet) and the other blocks' results are re-used, and
+the other parameters keep their saved values (and correlations).
+
+Runs are done in the order they were analysed, so a run whose R2 is an
+earlier run's R1 is picked up when that R1's parameters are re-written.
+A run is skipped (re-analyse it with HRBA) if it has no saved state,
+its Results-sheet block has been overwritten or a parameter it depends
+on is no longer on the sheet.
+
+Examples:
+python reanalyse.py data.xlsx --dry-run
+python reanalyse.py data.xlsx
+"""
+
+import os
+import sys
+import argparse
+import datetime as dt
+
+from openpyxl import load_workbook
+
+import R_info
+import r1kernel
+import runanalysis
+import incremental
+import resultcache
+
+VERSION = runanalysis.VERSION
+
+
+def Changed(record, values):
+    # Labels of run record's parameters whose values aren't the same as values (the sheet's) now
+    return sorted([label for label,v in record['dep_values'].items() if values.get(label) != v])
+
+
+def Substitute(info, new_info, labels):
+    # info (I_INFO or R_INFO) with its parameters labelled labels replaced by new_info's
+    new = {}
+    for params in new_info.values():
+        for v in params.values():
+            if incremental.IsUreal(v) and v.label is not None:
+                new[v.label] = v
+    for params in info.values():
+        for p,v in params.items():
+            if incremental.IsUreal(v) and v.label in labels:
+                assert new.has_key(v.label),'Parameter '+v.label+' is no longer on the Parameters sheet!'
+                params[p] = new[v.label]
+    return info
+
+
+def Reanalyse(wb, state, changed, log):
+    """
+    Re-analyse the blocks of a run (saved state) that depend on changed
+    parameters, and the run's fits. Results are written to workbook wb
+    and state is updated.
+    """
+    ws_Data = wb.get_sheet_by_name('Data')
+    ws_Summary = wb.get_sheet_by_name('Results')
+    ws_Params = wb.get_sheet_by_name('Parameters')
+    Run_Id = state['Run_Id']
+    start,stop = state['Data_start_row'],state['Data_row']-1
+
+    # Changed parameters from the sheet, the rest as they were
+    I_new,R_new = R_info.ReadParams(ws_Params,log)[:2]
+    I_INFO = Substitute(state['I_INFO'],I_new,changed)
+    R_INFO = Substitute(state['R_INFO'],R_new,changed)
+
+    R1_name,R2_name = R_info.ExtractNames(ws_Data['Z'+str(start)].value)
+    role_descr = R_info.GetRoles(ws_Data,start)
+    LV,HV = runanalysis.LVHV(ws_Data,start)
+    Rd_data = [state[k] for k in R_info.RD_NAMES]
+
+    # Blocks
+    results,result_rows,block_deps = state['results'],state['result_rows'],state['deps']
+    blocks = [b for b,deps in enumerate(block_deps) if set(deps) & set(changed)]
+    for b in blocks:
+        print 'Block',b+1,'(Data row %d, Results row %d)'%(start+4*b,result_rows[b])
+        log.write('\nBlock %d (Data row %d, Results row %d)'%(b+1,start+4*b,result_rows[b]))
+        results[b],budget,block_deps[b] = runanalysis.AnalyseBlock(ws_Data,start+4*b,I_INFO,R_INFO,role_descr,
+                                                                   R1_name,R2_name,Run_Id,Rd_data)
+        R_info.WriteThisResult(ws_Summary,result_rows[b],results[b])
+        R_info.WriteBudget(ws_Summary,result_rows[b],budget)
+    results_LV = []
+    results_HV = []
+    for result in results:
+        runanalysis.AddResult(result,results_LV,results_HV,LV,HV)
+
+    X,U,DF,IDS,info = r1kernel.RunInputs(ws_Data,start,stop,I_INFO,R_INFO,role_descr,R2_name,Rd_data[0])
+    run = dict(info, IDS=IDS)
+    run['R'],run['u'],run['df'],run['comp'] = r1kernel.Propagate(X,U,DF)
+    if state['mc_trials'] > 0: # Just the re-analysed blocks
+        runanalysis.MonteCarlo(ws_Summary,[result_rows[b] for b in blocks],X[blocks],U[blocks],DF[blocks],
+                               IDS[blocks],state['mc_trials'],state['mc_processes'],log)
+
+    # Fits
+    R_data,summary_row = runanalysis.WriteFits(ws_Summary,state['summary_start_row']+1,
+                                               results_LV,results_HV,LV,HV,run,log)
+    if R_info.RewriteR_Info(R1_name,runanalysis.R1_PARAMS,R_data,ws_Params,Run_Id,VERSION):
+        print 'Re-wrote',R1_name,'resistor info'
+        log.write('\nRe-wrote '+R1_name+' resistor info')
+        R_INFO[R1_name] = dict(zip(runanalysis.R1_PARAMS,R_data))
+
+    param_values = runanalysis.ParamValues(I_INFO,R_INFO)
+    state.update({'I_INFO':I_INFO,'R_INFO':R_INFO,'results':results,'deps':block_deps,
+                  'dep_values':dict([(label,param_values[label]) for deps in block_deps for label in deps])})
+    return (R_data,summary_row)
+
+
+def GetParser():
+    parser = argparse.ArgumentParser(description='HRBA v'+str(VERSION)+
+                                     ': re-analyse the runs affected by changes to the Parameters sheet.')
+    parser.add_argument('xlfile', help='Excel data file')
+    parser.add_argument('--dry-run', action='store_true', help='just list the affected runs and parameters')
+    return parser
+
+
+def main(argv=None):
+    parser = GetParser()
+    args = parser.parse_args(argv)
+    xlfile = os.path.abspath(args.xlfile)
+    if not os.path.isfile(xlfile):
+        parser.error('No such file: %s'%xlfile)
+    log = open(os.path.join(os.path.dirname(xlfile), R_info.Make_Log_Name(VERSION)),'a')
+    log.write(dt.datetime.now().strftime('%d/%m/%Y %H:%M:%S') + '\n' + xlfile + '\nreanalyse.py\n')
+
+    wb = load_workbook(xlfile,data_only=True)
+    ws_Data = wb.get_sheet_by_name('Data')
+    ws_Rlink = wb.get_sheet_by_name('Rlink')
+    ws_Summary = wb.get_sheet_by_name('Results')
+    ws_Params = wb.get_sheet_by_name('Parameters')
+
+    done = [] # (state, R_data, last Results row) of each re-analysed run
+    records = sorted(incremental.Records(xlfile), key=lambda r: r['summary_start_row'])
+    for record in records:
+        Run_Id = record['Run_Id']
+        I_INFO,R_INFO = R_info.ReadParams(ws_Params,log)[:2] # Again - an earlier run may have changed them
+        changed = Changed(record,runanalysis.ParamValues(I_INFO,R_INFO))
+        if len(changed) == 0:
+            continue
+        n_blocks = len([deps for deps in record['deps'] if set(deps) & set(changed)])
+        print '\nRun Id:',Run_Id,'-',n_blocks,'of',len(record['deps']),'blocks depend on',', '.join(changed)
+        log.write('\nRun Id: %s - %d of %d blocks depend on %s'%(Run_Id,n_blocks,len(record['deps']),', '.join(changed)))
+        if args.dry_run:
+            continue
+        if record['hrba_version'] != VERSION or ws_Summary['D'+str(record['summary_start_row'])].value != str(Run_Id):
+            print 'Saved state is out of date - re-analyse',Run_Id,'with HRBA.'
+            log.write('\nSaved state is out of date - re-analyse '+Run_Id+' with HRBA.')
+            continue
+        state = incremental.Load(xlfile,Run_Id)
+        try:
+            R_data,summary_row = Reanalyse(wb,state,changed,log)
+        except (AssertionError, KeyError) as msg:
+            print 'Can\'t re-analyse',Run_Id,'-',msg,'- re-analyse it with HRBA.'
+            log.write('\nCan\'t re-analyse %s - %s - re-analyse it with HRBA.'%(Run_Id,msg))
+            continue
+        done.append((state,R_data,summary_row))
+
+    if len(done) > 0:
+        wb.save(xlfile)
+        for state,R_data,summary_row in done:
+            Run_Id = state['Run_Id']
+            state['params_hash'] = R_info.ParamsHash(ws_Params)
+            incremental.Save(xlfile,Run_Id,state)
+            start,stop = state['Data_start_row'],state['Data_row']-1
+            role_descr = R_info.GetRoles(ws_Data,start)
+            R2_name = R_info.ExtractNames(ws_Data['Z'+str(start)].value)[1]
+            cache_key = resultcache.Key(ws_Data,start,stop,ws_Rlink,Run_Id,ws_Params,role_descr.values()+[R2_name],
+                                        log,VERSION,state['mc_trials'])
+            resultcache.Save(xlfile,Run_Id,cache_key,ws_Summary,state['summary_start_row'],state['next_row'],
+                             max(state['next_row']-1,summary_row),R_data)
+    print '\n%d of %d saved runs re-analysed'%(len(done),len(records))
+    log.write('\n%d of %d saved runs re-analysed\n\n'%(len(done),len(records)))
+    log.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
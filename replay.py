@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+replay.py - Deterministic replay of recorded instrument traces.
+
+A Player answers instrument calls (SendCmd, Read, Measure, SetV, ...)
+from a bus trace recorded by bustrace.py, so AqnThread and RLThread can
+re-run a historical measurement without the bridge: the same replies, in
+the same order, raising the same errors. ReplayInstrument stands in for
+devices.instrument / devices.GMH_Sensor in devices.ROLES_INSTR.
+
+Each role's recorded calls are matched in order. A call may be answered
+by a later recorded call with the same command (e.g. after a change in
+measurement order) unless strict, in which case any difference from the
+recording raises ReplayMismatch. Calls made inside another recorded call
+(e.g. GMH Transmit within Measure) are dropped when the trace is loaded.
+
+Time is virtual: while replaying, the 'time' module of acquisition,
+RLink, devices and estimator is replaced by a VirtualClock that starts
+at the recorded start time. At full speed sleep() just advances the
+clock and each call advances it by its recorded latency, so timestamps
+in the workbook follow the recorded run. With real_time the clock runs
+at normal speed, sleeps really sleep and calls take their recorded time.
+
+Roles that were in demo mode when recorded stay in demo mode; their
+simulated readings come from np.random, seeded (SEED) so replays of
+demo traces are repeatable too.
+
+Use a copy of the Excel file - the replayed run writes to it as usual.
+"""
+
+import sys
+import time
+import threading
+import collections
+
+import numpy as np
+
+import devices
+import bustrace
+
+SEED = 12345 # np.random seed for demo-mode readings
+
+
+class ReplayMismatch(Exception):
+    """ The code asked an instrument for something that isn't in the recording. """
+    pass
+
+
+class ReplayedError(Exception):
+    """ An error recorded in the trace, raised again at the same call. """
+    pass
+
+
+class VirtualClock():
+    """
+    Replay time. Full speed: advances only when told to. Real time: runs
+    at normal speed from the start time.
+    """
+    def __init__(self, start, real_time=False):
+        self.start = start
+        self.real_time = real_time
+        self.real_start = time.time()
+        self.offset = 0.0 # Virtual seconds elapsed (full speed)
+        self.lock = threading.Lock()
+
+    def Time(self):
+        if self.real_time:
+            return self.start + time.time() - self.real_start
+        with self.lock:
+            return self.start + self.offset
+
+    def Sleep(self, seconds):
+        if self.real_time:
+            time.sleep(seconds)
+        else:
+            self.Advance(seconds)
+
+    def Advance(self, seconds):
+        with self.lock:
+            self.offset += max(seconds, 0)
+
+
+class TimeModule():
+    """
+    Stands in for the time module in replayed code: time() and sleep() use
+    the VirtualClock, everything else is the real time module.
+    """
+    def __init__(self, clock):
+        self.clock = clock
+
+    def time(self):
+        return self.clock.Time()
+
+    def sleep(self, seconds):
+        self.clock.Sleep(seconds)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def DropNested(events):
+    # Remove calls made within a later-finishing call of the same role (records are in order of completion)
+    kept = []
+    for ev in events:
+        while kept and kept[-1].t0 >= ev.t0 and kept[-1].t1 <= ev.t1:
+            kept.pop()
+        kept.append(ev)
+    return kept
+
+
+class Player():
+    """
+    Recorded calls, per role, and the replay clock.
+    """
+    def __init__(self, filename, strict=False, real_time=False):
+        by_role = collections.OrderedDict()
+        for rec in bustrace.Read(filename):
+            if isinstance(rec, bustrace.EventRec):
+                by_role.setdefault(rec.role, []).append(rec)
+        assert len(by_role) > 0,'No instrument calls in trace %s'%filename
+        self.events = dict([(r,DropNested(evs)) for r,evs in by_role.items()])
+        self.demo = dict([(r,all([ev.flags & bustrace.DEMO for ev in evs])) for r,evs in self.events.items()])
+        self.strict = strict
+        self.clock = VirtualClock(min([evs[0].t0 for evs in self.events.values()]), real_time)
+        self.lock = threading.Lock()
+        self.replayed = 0
+        self.out_of_order = 0
+
+    def Next(self, role, cmd):
+        """
+        Recorded reply to cmd from role (re-raises a recorded error).
+        """
+        with self.lock:
+            queue = self.events.get(role, [])
+            for i,ev in enumerate(queue):
+                if ev.cmd == cmd:
+                    break
+                if self.strict:
+                    raise ReplayMismatch('%s: recorded "%s", replay asked for "%s"'%(role, ev.cmd, cmd))
+            else:
+                raise ReplayMismatch('%s: no recorded "%s" left'%(role, cmd))
+            del queue[i]
+            self.replayed += 1
+            if i > 0:
+                self.out_of_order += 1
+        self.clock.Sleep(ev.t1 - ev.t0) # The call takes its recorded time
+        if ev.flags & bustrace.ERROR:
+            raise ReplayedError(ev.error)
+        return ev.reply
+
+    def Skip(self, role, method):
+        # Drop the role's next recorded calls of this method
+        with self.lock:
+            queue = self.events.get(role, [])
+            while queue and queue[0].cmd.split(' ')[0] == method:
+                self.clock.Advance(queue[0].t1 - queue[0].t0)
+                del queue[0]
+
+    def Report(self):
+        # Text lines: how faithful the replay was
+        lines = ['Replayed %d calls (%d out of recorded order)'%(self.replayed, self.out_of_order)]
+        for r,queue in sorted(self.events.items()):
+            if len(queue) > 0:
+                lines.append('%s: %d recorded calls not replayed (next: "%s")'%(r, len(queue), queue[0].cmd))
+        return lines
+
+
+class ReplayInstrument():
+    """
+    Replaces a devices.instrument or devices.GMH_Sensor: every method
+    returns the recorded reply.
+    """
+    def __init__(self, descr, role, player):
+        self.Descr = descr
+        self.role = role
+        self.player = player
+        self.demo = player.demo.get(role, True)
+        self.gmh = 'GMH' in role # GMH Open, Init, Close aren't traced - only Transmit and Measure
+        info = devices.INSTR_DATA.get(descr, {})
+        self.addr = info.get('addr')
+        self.str_addr = info.get('str_addr')
+
+    def Call(self, method, *args):
+        return self.player.Next(self.role, bustrace.FormatCmd(method, args))
+
+    def Open(self):
+        if self.gmh:
+            self.player.Skip(self.role, 'Transmit') # Responsiveness test
+            return not self.demo
+        return self.Call('Open')
+
+    def Close(self):
+        if self.gmh:
+            return 1
+        return self.Call('Close')
+
+    def Init(self):
+        if self.gmh:
+            return None
+        return self.Call('Init')
+
+    def SetV(self, V):
+        return self.Call('SetV', V)
+
+    def SetFn(self):
+        return self.Call('SetFn')
+
+    def Oper(self):
+        return self.Call('Oper')
+
+    def Stby(self):
+        return self.Call('Stby')
+
+    def CheckErr(self):
+        return self.Call('CheckErr')
+
+    def SendCmd(self, s):
+        return self.Call('SendCmd', s)
+
+    def Read(self):
+        return self.Call('Read')
+
+    def Test(self, s):
+        return self.SendCmd(s)
+
+    def Measure(self, meas):
+        return self.Call('Measure', meas)
+
+
+"""
+---------------------------------------------------------------
+Installing a replay
+"""
+REPLAY_MODULES = ('acquisition', 'RLink', 'devices', 'estimator')
+_saved_time = {}
+
+
+def CreateRoles(roles, player):
+    """
+    Replay instruments for all roles - as devices.CreateRoles(), including
+    the (replayed) opening of VISA instruments.
+    """
+    futures = []
+    for r,d in roles.items():
+        devices.ROLES_INSTR[r] = ReplayInstrument(d, r, player)
+        if d in devices.INSTR_DATA:
+            devices.INSTR_DATA[d]['role'] = r
+            devices.INSTR_DATA[d]['demo'] = devices.ROLES_INSTR[r].demo
+        if 'GMH' not in r:
+            futures.append(devices.Submit(r,'Open'))
+    for f in futures:
+        f.Result()
+
+
+def Start(player):
+    # Switch the replayed modules to virtual time
+    np.random.seed(SEED)
+    for name in REPLAY_MODULES:
+        m = sys.modules.get(name)
+        if m is not None and name not in _saved_time:
+            _saved_time[name] = m.time
+            m.time = TimeModule(player.clock)
+
+
+def Stop():
+    # Back to real time
+    for name,t in _saved_time.items():
+        sys.modules[name].time = t
+    _saved_time.clear()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+resultcache.py - Re-use HRBA's results for runs whose inputs haven't changed.
+
+An HRBA analysis of a run depends only on the run's rows of the Data
+sheet, its block of Rlink data, the Parameters-sheet entries for R2 and
+the run's instruments - and on HRBA itself. Key() is a hash of exactly
+those (plus HRBA's version and anything else that changes the output,
+e.g. the number of Monte Carlo trials).
+
+After an analysis, HRBA saves the run's block of the Results sheet (cell
+values and styles, from the headings to the last fit) and the R1
+parameters it derived, under that key. If a later analysis of the run
+gets the same key, the block is just written out again at the current
+start row of the Results sheet - no budgets or fits are recalculated.
+
+The cache lives with incremental.py's saved state, in '<workbook>.hrba'.
+"""
+
+import os
+import copy
+import hashlib
+import cPickle
+
+import GTC
+
+import R_info
+import incremental
+
+VERSION = 1 # Format of cache files
+EXT = '.cache'
+
+
+def Key(ws_Data, start, stop, ws_Rlink, Run_Id, ws_Params, names, log, *extra):
+    """
+    Hash of a run's inputs: its Data rows (start-stop, with the run id
+    and roles), its Rlink block, the Parameters rows of the resistors
+    and instruments in names - and extra.
+    """
+    h = hashlib.md5(repr((VERSION,) + extra))
+    for r in ws_Data.iter_rows(min_row=start-1, max_row=max(stop, start+R_info.N_ROLES-1), max_col=30):
+        h.update(repr([c.value for c in r]))
+    RL_start_row,N_revs,N_reads = R_info.RlinkBlock(ws_Rlink, Run_Id, log)
+    for r in ws_Rlink.iter_rows(min_row=RL_start_row-1, max_row=RL_start_row+4+N_reads, max_col=max(2*N_revs, 4)):
+        h.update(repr([c.value for c in r]))
+    h.update(R_info.ParamsHash(ws_Params, names))
+    return h.hexdigest()
+
+
+def Save(xlfile, Run_Id, key, sheet, start_row, next_row, last_row, R_data):
+    """
+    Save the run's Results block - rows start_row-1 (headings) to
+    last_row, next_row being the next run's start row - and R_data.
+    """
+    cells = []
+    for r in sheet.iter_rows(min_row=start_row-1, max_row=last_row):
+        for c in r:
+            if c.has_style:
+                cells.append((c.column, c.row - start_row, c.value, copy.copy(c.font), copy.copy(c.fill)))
+            elif c.value is not None:
+                cells.append((c.column, c.row - start_row, c.value, None, None))
+    data = [(incremental.IsUreal(v), (v.x, v.u, v.df) if incremental.IsUreal(v) else v) for v in R_data]
+    filename = incremental.Path(xlfile, Run_Id, EXT)
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'wb') as f:
+        cPickle.dump({'version':VERSION, 'key':key, 'cells':cells, 'rows':next_row - start_row,
+                      'R_data':data}, f, 2)
+
+
+def Load(xlfile, Run_Id, key):
+    # Cached results for a run, or None if there aren't any with this key
+    filename = incremental.Path(xlfile, Run_Id, EXT)
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, 'rb') as f:
+        cached = cPickle.load(f)
+    if cached['version'] != VERSION or cached['key'] != key:
+        return None
+    return cached
+
+
+def Rewrite(sheet, start_row, cached):
+    """
+    Write a cached Results block, starting at start_row, and set the next
+    start row (B1). Returns the cached R1 parameters (ureals, for the
+    Parameters sheet).
+    """
+    for col,row,value,font,fill in cached['cells']:
+        c = sheet[col+str(start_row+row)]
+        c.value = value
+        if font is not None:
+            c.font = font
+            c.fill = fill
+    sheet['B1'] = start_row + cached['rows']
+    return [GTC.ureal(*v) if un else v for un,v in cached['R_data']]
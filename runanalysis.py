@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+"""
+runanalysis.py - HRBA's analysis of a run, one stage at a time.
+
+The stages of a full HRBA analysis (HRBA.py) that a partial re-analysis
+(reanalyse.py) also needs: one 4-row block's R1 and uncertainty budget,
+Monte Carlo uncertainties and the LV, HV and joint fits of the whole run.
+Nothing is read from or written to the Parameters sheet here.
+
+Each block's results depend on some of the Parameters-sheet entries
+(corrections, R2's parameters...) - AnalyseBlock() also returns their
+labels (from the block's list of influence quantities), so HRBA can save
+them with the run's state (see incremental.py).
+"""
+
+import math
+
+import GTC
+
+import R_info
+import montecarlo
+import glsfit
+import incremental
+
+VERSION = 1.3 # HRBA version
+
+ZERO = GTC.ureal(0,0)
+PPM_TOLERANCE = {'R2':1e-4,'G':0.01,'R1':1e-3}
+
+# R1 parameters added to the Parameters sheet, if R1 isn't there already
+R1_PARAMS = ['R0_LV','TRef_LV','VRef_LV','R0_HV','TRef_HV','VRef_HV','alpha',
+             'beta','gamma','date','T_sensor']
+
+
+# Determine the meanings of 'LV' and 'HV' for a run starting at start_row
+def LVHV(ws_Data,start_row):
+    V1set_a = abs(ws_Data['A'+str(start_row)].value)
+    assert V1set_a is not None,'Missing initial V1 value!'
+    V1set_b = abs(ws_Data['A'+str(start_row+4)].value)
+    assert V1set_b is not None,'Missing second V1 value!'
+
+    if V1set_a < V1set_b:
+        LV = V1set_a
+        HV = V1set_b 
+    elif V1set_b < V1set_a:
+        LV = V1set_b
+        HV = V1set_a
+    else: # 'HV' and 'LV' equal
+        LV = HV = V1set_a
+    return (LV,HV)
+
+
+# {label: (value,uncert,dof)} of every labelled ureal in I_INFO and R_INFO
+def ParamValues(I_INFO,R_INFO):
+    values = {}
+    for info in (I_INFO,R_INFO):
+        for params in info.values():
+            for v in params.values():
+                if incremental.IsUreal(v) and v.label is not None:
+                    values[v.label] = (v.x,v.u,v.df)
+    return values
+
+
+def AnalyseBlock(ws_Data,Data_row,I_INFO,R_INFO,role_descr,R1_name,R2_name,Run_Id,Rd_data):
+    """
+    R1 from the 4-row block starting at Data_row. Rd_data is
+    (Rd,nom_R1,nom_R2,abs_V1,abs_V2) - see R_info.GetRd().
+    Returns the result (dict of name,time,R,T,V entries), its uncertainty
+    budget and the (sorted) labels of the Parameters-sheet entries it
+    depends on.
+    """
+    Rd,nom_R1,nom_R2,abs_V1,abs_V2 = Rd_data
+
+    # R2 parameters:
+    V2set = ws_Data['B'+str(Data_row)].value # Changed from Data_start_row!
+    assert V2set is not None,'Missing V2 setting!'
+    V1set = ws_Data['A'+str(Data_row)].value  # Changed from Data_start_row!
+    assert V1set is not None,'Missing V1 setting!'
+    
+    # Select R2 info based on applied voltage ('LV' or 'HV')
+    R2_0,R2TRef,R2VRef = R_info.SelectR2(R_INFO[R2_name],V2set)
+
+    v_ratio_code = R_info.VRatioCode(V1set,V2set)
+    
+    # Select appropriate value of VRC, etc.
+    """
+    #################################################################
+    NOTE: In future, replace VRCs with individual gain factors for
+    each test-V (at mid- or top-of-range), on each instrument. Since
+    this matches available info in DMM cal. cert. and minimises the
+    number of possible values (ie: No. of test-Vs] < [No. of possible
+    voltage ratios]).
+    #################################################################
+    """
+    vrc = I_INFO[role_descr['DVM12']][v_ratio_code]
+    Vlin_gain = I_INFO[role_descr['DVMd']]['linearity_gain'] # linearity used in G calculation
+    Vlin_Vd = I_INFO[role_descr['DVMd']]['linearity_Vd'] # linearity used in Vd calculation
+    
+    # Start list of influence variables
+    influencies = [vrc,Vlin_gain,Vlin_Vd,R2TRef,R2VRef] # R2 dependancies
+
+    R2alpha = R_INFO[R2_name]['alpha']
+    R2beta = R_INFO[R2_name]['beta']
+    R2gamma = R_INFO[R2_name]['gamma']
+    R2Tsensor  = R_INFO[R2_name]['T_sensor']
+    influencies.extend([R2_0,R2alpha,R2beta,R2gamma]) # R2 dependancies
+    
+    if not R_INFO.has_key(R1_name):
+        R1Tsensor = 'Pt 100r' # assume a Pt sensor in unknown resistor
+    else:
+        R1Tsensor = R_INFO[R1_name]['T_sensor'] 
+    
+    # GMH correction factors
+    GMH1_cor = I_INFO[role_descr['GMH1']]['T_correction']
+    GMH2_cor = I_INFO[role_descr['GMH2']]['T_correction']
+    
+    
+    # Temperature measurement, RH and times:
+    raw_gmh1 = [] # list for 4 corrected T1 gmh readings
+    raw_gmh2 = [] # list for 4 corrected T2 gmh readings
+    T_dvm1 = [] # list for 4 corrected T1(dvm) readings
+    T_dvm2 = [] # list for 4 corrected T2(dvm) readings
+    R_dvm1 = [] # list for 4 corrected dvm readings
+    R_dvm2 = [] # list for 4 corrected dvm readings
+    times = [] # list for 3*4 mean measurement time-strings
+    RHs = [] # list for 4 RH values
+    Ps = [] # list for 4 room pressure values
+    Ts = [] # list for 4 room Temp values
+    
+    
+    # Process times, RH and temperature data in this 4-row block:
+    for r in range(Data_row,Data_row+4): # build list of 4 gmh / T-probe dvm readings
+        assert ws_Data['U'+str(r)].value is not None,'No R1 GMH temperature data!'
+        assert ws_Data['V'+str(r)].value is not None,'No R2 GMH temperature data!'
+        raw_gmh1.append(ws_Data['U'+str(r)].value)
+        raw_gmh2.append(ws_Data['V'+str(r)].value)
+        
+        assert ws_Data['G'+str(r)].value is not None,'No V2 timestamp!'
+        assert ws_Data['M'+str(r)].value is not None,'No Vd1 timestamp!'
+        assert ws_Data['P'+str(r)].value is not None,'No V1 timestamp!'
+        times.append(ws_Data['G'+str(r)].value)
+        times.append(ws_Data['M'+str(r)].value)
+        times.append(ws_Data['P'+str(r)].value)
+               
+        assert ws_Data['S'+str(r)].value is not None,'No R1 raw DVM (temperature) data!'
+        raw_dvm1 = ws_Data['S'+str(r)].value
+        
+        assert ws_Data['T'+str(r)].value is not None,'No R2 raw DVM (temperature) data!'
+        raw_dvm2 = ws_Data['T'+str(r)].value
+        
+        # Check corrections for range-dependant values...
+        # and apply appropriate corrections
+        assert raw_dvm1 > 0,'DVMT1: Negative resistance value!'
+        assert raw_dvm2 > 0,'DVMT2: Negative resistance value!'
+        if raw_dvm1 < 120:
+            T1DVM_cor = I_INFO[role_descr['DVMT1']]['correction_100r']
+        elif raw_dvm1 < 12e3:
+            T1DVM_cor = I_INFO[role_descr['DVMT1']]['correction_10k']
+        else:
+            T1DVM_cor = I_INFO[role_descr['DVMT1']]['correction_100k']
+        R_dvm1.append(raw_dvm1*(1+T1DVM_cor))
+        
+        if raw_dvm2 < 120:
+            T2DVM_cor =  I_INFO[role_descr['DVMT2']]['correction_100r']
+        elif raw_dvm2 < 12e3:
+            T2DVM_cor =  I_INFO[role_descr['DVMT2']]['correction_10k']
+        else:
+            T2DVM_cor =  I_INFO[role_descr['DVMT2']]['correction_100k']
+        R_dvm2.append(raw_dvm2*(1+T2DVM_cor))
+    
+    # Mean temperature from GMH
+    # Data are plain numbers (with digitization rounding), so use ta.estimate_digitized() to return a ureal
+    assert len(raw_gmh1) > 1,'Not enough GMH1 temperatures to average!'
+    T1_av_gmh = GTC.ar.result(GTC.ta.estimate_digitized(raw_gmh1,0.01) + GMH1_cor,label='T1_av_gmh '+ Run_Id)
+    
+    assert len(raw_gmh2) > 1,'Not enough GMH2 temperatures to average!'
+    T2_av_gmh = GTC.ar.result(GTC.ta.estimate_digitized(raw_gmh2,0.01) + GMH2_cor,label='T2_av_gmh '+ Run_Id) 
+    
+    assert len(times) > 1,'Not enough timestamps to average!'
+    times_av_str = R_info.av_t_strin(times,'str') # mean time(as a time string)
+    times_av_fl = R_info.av_t_strin(times,'fl') # mean time(as a float)
+    
+    
+    """
+    TO DO: Incorporate ambient T, P, %RH readings into final reported results...
+    
+    assert len(RHs) > 1,'Not enough RH values to average!'
+    # Digitization could be 2 or 3 decimal places, depending on RH probe:
+    RH_av = GTC.ar.result(GTC.ta.estimate_digitized(RHs,R_info.GetDigi(RHs)),label = 'RH_av')
+    
+    ... (and same for T, P) ...
+    
+    """
+
+
+    # Build lists of 4 temperatures (calculated from T-probe dvm readings)...
+    # ... and calculate mean temperatures
+    if (R1Tsensor in ('none','any')): # no or unknown T-sensor (Tinsleys or T-sensor itelf)
+        T_dvm1 = [ZERO,ZERO,ZERO,ZERO]
+    else:
+        assert len(R_dvm1) > 1,'Not enough R_dvm1 values to average!'
+        for R in R_dvm1: # convert resistance measurement to a temperature
+            T_dvm1.append(R_info.R_to_T(R_INFO[R1Tsensor]['alpha'],
+                                        R_INFO[R1Tsensor]['beta'],R,
+                                        R_INFO[R1Tsensor]['R0_LV'],
+                                        R_INFO[R1Tsensor]['TRef_LV']))
+    if R2Tsensor in ('none','any'):
+        T_dvm2 = [ZERO,ZERO,ZERO,ZERO]
+    else:
+        assert len(R_dvm2) > 1,'Not enough R_dvm2 values to average!'
+        for R in R_dvm2: # convert resistance measurement to a temperature
+            T_dvm2.append(R_info.R_to_T(R_INFO[R2Tsensor]['alpha'],
+                                        R_INFO[R2Tsensor]['beta'],R,
+                                        R_INFO[R2Tsensor]['R0_LV'],
+                                        R_INFO[R2Tsensor]['TRef_LV']))
+                                        
+    # Mean temperature from T-probe dvm  
+    # Data are high-precision plain numbers, so use ta.estimate() to return a ureal                                 
+    T1_av_dvm = GTC.ar.result(GTC.ta.estimate(T_dvm1),label='T1_av_dvm'+ Run_Id)
+    T2_av_dvm = GTC.ar.result(GTC.ta.estimate(T_dvm2),label='T2_av_dvm'+ Run_Id)
+    
+    # Mean temperatures and temperature definitions
+#    if role_descr['DVMT1']=='none':  # No aux. T sensor or DVM not associated with R1 (just GMH)
+    T1_av = T1_av_gmh
+    T1_av_dvm = GTC.ureal(0,0) # ignore any dvm data
+    Diff_T1 = GTC.ureal(0,0) # No temperature disparity (GMH only)
+#    else:
+#        T1_av = GTC.ar.result(GTC.fn.mean((T1_av_dvm,T1_av_gmh)),label='T1_av'+ Run_Id)
+#        Diff_T1 = GTC.magnitude(T1_av_dvm-T1_av_gmh)
+    
+#    if role_descr['DVMT2']=='none':  # No aux. T sensor or DVM not associated with R2 (just GMH)
+    T2_av = T2_av_gmh
+    T2_av_dvm = GTC.ureal(0,0) # ignore any dvm data
+    Diff_T2 = GTC.ureal(0,0) # No temperature disparity (GMH only)
+    influencies.append(T2_av_gmh) # R2 dependancy
+#    else:
+#        T2_av = GTC.ar.result( GTC.fn.mean((T2_av_dvm,T2_av_gmh)),label='T2_av' + Run_Id)
+#        Diff_T2 = GTC.ar.result(GTC.magnitude(T2_av_dvm-T2_av_gmh),label='Diff_T2' + Run_Id)
+#        influencies.append(T2_av_dvm,T2_av_gmh) # R2 dependancy
+    
+    # Default T definition arises from imperfect positioning of sensors wrt resistor:
+    T_def = GTC.ureal(0,GTC.type_b.distribution['gaussian'](0.01),3,label='T_def '+ Run_Id)
+        
+    # T-definition arises from imperfect positioning of both probes AND their disagreement:
+    T_def1 = GTC.ar.result(GTC.ureal(0,Diff_T1.u/2,7) + T_def,label='T_def1 ' + Run_Id)    
+    T_def2 = GTC.ar.result(GTC.ureal(0,Diff_T2.u/2,7) + T_def,label = 'T_def2 ' + Run_Id)
+    influencies.append(T_def2) # R2 dependancy
+    
+    # Raw voltage measurements: V: [Vp,Vm,Vpp,Vppp]
+    # All measurements have high-enough precision to not worry about digitization error...
+    V1 = []
+    V2 = []
+    Vd = []
+    for line in range(4):
+        # Readings taken (J,K,L) may be fewer than n (C) if the phase stopped on target SEM
+        n = ws_Data['C'+str(Data_row+line)].value
+        n_V1,n_V2,n_Vd = [ws_Data[c+str(Data_row+line)].value or n for c in ('J','K','L')]
+        
+        V1.append(GTC.ureal(ws_Data['Q'+str(Data_row+line)].value,
+                        ws_Data['R'+str(Data_row+line)].value,
+                        n_V1-1,label='V1_'+str(line) + ' ' + Run_Id))
+        V2.append(GTC.ureal(ws_Data['H'+str(Data_row+line)].value,
+                        ws_Data['I'+str(Data_row+line)].value,
+                        n_V2-1,label='V2_'+str(line) + ' ' + Run_Id))
+        Vd.append(GTC.ureal(ws_Data['N'+str(Data_row+line)].value,
+                        ws_Data['O'+str(Data_row+line)].value,
+                        n_Vd-1,label='Vd_'+str(line) + ' ' + Run_Id))
+        assert V1[-1] is not None,'Missing V1 data!'
+        assert V2[-1] is not None,'Missing V2 data!'
+        assert Vd[-1] is not None,'Missing Vd data!'
+    influencies.extend(V1+V2+Vd) # R2 dependancies - raw measurements
+
+    # Define drift
+    Vdrift1=GTC.ureal(0,
+    GTC.tb.distribution['gaussian'](abs(Vd[2]-(Vd[0]+((Vd[3]-Vd[2])/(V2[3]-V2[2]))*(V2[2]-V2[0])))/4),
+                                8,label='Vdrift_gain '+ Run_Id)
+    Vdrift2=GTC.ureal(0,
+    GTC.tb.distribution['gaussian'](abs(Vd[2]-(Vd[0]+((Vd[3]-Vd[2])/(V2[3]-V2[2]))*(V2[2]-V2[0])))/4),
+                                8,label='Vdrift_Vd '+ Run_Id)
+    # 
+    Vdrift = {'gain':Vdrift1,'Vd':Vdrift2}
+    influencies.extend([Vdrift['gain'],Vdrift['Vd']]) # R2 dependancies
+    
+    # Mean voltages
+    V1av = (V1[0]-2*V1[1]+V1[2])/4
+    V2av = (V2[0]-2*V2[1]+V2[2])/4
+    Vdav = (Vd[0]-2*Vd[1]+Vd[2])/4 + Vlin_Vd + Vdrift['Vd']
+    
+    influencies.append(Rd) # R2 dependancy
+    
+    # Calculate R2 (corrected for T and V)
+    dT2 = T2_av - R2TRef + T_def2
+    
+    dV2 = abs(abs(V2av) - R2VRef) # NOTE: TWO abs() NEEDED TO ENSURE NON-NEGATIVE DIFFERENCE!
+
+    R2 = R2_0*(1+R2alpha*dT2 + R2beta*dT2**2 + R2gamma*dV2) + Rd
+    assert abs(R2.x-nom_R2)/nom_R2 < PPM_TOLERANCE['R2'],'R2 > 100 ppm from nominal! R2 = {0}'.format(R2.x)
+    
+    # Gain factor due to null meter input Z
+    G = (Vd[3]- Vd[2] + Vlin_gain + Vdrift['gain'])/(V2[3]-V2[2])
+    
+    if round(abs_V1.x/abs_V2.x) == 10:
+        nom_G = 10.0/11.0
+    elif round(abs_V1.x/abs_V2.x) == 1:
+        nom_G = 0.5 # nominally = 1/2
+    else:
+        assert False,'Wrong V1/V2 ratio!'
+    
+    assert abs(G.x-nom_G)/nom_G < PPM_TOLERANCE['G'],'Gain > 1% from nominal! G = {0}, nom_G = {1}'.format(G.x,nom_G)
+       
+    # calculate R1  
+    R1 = -R2*(1+vrc)*V1av*G/(G*V2av - Vdav)
+    assert abs(R1.x-nom_R1)/nom_R1 < PPM_TOLERANCE['R1'],'R1 > 1000 ppm from nominal!'
+    
+    T1 = T1_av + T_def1
+   
+    # Combine data for this measurement: name,time,R,T,V
+    this_result = {'name':R1_name,'time_str':times_av_str,'time_fl':times_av_fl,'V':V1av,
+                   'R':R1,'T':T1,'R_expU':R1.u*GTC.rp.k_factor(R1.df, quick=False)}
+
+    # build uncertainty budget table
+    budget_table =[]
+    for i in influencies: # rp.u_component(R1_gmh,i) gives + or - values
+        if i.u > 0:
+            sensitivity = GTC.rp.u_component(R1,i)/i.u # GTC.rp.sensitivity() deprecated
+        else:
+            sensitivity = 0
+        budget_table.append([i.label,i.x,i.u,i.df,sensitivity,GTC.component(R1,i)])
+        
+    budget_table_sorted = sorted(budget_table,key=R_info.by_u_cont,reverse=True)
+
+    # Parameters-sheet entries the result depends on (T1 depends on GMH1_cor, too)
+    labels = ParamValues(I_INFO,R_INFO)
+    deps = sorted(set([q.label for q in influencies + [GMH1_cor,GMH2_cor]
+                       if incremental.IsUreal(q) and q.label in labels]))
+    return (this_result,budget_table_sorted,deps)
+
+
+# Separate results by voltage if different
+def AddResult(result,results_LV,results_HV,LV,HV):
+    if HV == LV:
+        results_LV.append(result)
+        results_HV.append(result)
+    elif abs(result['V'].x - LV) < 1:
+        results_LV.append(result)
+    else:
+        results_HV.append(result)
+
+
+# Monte Carlo uncertainties of blocks X (all at once), written below their results (rows)
+def MonteCarlo(ws_Summary,rows,X,U,DF,IDS,trials,processes,log):
+    print '\nMonte Carlo:',trials,'trials...'
+    log.write('\nMonte Carlo: '+str(trials)+' trials')
+    mc = montecarlo.Summary(montecarlo.Run(X,U,DF,IDS,trials,processes=processes))
+    for b,row in enumerate(rows):
+        mc_b = {'mean':mc['mean'][b],'u':mc['u'][b],'low':mc['low'][b],'high':mc['high'][b],
+                'trials':mc['trials'],'p':mc['p']}
+        R_info.WriteMCResult(ws_Summary,row,mc_b)
+        line = 'Row %d: MC u = %.4g, 95%% interval [%.12g, %.12g]'%(row,mc_b['u'],mc_b['low'],mc_b['high'])
+        print line
+        log.write('\n'+line)
+
+
+def WriteFits(ws_Summary,summary_row,results_LV,results_HV,LV,HV,run,log):
+    """
+    Values of R1 are derived from fits to Temperature.
+    The Temperature data are offset so the mean is at ~zero, then the fits
+    are used to calculate R1 at the mean Temperature. LV and HV values are
+    obtained separately. The mean time, Temperature and Voltage values are
+    also reported.
+
+    The fits are written from summary_row (the row below the run's
+    headings); run is the run's vectorised blocks (see r1kernel.py), for
+    the joint fit. Returns R1's parameters (R1_PARAMS values) and the last
+    row written.
+    """
+    # Weighted total least-squares fit (R1-T), LV
+    print '\nLV:'
+    log.write('\nLV:')
+    R1_LV, Ohm_per_C_LV, T_LV, V_LV, date = R_info.write_R1_T_fit(results_LV,ws_Summary,summary_row,log)
+    alpha_LV = Ohm_per_C_LV/R1_LV
+
+    summary_row += 1
+
+    # Weighted total least-squares fit (R1-T), HV
+    print '\nHV:'
+    log.write('\nHV:')
+    R1_HV, Ohm_per_C_HV, T_HV, V_HV, date = R_info.write_R1_T_fit(results_HV,ws_Summary,summary_row,log)
+    alpha_HV = Ohm_per_C_HV/R1_HV
+
+    alpha = GTC.fn.mean([alpha_LV,alpha_HV])
+    beta = GTC.ureal(0,0) # assume no beta
+
+    if HV == LV: # Can't estimate gamma
+        gamma = GTC.ureal(0,0)
+    else:
+        gamma = ((R1_HV-R1_LV)/(V_HV-V_LV))/R1_LV
+
+    summary_row += 2
+
+    ws_Summary['R'+str(summary_row)] = 'alpha (/C)'
+    ws_Summary['V'+str(summary_row)] = 'gamma (/V)'
+
+    summary_row += 1
+
+    ws_Summary['R'+str(summary_row)] = alpha.x
+    ws_Summary['S'+str(summary_row)] = alpha.u
+
+    if math.isinf(alpha.df):
+        print'alpha.df is',alpha.df
+        ws_Summary['T'+str(summary_row)] = str(alpha.df)
+    else:
+        print'alpha.df =',alpha.df
+        ws_Summary['T'+str(summary_row)] = round(alpha.df)
+
+    ws_Summary['V'+str(summary_row)] = gamma.x
+    ws_Summary['W'+str(summary_row)] = gamma.u
+    if math.isinf(gamma.df):
+        print'gamma.df is',gamma.df
+        ws_Summary['X'+str(summary_row)] = str(gamma.df)
+    else:
+        print'gamma.df =',gamma.df
+        ws_Summary['X'+str(summary_row)] = round(gamma.df)
+
+    # Joint GLS fit to T, V and t
+    no_fit = glsfit.JointFit([run])
+    if no_fit is None:
+        print '\n'+'\n'.join(glsfit.Describe(run['fit']))
+        log.write('\n'+'\n'.join(glsfit.Describe(run['fit'])))
+        summary_row += 2
+        summary_row = R_info.WriteJointFit(ws_Summary,summary_row,run['fit'])
+    else:
+        print '\nNo joint fit R1(T,V,t) -',no_fit
+        log.write('\nNo joint fit R1(T,V,t) - '+no_fit)
+
+    R_data = [R1_LV,T_LV,V_LV,R1_HV,T_HV,V_HV,alpha,beta,gamma, date, 'none']
+    return (R_data,summary_row)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+runconfig.py
+
+A RunConfig holds everything an acquisition (AqnThread) or R-link
+(RLThread) run needs that used to be read from GUI widgets. It's built
+by RunPage.GetRunConfig() in the GUI, or by hrbc_cli.py from command-line
+arguments.
+
+This module must not import wx.
+"""
+
+import datetime as dt
+
+from openpyxl import load_workbook
+
+VERSION = "1.0" # HRBC version (GUI and command-line)
+MIN_READINGS = 5 # Minimum readings per phase when stopping on target SEM
+
+
+class RunConfig():
+    """
+    Run configuration:
+    xlfilename - full path of the Excel data file,
+    wb - the open workbook (openpyxl, data_only = True),
+    log - open log file,
+    roles - dictionary of instrument descriptions keyed by role,
+    comment - written to every data row (column Z),
+    run_id - pairs RLink data with measurement data,
+    settle_time - delay (s) before the first measurement,
+    auto_range - if True, set DVM12 range to V2 for V2 measurements (else use V1 range),
+    R1Name, R2Name - resistor names (nominal value at the end, e.g. 'HRBC 1G'),
+    sem_ppm - target SEM of V1, V2 readings (ppm of setting) - stop early when reached,
+    sem_Vd - target SEM of Vd readings (V),
+    min_readings - never stop a phase early with fewer readings than this.
+    None (sem_ppm, sem_Vd) means always take the full n readings.
+    sequence - order of V1, V2, Vd phases: 'auto' (seqplan.Choose()) or a seqplan plan name.
+    """
+    def __init__(self, xlfilename, wb, log, roles, comment='', run_id='none',
+                 settle_time=0, auto_range=False, R1Name='', R2Name='',
+                 sem_ppm=None, sem_Vd=None, min_readings=MIN_READINGS, sequence='auto'):
+        self.xlfilename = xlfilename
+        self.wb = wb
+        self.log = log
+        self.roles = dict(roles)
+        self.comment = comment
+        self.run_id = run_id
+        self.settle_time = settle_time
+        self.auto_range = auto_range
+        self.R1Name = R1Name
+        self.R2Name = R2Name
+        self.sem_ppm = sem_ppm
+        self.sem_Vd = sem_Vd
+        self.min_readings = max(min_readings,2) # Need at least 2 for an SD
+        self.sequence = sequence
+
+    def __repr__(self):
+        return 'RunConfig(%s, R1=%s, R2=%s, run_id=%s)'%(self.xlfilename, self.R1Name,
+                                                         self.R2Name, self.run_id)
+
+
+def OpenWorkbook(xlfilename):
+    # Need cell VALUE, not FORMULA, so set data_only = True
+    return load_workbook(xlfilename, data_only = True)
+
+
+def NewRunId(version, R1Name, R2Name):
+    # Unique id used to link subsequent RLink and measurement data
+    return str('HRBC.v' + version + ' ' + R1Name + ':' + R2Name + ' ' +
+               dt.datetime.now().strftime("%d/%m/%Y %H:%M:%S"))
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+runqueue.py - Overnight run queue and scheduler.
+
+A RunQueue is a list of jobs, kept in a JSON file so it survives a restart.
+Each job is an acquisition run ('run': rows of the Data sheet) or an R-link
+measurement ('rlink': Rlink sheet), with its own workbook, resistor names,
+voltages, row range and instrument roles.
+
+The Scheduler executes pending jobs back to back, without the GUI: sources
+go to standby between jobs, and each job waits for its settle delay before
+measuring. If a job fails it's marked 'failed' (with the error message) and
+the scheduler moves on to the next one. Ctrl-C aborts the current job and
+stops the queue.
+
+Job status: 'pending' -> 'running' -> 'finished', 'aborted' or 'failed'.
+A job found 'running' when the queue is loaded was interrupted (e.g. by a
+crash) - it's marked 'interrupted' and not re-run until reset. When it is
+re-run, it resumes from its checkpoint (see checkpoint.py) if the run id
+matches, instead of starting again.
+
+Examples:
+python runqueue.py overnight.json add rlink data.xlsx --r1 "HRBC 1G" --r2 "HRBC 1M" --V1 100 --V2 10
+python runqueue.py overnight.json add run data.xlsx --r1 "HRBC 1G" --r2 "HRBC 1M" --rows 5 40 --share-id --settle 600
+python runqueue.py overnight.json add rlink data.xlsx --r1 "HRBC 1G" --r2 "HRBC 1M" --share-id
+python runqueue.py overnight.json list
+python runqueue.py overnight.json run --gap 300
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import datetime as dt
+import traceback
+
+import devices
+import checkpoint
+import bustrace
+import progress
+import runconfig
+import acquisition as acq
+import RLink as rl
+import hrbc_cli
+
+VERSION = runconfig.VERSION
+JOB_KINDS = ('run','rlink')
+
+
+def NewJob(kind, xlfile, r1='', r2='', comment='', run_id=None, share_id=False,
+           settle=0, auto_range=False, roles=None, rows=None, V1=None, V2=None,
+           reversals=None, readings=None, sem_ppm=None, sem_Vd=None, min_readings=runconfig.MIN_READINGS,
+           sequence='auto'):
+    """
+    Return a new (pending) job dictionary.
+    kind - 'run' or 'rlink',
+    run_id - if None, a new id is made when the job starts (pairs RLink and run data)...
+    share_id - ...unless True, in which case the previous job's run id is used
+    roles - role -> description assignments, overriding devices.DEFAULT_ROLES,
+    rows - [start, stop] Data sheet rows ('run' jobs; default: B1, B2),
+    V1, V2 - |V1|, |V2| ('rlink' jobs; default: Rlink sheet D1, D2),
+    reversals, readings - 'rlink' jobs (default: Rlink sheet B2, B3),
+    sem_ppm, sem_Vd, min_readings - early stopping ('run' jobs, see runconfig.RunConfig),
+    sequence - order of V1, V2, Vd phases ('run' jobs, see seqplan.py).
+    """
+    assert kind in JOB_KINDS,'Unknown job kind: %s'%kind
+    return {'kind':kind, 'xlfile':os.path.abspath(xlfile), 'r1':r1, 'r2':r2,
+            'comment':comment, 'run_id':run_id, 'share_id':share_id,
+            'settle':settle, 'auto_range':auto_range, 'roles':roles or {},
+            'rows':rows, 'V1':V1, 'V2':V2, 'reversals':reversals, 'readings':readings,
+            'sem_ppm':sem_ppm, 'sem_Vd':sem_Vd, 'min_readings':min_readings, 'sequence':sequence,
+            'status':'pending', 'message':'', 'started':None, 'finished':None}
+
+
+class RunQueue():
+    """
+    An ordered list of jobs, saved to filename after every change.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.jobs = []
+        self.next_id = 1
+        if os.path.isfile(filename):
+            self.Load()
+
+    def Load(self):
+        with open(self.filename) as f:
+            stored = json.load(f)
+        self.jobs = stored['jobs']
+        self.next_id = stored['next_id']
+        for job in self.jobs:
+            if job['status'] == 'running':
+                job['status'] = 'interrupted'
+                job['message'] = 'Found running when queue was loaded'
+
+    def Save(self):
+        # Write a new file, then replace the old one, so a crash can't leave half a queue
+        checkpoint.WriteJSON(self.filename, {'next_id':self.next_id, 'jobs':self.jobs})
+
+    def Add(self, job):
+        job['id'] = self.next_id
+        self.next_id += 1
+        self.jobs.append(job)
+        self.Save()
+        return job['id']
+
+    def Find(self, job_id):
+        for job in self.jobs:
+            if job['id'] == job_id:
+                return job
+        raise KeyError('No job %s in %s'%(job_id, self.filename))
+
+    def Remove(self, job_id):
+        self.jobs.remove(self.Find(job_id))
+        self.Save()
+
+    def Reset(self, job_id):
+        job = self.Find(job_id)
+        job['status'] = 'pending'
+        job['message'] = ''
+        self.Save()
+
+    def NextPending(self):
+        for job in self.jobs:
+            if job['status'] == 'pending':
+                return job
+        return None
+
+    def PreviousRunId(self, job):
+        # Run id of the nearest earlier job that has one (or None)
+        for previous in reversed(self.jobs[:self.jobs.index(job)]):
+            if previous['run_id'] is not None:
+                return previous['run_id']
+        return None
+
+    def SetStatus(self, job, status, message=''):
+        job['status'] = status
+        job['message'] = message
+        now = dt.datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+        if status == 'running':
+            job['started'] = now
+        else:
+            job['finished'] = now
+        self.Save()
+
+
+class Scheduler():
+    """
+    Execute the pending jobs of a RunQueue one after another.
+    gap - delay (s) between jobs, with sources at standby.
+    """
+    def __init__(self, queue, log, sink, gap=0):
+        self.queue = queue
+        self.log = log
+        self.sink = sink
+        self.gap = gap
+        self.stopped = False
+
+    def Run(self):
+        # Returns the number of jobs that didn't finish
+        n_bad = 0
+        job = self.queue.NextPending()
+        while job is not None and not self.stopped:
+            self.sink.Status('Scheduler: job %d (%s, %s)'%(job['id'],job['kind'],os.path.basename(job['xlfile'])), field=0)
+            self.queue.SetStatus(job, 'running')
+            try:
+                outcome,message = self.RunJob(job)
+            except Exception as msg:
+                print'Scheduler.Run(): job',job['id'],'failed:'
+                traceback.print_exc()
+                traceback.print_exc(file=self.log)
+                outcome,message = 'failed',str(msg)
+            self.queue.SetStatus(job, outcome, message)
+            print >>self.log,'Scheduler.Run(): job',job['id'],outcome,message
+            self.sink.Status('Scheduler: job %d %s %s'%(job['id'],outcome,message), field=0)
+            if outcome != 'finished':
+                n_bad += 1
+
+            self.Standby()
+            job = self.queue.NextPending()
+            if job is not None and not self.stopped and self.gap > 0:
+                self.sink.Status('Scheduler: waiting %d s before next job...'%self.gap, field=1)
+                try:
+                    time.sleep(self.gap)
+                except KeyboardInterrupt:
+                    self.stopped = True
+        return n_bad
+
+    def RunJob(self, job):
+        # Set up and run one job. Returns (outcome, message).
+        roles = dict(devices.DEFAULT_ROLES)
+        roles.update(job['roles'])
+
+        # Re-read instrument info (each job may use a different workbook) and (re-)create instruments
+        bustrace.Start(os.path.dirname(job['xlfile'])) # Trace alongside the data
+        wb = runconfig.OpenWorkbook(job['xlfile'])
+        devices.LoadInstrData(wb, self.log)
+        devices.CloseRoles()
+        devices.CreateRoles(roles)
+
+        if job['kind'] == 'run':
+            ws = wb.get_sheet_by_name('Data')
+            if job['rows'] is not None:
+                ws['B1'],ws['B2'] = job['rows']
+        else:
+            ws = wb.get_sheet_by_name('Rlink')
+            for cell,key in (('D1','V1'),('D2','V2'),('B2','reversals'),('B3','readings')):
+                if job[key] is not None:
+                    ws[cell] = job[key]
+
+        run_id = job['run_id']
+        if job['share_id']:
+            run_id = self.queue.PreviousRunId(job)
+        if run_id is None:
+            run_id = runconfig.NewRunId(VERSION, job['r1'], job['r2'])
+        job['run_id'] = run_id # Recorded so later jobs can share it
+        self.queue.Save()
+
+        config = runconfig.RunConfig(job['xlfile'], wb, self.log, roles,
+                                     comment = job['comment'],
+                                     run_id = run_id,
+                                     settle_time = job['settle'],
+                                     auto_range = job['auto_range'],
+                                     R1Name = job['r1'],
+                                     R2Name = job['r2'],
+                                     sem_ppm = job.get('sem_ppm'), # (not in older queue files)
+                                     sem_Vd = job.get('sem_Vd'),
+                                     min_readings = job.get('min_readings',runconfig.MIN_READINGS),
+                                     sequence = job.get('sequence','auto'))
+        print >>self.log,'Scheduler.RunJob(): job',job['id'],config
+
+        # Pick up where an interrupted attempt at this job left off
+        resume = checkpoint.Load(job['xlfile'], job['kind'])
+        if resume is not None and resume['run_id'] != run_id:
+            resume = None # Checkpoint belongs to some other run
+        if job['kind'] == 'run':
+            thread = acq.AqnThread(config, self.sink, resume)
+        else:
+            thread = rl.RLThread(config, self.sink, resume)
+        if hrbc_cli.WaitFor(thread):
+            self.stopped = True # Ctrl-C: abort this job and stop the queue
+        if thread.error is not None:
+            return thread.outcome, str(thread.error)
+        return thread.outcome, ''
+
+    def Standby(self):
+        # Leave sources safe between jobs (even if a job failed before its own standby)
+        for r in ('SRC1','SRC2'):
+            if r in devices.ROLES_INSTR:
+                try:
+                    devices.SetSrcV(r,0)
+                except Exception as msg:
+                    print >>self.log,'Scheduler.Standby(): failed to set',r,'to 0 V:',msg
+
+
+def ListJobs(queue):
+    for job in queue.jobs:
+        if job['kind'] == 'run':
+            detail = 'rows %s'%(job['rows'],) if job['rows'] is not None else 'rows B1:B2'
+        else:
+            detail = '|V1|=%s, |V2|=%s'%(job['V1'], job['V2'])
+        print '%3d %-11s %-5s %s, R1=%s, R2=%s, %s %s'%(job['id'], job['status'], job['kind'],
+                                                   os.path.basename(job['xlfile']), job['r1'],
+                                                   job['r2'], detail, job['message'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='HRBC v'+VERSION+': overnight run queue.')
+    parser.add_argument('queue', help='queue file (JSON)')
+    sub = parser.add_subparsers(dest='cmd')
+
+    add = sub.add_parser('add', help='add a job to the end of the queue')
+    add.add_argument('kind', choices=JOB_KINDS)
+    add.add_argument('xlfile', help='Excel data file')
+    hrbc_cli.AddRunArguments(add)
+    add.add_argument('--share-id', action='store_true', help='use the run id of the previous job')
+    add.add_argument('--rows', type=int, nargs=2, metavar=('START','STOP'), help="Data sheet rows ('run' jobs)")
+    add.add_argument('--V1', type=float, help="|V1| ('rlink' jobs)")
+    add.add_argument('--V2', type=float, help="|V2| ('rlink' jobs)")
+    add.add_argument('--reversals', type=int, help="number of reversals ('rlink' jobs)")
+    add.add_argument('--readings', type=int, help="readings per reversal ('rlink' jobs)")
+
+    sub.add_parser('list', help='list all jobs')
+    for cmd,hlp in (('remove','remove a job'),('reset','mark a job pending again')):
+        p = sub.add_parser(cmd, help=hlp)
+        p.add_argument('id', type=int)
+
+    run = sub.add_parser('run', help='run all pending jobs')
+    run.add_argument('--gap', type=int, default=0, help='delay (s) between jobs, sources at standby')
+    run.add_argument('--quiet', action='store_true', help='no console output (log file only)')
+
+    args = parser.parse_args(argv)
+    queue = RunQueue(args.queue)
+
+    if args.cmd == 'add':
+        roles = hrbc_cli.ParseRoles(parser, args.role)
+        roles = dict([(r,d) for r,d in roles.items() if devices.DEFAULT_ROLES[r] != d]) # Only overrides
+        job = NewJob(args.kind, args.xlfile, r1=args.r1, r2=args.r2, comment=args.comment,
+                     run_id=args.run_id, share_id=args.share_id, settle=args.settle,
+                     auto_range=args.auto_range, roles=roles, rows=args.rows,
+                     V1=args.V1, V2=args.V2, reversals=args.reversals, readings=args.readings,
+                     sem_ppm=args.sem_ppm, sem_Vd=args.sem_vd, min_readings=args.min_readings,
+                     sequence=args.sequence)
+        print 'Added job',queue.Add(job)
+    elif args.cmd == 'list':
+        ListJobs(queue)
+    elif args.cmd == 'remove':
+        queue.Remove(args.id)
+    elif args.cmd == 'reset':
+        queue.Reset(args.id)
+    elif args.cmd == 'run':
+        log = hrbc_cli.OpenLog(os.path.dirname(os.path.abspath(args.queue)))
+        sinks = [progress.LogSink(log)]
+        if not args.quiet:
+            sinks.append(progress.ConsoleSink())
+        scheduler = Scheduler(queue, log, progress.TeeSink(*sinks), gap=args.gap)
+        try:
+            n_bad = scheduler.Run()
+        finally:
+            devices.CloseAll()
+            log.close()
+        ListJobs(queue)
+        if n_bad > 0:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+seqplan.py - Measurement-order planner for acquisition runs.
+
+Each Data-sheet row measures three phases: V1, V2 (both on DVM12) and Vd
+(DVMd). Every phase needs the switchbox moved and a range delay, but a
+DVM12 range change (DCV,<range> + LFREQ + short delay) costs more - and
+is only needed when the range actually changes. That depends on the
+order of the phases, within a row and across row boundaries.
+
+The planner simulates every candidate order - the same permutation on
+every row, or a permutation on even rows and its reverse on odd rows -
+over the run's rows and picks the one with the least predicted settle
+time. HRBA's drift correction assumes the V1, V2 and Vd readings of each
+4-row block are centred on the same time, so a candidate is only allowed
+if no phase's mean time in any block is further from the block centre
+than with the original V1, V2, Vd order (plus SYMMETRY_TOL).
+
+The same cost model (the timing schedule of AqnThread) is used by
+estimator.py to predict run durations.
+
+Row order is never changed - HRBA relies on the 4-row (+,-,+,-) block
+structure of the Data sheet.
+"""
+
+import itertools
+
+PHASES = ('V1','V2','Vd')
+FIXED = 'V1-V2-Vd' # The original order
+BLOCK = 4 # HRBA analyses 4-row blocks
+
+# AqnThread's fixed delays (s) - acquisition.py and devices.py sleep for these
+SHORT_DEL_1 = 5.0 # Start of each row
+ERR_CHECK_DEL = 3.0 # After the F5520A error check
+SRC_DEL = 5.0 # Between setting SRC1 and SRC2
+SRC_SETTLE_DEL = 0.5 # devices._SetSrcV(): after setting V and again after Oper/Stby
+RANGE_SET_DEL = 0.5 # After a DVM12 range change
+SHORT_DEL_2 = 3.0 # After LFREQ, following a DVM12 range change
+
+# Cost model (s)
+RANGE_CHANGE_DEL = RANGE_SET_DEL + SHORT_DEL_2
+ROW_OVERHEAD = SHORT_DEL_1 + ERR_CHECK_DEL + SRC_DEL + 2*2*SRC_SETTLE_DEL # Two sources set - plus start del.
+READ_TIME = 1.0 # Per reading (approx.) - plus AZ1 del. for Vd
+EXTRA_READS = {'V1':2,'V2':2,'Vd':1} # Junk / dummy reads before each phase
+ROW_END_DEL = 2.0 # Temperature and room-condition reads at the end of a row (approx.)
+SYMMETRY_TOL = 1.0 # Allowed extra block asymmetry
+
+
+class SequencePlan():
+    """
+    Phase order for even rows and odd rows (counted from the run's start row).
+    """
+    def __init__(self, even, odd):
+        self.even = tuple(even)
+        self.odd = tuple(odd)
+        self.name = '-'.join(even)
+        if self.odd != self.even:
+            self.name += '/rev'
+
+    def Order(self, i):
+        # i: row index from the start row
+        if i % 2 == 0:
+            return self.even
+        return self.odd
+
+    def __repr__(self):
+        return 'SequencePlan(%s)'%self.name
+
+
+def Candidates():
+    plans = []
+    for perm in itertools.permutations(PHASES):
+        plans.append(SequencePlan(perm, perm))
+        plans.append(SequencePlan(perm, perm[::-1]))
+    return plans # FIXED is first
+
+
+def Names():
+    return [p.name for p in Candidates()]
+
+
+def Find(name):
+    for p in Candidates():
+        if p.name == name:
+            return p
+    raise KeyError('Unknown measurement sequence: %s'%name)
+
+
+def ReadRows(ws, first_row, last_row):
+    # Row settings (Data sheet columns A-F) used by the cost model
+    rows = []
+    for r in range(first_row, last_row+1):
+        V1,V2,n,start_del,AZ1_del,range_del = [ws.cell(row=r,column=c).value for c in range(1,7)]
+        rows.append({'V1':V1,'V2':V2,'n':n,'start_del':start_del,
+                     'AZ1_del':AZ1_del,'range_del':range_del})
+    return rows
+
+
+def DVMRange(node, rs, auto_range):
+    # DVM12 range needed for a phase (None for Vd - it's on DVMd)
+    if node == 'V1':
+        return abs(float(rs['V1']))
+    elif node == 'V2':
+        if auto_range:
+            return abs(float(rs['V2']))
+        return abs(float(rs['V1']))
+    return None
+
+
+def Simulate(plan, rows, auto_range, offset=0):
+    """
+    Predicted timeline of a run. offset: index (from the start row) of rows[0].
+    Returns settle time, duration, number of DVM12 range changes, the
+    mid-time of each phase of each row and the end-time of each row.
+    """
+    t = 0.0
+    settle = 0.0
+    changes = 0
+    dvm_range = None
+    mids = []
+    ends = []
+    for i,rs in enumerate(rows):
+        t += ROW_OVERHEAD + rs['start_del']
+        row_mids = {}
+        for node in plan.Order(i+offset):
+            d = rs['range_del']
+            rng = DVMRange(node, rs, auto_range)
+            if rng is not None and rng != dvm_range:
+                d += RANGE_CHANGE_DEL
+                dvm_range = rng
+                changes += 1
+            settle += d
+            t += d
+            t += EXTRA_READS[node]*READ_TIME
+            dur = rs['n']*READ_TIME
+            if node == 'Vd':
+                dur += rs['n']*rs['AZ1_del']
+            row_mids[node] = t + dur/2.0
+            t += dur
+        t += ROW_END_DEL
+        mids.append(row_mids)
+        ends.append(t)
+    return {'settle':settle,'duration':t,'range_changes':changes,'mids':mids,'row_ends':ends}
+
+
+def Asymmetry(mids, offset=0):
+    # Largest distance (s) of any phase's mean time from the centre of its 4-row block
+    blocks = {}
+    for i,row_mids in enumerate(mids):
+        blocks.setdefault((i+offset)//BLOCK, []).append(row_mids)
+    worst = 0.0
+    for block in blocks.values():
+        times = [t for row_mids in block for t in row_mids.values()]
+        centre = (min(times) + max(times))/2.0
+        for node in PHASES:
+            node_times = [row_mids[node] for row_mids in block]
+            worst = max(worst, abs(sum(node_times)/len(node_times) - centre))
+    return worst
+
+
+def Choose(rows, auto_range, offset=0):
+    """
+    Best (least settle time) symmetric plan for these rows.
+    Returns (plan, results) - results: [(plan, simulation, asymmetry),...].
+    """
+    results = []
+    for plan in Candidates():
+        sim = Simulate(plan, rows, auto_range, offset)
+        results.append((plan, sim, Asymmetry(sim['mids'], offset)))
+    limit = results[0][2] + SYMMETRY_TOL # FIXED sets the limit
+    allowed = [r for r in results if r[2] <= limit]
+    best = min(allowed, key=lambda r: r[1]['settle']) # min() keeps the first of equals - FIXED if no gain
+    return best[0], results